@@ -5,27 +5,30 @@ import re
 import uuid
 import json
 import concurrent.futures
+import threading
+import hashlib
+import random
 import base64
 from pathlib import Path
 from io import BytesIO
-from PIL import Image
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from PIL import Image, features
+import pandas as pd
 
 from google import genai
 from google.genai import types
 from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import FailedPrecondition
 from google.oauth2 import service_account
 
-# ReportLab PDF
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Spacer, PageBreak,
-    Image as RLImage, Table, TableStyle
-)
-from reportlab.lib.utils import ImageReader
-from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from reportlab.lib import colors
+import textbook_index
+from sanitizer import VISUAL_DIRECTIVE_RE, StreamSanitizer, sanitize_response, clean_display
+
+from pdf_render import create_pdf
+from model_scheduler import ModelScheduler
+from tracing import Tracer, walk
 
 # Matplotlib
 from matplotlib.figure import Figure
@@ -182,16 +185,58 @@ def get_firestore_client():
 
 db = get_firestore_client()
 
+# -----------------------------
+# SESSION READ CACHE
+# -----------------------------
+# Streamlit reruns the script on every widget interaction, so per-rerun lookups (profile, class, thread list) are
+# served from session_state. The app invalidates entries whenever it writes them itself; READ_CACHE_TTL bounds how
+# long changes made elsewhere (another tab, a teacher, the admin console) can stay invisible.
+READ_CACHE_TTL = 60
+
+@st.cache_resource
+def get_read_stats():
+    return {"lock": threading.Lock(), "reruns": 0, "reads": 0, "hits": 0}
+
+read_stats = get_read_stats()
+session_reads = st.session_state.setdefault("read_counter", {"current": 0, "history": []})
+session_reads["history"] = (session_reads["history"] + [session_reads["current"]])[-30:]
+session_reads["current"] = 0
+with read_stats["lock"]: read_stats["reruns"] += 1
+
+def count_reads(n=1):
+    session_reads["current"] += n
+    with read_stats["lock"]: read_stats["reads"] += n
+
+def cached_read(key, loader, ttl=READ_CACHE_TTL):
+    cache = st.session_state.setdefault("read_cache", {})
+    hit = cache.get(key)
+    if hit and time.time() - hit[0] < ttl:
+        with read_stats["lock"]: read_stats["hits"] += 1
+        return hit[1]
+    value = loader()
+    cache[key] = (time.time(), value)
+    return value
+
+def invalidate_reads(*kinds):
+    cache = st.session_state.get("read_cache", {})
+    for k in [k for k in cache if k[0] in kinds]: del cache[k]
+
 def get_student_class_data(student_email):
     if not db: return None
-    for c in db.collection("classes").where(filter=firestore.FieldFilter("students", "array_contains", student_email)).limit(1).stream():
-        return {"id": c.id, **c.to_dict()}
-    return None
+    def fetch():
+        count_reads()
+        for c in db.collection("classes").where(filter=firestore.FieldFilter("students", "array_contains", student_email)).limit(1).stream():
+            return {"id": c.id, **c.to_dict()}
+        return None
+    return cached_read(("class", student_email), fetch)
 
 def get_user_profile(email):
     if not db: return {"role": "student"}
+    return cached_read(("profile", email), lambda: fetch_user_profile(email))
+
+def fetch_user_profile(email):
     doc_ref = db.collection("users").document(email)
-    doc = doc_ref.get()
+    doc = doc_ref.get(); count_reads()
     if doc.exists:
         profile = doc.to_dict()
         needs_update = False
@@ -232,6 +277,89 @@ if is_authenticated:
     user_profile = get_user_profile(user_email)
     user_role = user_profile.get("role", "student")
 
+# -----------------------------
+# SESSION PAYLOAD STORE
+# -----------------------------
+# Messages in session_state only carry content-addressed keys (image_keys, image_refs, user_attachment_key). The
+# bytes live in one process-wide LRU capped at PAYLOAD_MEM_BYTES that spills evicted blobs to a size-capped disk
+# folder; saved images that fell out of both tiers are re-fetched from Firestore when their message is rendered.
+PAYLOAD_DIR = Path(".payload_store")
+PAYLOAD_MEM_BYTES = int(st.secrets.get("PAYLOAD_MEM_BYTES", 256 * 1024 * 1024))
+PAYLOAD_DISK_BYTES = 2 * 1024 * 1024 * 1024
+PAYLOAD_SESSION_IDLE = 3600
+
+@st.cache_resource
+def get_payload_store():
+    return {"lock": threading.Lock(), "mem": OrderedDict(), "mem_bytes": 0, "sizes": {}, "sessions": {},
+            "stats": {"hits": 0, "disk_hits": 0, "misses": 0, "spilled": 0}}
+
+payload_store = get_payload_store()
+payload_session = st.session_state.setdefault("payload_session", {"id": uuid.uuid4().hex, "keys": set(), "seen": 0})
+with payload_store["lock"]:
+    payload_session["seen"] = time.time()
+    payload_store["sessions"][payload_session["id"]] = payload_session
+    for sid in [sid for sid, s in payload_store["sessions"].items() if time.time() - s["seen"] > PAYLOAD_SESSION_IDLE]: del payload_store["sessions"][sid]
+
+def payload_put(data: bytes):
+    if not data: return None
+    key, ps = hashlib.sha256(data).hexdigest(), payload_store
+    with ps["lock"]:
+        if key in ps["mem"]: ps["mem"].move_to_end(key)
+        else: ps["mem"][key] = data; ps["mem_bytes"] += len(data)
+        ps["sizes"][key] = len(data)
+        evicted = []
+        while ps["mem_bytes"] > PAYLOAD_MEM_BYTES and len(ps["mem"]) > 1:
+            k, v = ps["mem"].popitem(last=False); ps["mem_bytes"] -= len(v); evicted.append((k, v))
+    if evicted: spill_payloads(evicted)
+    return key
+
+def payload_get(key):
+    if not key: return None
+    ps = payload_store
+    with ps["lock"]:
+        if (data := ps["mem"].get(key)) is not None:
+            ps["mem"].move_to_end(key); ps["stats"]["hits"] += 1
+            return data
+    try: data = (PAYLOAD_DIR / key).read_bytes()
+    except OSError:
+        with ps["lock"]: ps["stats"]["misses"] += 1
+        return None
+    with ps["lock"]: ps["stats"]["disk_hits"] += 1
+    payload_put(data) # back into RAM; the disk copy stays, so re-eviction costs no write
+    return data
+
+def spill_payloads(evicted):
+    try:
+        PAYLOAD_DIR.mkdir(exist_ok=True)
+        for key, data in evicted:
+            if (PAYLOAD_DIR / key).exists(): continue
+            tmp = PAYLOAD_DIR / f".{key}.{uuid.uuid4().hex}"
+            tmp.write_bytes(data); tmp.replace(PAYLOAD_DIR / key)
+        files = sorted((f.stat().st_mtime, f.stat().st_size, f) for f in PAYLOAD_DIR.iterdir() if not f.name.startswith("."))
+        total, dropped = sum(size for _, size, _ in files), []
+        for _, size, f in files:
+            if total <= PAYLOAD_DISK_BYTES: break
+            f.unlink(missing_ok=True); total -= size; dropped.append(f.name)
+        with payload_store["lock"]:
+            payload_store["stats"]["spilled"] += len(evicted)
+            for key in dropped:
+                if key not in payload_store["mem"]: payload_store["sizes"].pop(key, None)
+    except Exception as e: print(f"Payload Spill Error: {e}")
+
+def track_session_payloads(messages):
+    keys = {k for m in messages for k in [*(m.get("image_keys") or []), *(m.get("image_refs") or []), m.get("user_attachment_key")] if k}
+    with payload_store["lock"]: payload_session["keys"] = keys
+
+def payload_gauges():
+    ps = payload_store
+    with ps["lock"]:
+        sessions = {sid: sum(ps["sizes"].get(k, 0) for k in s["keys"]) for sid, s in ps["sessions"].items()}
+        return {"mem_bytes": ps["mem_bytes"], "mem_items": len(ps["mem"]), "stats": dict(ps["stats"]), "sessions": sessions}
+
+def payload_disk_usage():
+    try: return sum(f.stat().st_size for f in PAYLOAD_DIR.iterdir())
+    except Exception: return 0
+
 # -----------------------------
 # THREAD HELPERS
 # -----------------------------
@@ -242,63 +370,268 @@ def get_all_threads():
     coll_ref = get_threads_collection()
     if coll_ref:
         try:
-            return[{"id": doc.id, **doc.to_dict()} for doc in coll_ref.order_by("updated_at", direction=firestore.Query.DESCENDING).limit(15).stream()]
+            def fetch():
+                threads =[{"id": doc.id, **doc.to_dict()} for doc in coll_ref.order_by("updated_at", direction=firestore.Query.DESCENDING).limit(15).stream()]
+                count_reads(max(1, len(threads)))
+                return threads
+            return cached_read(("threads",), fetch)
         except Exception: pass
     return[]
 
+def touch_cached_thread(thread_id, **fields):
+    # Apply our own write to the cached thread list instead of re-querying; unknown (new) threads force a refetch.
+    hit = st.session_state.get("read_cache", {}).get(("threads",))
+    t = next((t for t in hit[1] if t["id"] == thread_id), None) if hit else None
+    if t is None: invalidate_reads("threads"); return
+    t.update(fields); hit[1].sort(key=lambda t: t.get("updated_at", 0), reverse=True)
+
 def get_default_greeting():
     return[{"role": "assistant", "content": "👋 **Hey there! I'm Helix!**\n\nI'm your friendly CIE tutor here to help you ace your CIE exams! 📖\n\nI can answer your doubts, draw diagrams, and create quizzes!\nYou can also **attach photos, PDFs, or text files directly in the chat box below!** 📸📄\n\nWhat are we learning today?", "is_greeting": True}]
 
+# Threads are stored append-only: the thread doc only carries lightweight metadata, each message is written once to
+# threads/{id}/messages/{seq}, and images live in content-addressed users/{email}/image_blobs/{sha256} docs.
+MESSAGE_PAGE_SIZE = 20
+
+def get_image_blobs_collection():
+    return db.collection("users").document(auth_object.email).collection("image_blobs") if is_authenticated and db else None
+
+def missing_blobs() -> set:
+    # Blob refs this session already looked up and Firestore did not have; they are never fetched again.
+    return st.session_state.setdefault("missing_blobs", set())
+
+def fetch_image_blobs(refs):
+    blobs_ref, missing = get_image_blobs_collection(), missing_blobs()
+    refs = {h for h in refs if h and h not in missing}
+    if not blobs_ref or not refs: return
+    count_reads(len(refs))
+    try:
+        found = set()
+        for snap in db.get_all([blobs_ref.document(h) for h in refs]):
+            if snap.exists and (data := (snap.to_dict() or {}).get("data")): payload_put(data); found.add(snap.id)
+        missing |= refs - found
+    except Exception as e: print(f"Image Blob Error: {e}")
+
+def message_images(msg):
+    # Rehydrated from the payload store on render; saved images missing from both tiers come back from Firestore.
+    keys = msg.get("image_keys") or msg.get("image_refs") or []
+    imgs = [payload_get(k) for k in keys]
+    if msg.get("image_refs") and any(k and img is None and k not in missing_blobs() for k, img in zip(keys, imgs)):
+        fetch_image_blobs(msg["image_refs"])
+        imgs = [payload_get(h) for h in msg["image_refs"]]
+    return imgs
+
+def legacy_messages(messages):
+    # Inline threads from before the messages subcollection carry base64 images; only their keys stay in the session.
+    # legacy_index lets save_chat_history re-read an image from the inline field if it was evicted before migration.
+    for i, m in enumerate(messages):
+        if "db_images" in m: m["image_refs"] = [payload_put(base64.b64decode(b)) if b else None for b in m.pop("db_images") or []]; m["legacy_index"] = i
+    return messages
+
+def message_from_doc(d: dict) -> dict:
+    return {"role": d.get("role"), "content": d.get("content", ""), "is_greeting": d.get("is_greeting", False), "is_downloadable": d.get("is_downloadable", False),
+            "image_refs": d.get("image_refs", []), "image_models": d.get("image_models", []), "seq": d.get("seq")}
+
 def load_chat_history(thread_id):
     coll_ref = get_threads_collection()
     if coll_ref and thread_id:
         try:
-            doc = coll_ref.document(thread_id).get()
-            if doc.exists: return doc.to_dict().get("messages",[])
+            doc = coll_ref.document(thread_id).get(); count_reads()
+            if doc.exists:
+                data = doc.to_dict()
+                if "messages" in data: # legacy inline thread: migrated into the subcollection on its next save
+                    st.session_state.thread_cursor = {"thread": thread_id, "next_seq": 0, "oldest_seq": 0}
+                    return legacy_messages(data["messages"])
+                st.session_state.history_summary = {"thread": thread_id, "text": data.get("summary", ""), "upto": data.get("summary_upto", 0)}
+                page =[message_from_doc(m.to_dict()) for m in coll_ref.document(thread_id).collection("messages").order_by("seq", direction=firestore.Query.DESCENDING).limit(MESSAGE_PAGE_SIZE).stream()][::-1]
+                count_reads(len(page))
+                st.session_state.thread_cursor = {"thread": thread_id, "next_seq": data.get("message_count", len(page)), "oldest_seq": page[0]["seq"] if page else 0}
+                if page: return page
         except Exception: pass
     return get_default_greeting()
 
-def compress_image_for_db(image_bytes: bytes) -> str:
+def load_earlier_messages():
+    coll_ref, cur = get_threads_collection(), st.session_state.get("thread_cursor") or {}
+    if not coll_ref or cur.get("thread") != st.session_state.current_thread_id or not cur.get("oldest_seq"): return
+    try:
+        page =[message_from_doc(m.to_dict()) for m in coll_ref.document(cur["thread"]).collection("messages").where(filter=firestore.FieldFilter("seq", "<", cur["oldest_seq"])).order_by("seq", direction=firestore.Query.DESCENDING).limit(MESSAGE_PAGE_SIZE).stream()][::-1]
+        count_reads(max(1, len(page)))
+        if page: st.session_state.messages = page + st.session_state.messages; cur["oldest_seq"] = page[0]["seq"]
+        else: cur["oldest_seq"] = 0
+    except Exception as e: st.toast(f"⚠️ DB Error: {e}")
+
+# -----------------------------
+# IMAGE INGESTION
+# -----------------------------
+# Images are stored downscaled to IMAGE_DB_MAX_PX and re-encoded as IMAGE_DB_FORMAT (JPEG, or WEBP via secrets when
+# Pillow has it). Each distinct image is encoded once per process: ingest_image memoizes the encode future by the
+# SHA-256 of the raw bytes (the payload key), and visuals are queued for encoding on image_ingest's pool the moment
+# they finish, so save_chat_history and paper jobs normally just collect finished results.
+IMAGE_DB_MAX_PX = 1024
+IMAGE_DB_FORMAT = "WEBP" if str(st.secrets.get("IMAGE_DB_FORMAT", "JPEG")).upper() == "WEBP" and features.check("webp") else "JPEG"
+IMAGE_DB_OPTIONS = {"JPEG": {"quality": 85, "optimize": True}, "WEBP": {"quality": 80, "method": 4}}
+IMAGE_INGEST_WORKERS = 4
+IMAGE_INGEST_MEMO = 512
+
+@st.cache_resource
+def get_image_ingest():
+    return {"lock": threading.Lock(), "memo": OrderedDict(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_INGEST_WORKERS, thread_name_prefix="image-ingest"),
+            "stats": {"images": 0, "memo_hits": 0, "passthrough": 0, "raw_bytes": 0, "stored_bytes": 0, "encode_s": 0.0}}
+
+image_ingest = get_image_ingest()
+
+def compress_image_for_db(image_bytes: bytes, fmt="JPEG") -> bytes:
     try:
         if not image_bytes: return None
-        img = Image.open(BytesIO(image_bytes)).convert('RGB')
-        img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+        img = Image.open(BytesIO(image_bytes))
+        if img.format == fmt and max(img.size) <= IMAGE_DB_MAX_PX: return image_bytes # already stored-size: no second generation loss
+        if img.format == "JPEG": img.draft("RGB", (IMAGE_DB_MAX_PX, IMAGE_DB_MAX_PX))
+        img = img.convert('RGB')
+        img.thumbnail((IMAGE_DB_MAX_PX, IMAGE_DB_MAX_PX), Image.Resampling.LANCZOS, reducing_gap=3.0)
         buf = BytesIO()
-        img.save(buf, format="JPEG", quality=85, optimize=True)
-        return base64.b64encode(buf.getvalue()).decode('utf-8')
+        img.save(buf, format=fmt, **IMAGE_DB_OPTIONS[fmt])
+        return buf.getvalue()
     except Exception: return None
 
-def save_chat_history():
-    coll_ref = get_threads_collection()
+def encode_for_db(data: bytes) -> bytes:
+    t0 = time.perf_counter()
+    blob = compress_image_for_db(data, IMAGE_DB_FORMAT)
+    with image_ingest["lock"]:
+        stats = image_ingest["stats"]
+        stats["images"] += 1; stats["passthrough"] += blob is data; stats["encode_s"] += time.perf_counter() - t0
+        if blob: stats["raw_bytes"] += len(data); stats["stored_bytes"] += len(blob)
+    return blob
+
+def ingest_image(data: bytes):
+    # -> Future of the bytes to store for this image. Safe to call from any thread.
+    key = hashlib.sha256(data).hexdigest()
+    with image_ingest["lock"]:
+        if (fut := image_ingest["memo"].get(key)) is not None:
+            image_ingest["memo"].move_to_end(key); image_ingest["stats"]["memo_hits"] += 1
+            return fut
+        fut = image_ingest["memo"][key] = image_ingest["pool"].submit(encode_for_db, data)
+        while len(image_ingest["memo"]) > IMAGE_INGEST_MEMO: image_ingest["memo"].popitem(last=False)
+    return fut
+
+def stored_image(key) -> bytes:
+    # Compressed bytes for a payload key; only images that fell out of the memo are encoded here.
+    with image_ingest["lock"]: fut = image_ingest["memo"].get(key)
+    if fut is None: fut = ingest_image(data) if (data := payload_get(key)) else None
+    try: return fut.result() if fut else None
+    except Exception as e: print(f"Image Ingest Error: {e}"); return None
+
+def ingest_visual(fut):
+    # done-callback for visual futures: starts the storage encode while the rest of the turn is still running
+    try: res = fut.result()
+    except Exception: return
+    if res and res[0]: ingest_image(res[0])
+
+def detect_thread_metadata(content_str: str):
+    subjects, grades = set(), set()
+    q = content_str.lower()
+    if any(k in q for k in["math", "algebra", "geometry", "calculate", "equation", "number", "fraction"]): subjects.add("Math")
+    if any(k in q for k in["science", "cell", "biology", "physics", "chemistry", "experiment", "gravity"]): subjects.add("Science")
+    if any(k in q for k in["english", "poem", "story", "essay", "writing", "grammar", "noun", "verb"]): subjects.add("English")
+    qn = normalize_stage_text(content_str)
+    if re.search(r"\b(stage\W*7|grade\W*6|class\W*6|year\W*6)\b", qn): grades.add("Grade 6")
+    if re.search(r"\b(stage\W*8|grade\W*7|class\W*7|year\W*7)\b", qn): grades.add("Grade 7")
+    if re.search(r"\b(stage\W*9|grade\W*8|class\W*8|year\W*8)\b", qn): grades.add("Grade 8")
+    return subjects, grades
+
+def save_chat_history(title=None):
+    coll_ref, blobs_ref = get_threads_collection(), get_image_blobs_collection()
     if not coll_ref: return
-    safe_messages, detected_subjects, detected_grades =[], set(), set()
-
-    for msg in st.session_state.messages:
+    thread_id = st.session_state.current_thread_id
+    cur = st.session_state.get("thread_cursor") or {}
+    if cur.get("thread") != thread_id: cur = st.session_state.thread_cursor = {"thread": thread_id, "next_seq": 0, "oldest_seq": 0}
+    pending =[m for m in st.session_state.messages if m.get("seq") is None]
+    if not pending: return
+    saved_blobs, new_blobs = st.session_state.setdefault("saved_blobs", set()), set()
+    detected_subjects, detected_grades, batches = set(), set(), [[db.batch(), 0]]
+
+    def write(ref, data, **kw): # legacy migrations can exceed the 500-op batch limit
+        if batches[-1][1] >= 450: batches.append([db.batch(), 0])
+        batches[-1][0].set(ref, data, **kw); batches[-1][1] += 1
+
+    legacy, unresolved = None, False # inline legacy messages, re-read only when a migrating image left the payload store
+    def legacy_blob(msg, h):
+        nonlocal legacy
+        if msg.get("legacy_index") is None: return None
+        if legacy is None:
+            snap = coll_ref.document(thread_id).get(); count_reads()
+            legacy = ((snap.to_dict() or {}).get("messages") or []) if snap.exists else []
+        src = legacy[msg["legacy_index"]] if msg["legacy_index"] < len(legacy) else {}
+        for b in src.get("db_images") or []:
+            if b and hashlib.sha256(data := base64.b64decode(b)).hexdigest() == h: return data
+        return None
+
+    for msg in pending:
         content_str = str(msg.get("content", ""))
         role = msg.get("role")
         if role == "user":
-            q = content_str.lower()
-            if any(k in q for k in["math", "algebra", "geometry", "calculate", "equation", "number", "fraction"]): detected_subjects.add("Math")
-            if any(k in q for k in["science", "cell", "biology", "physics", "chemistry", "experiment", "gravity"]): detected_subjects.add("Science")
-            if any(k in q for k in["english", "poem", "story", "essay", "writing", "grammar", "noun", "verb"]): detected_subjects.add("English")
-            qn = normalize_stage_text(content_str)
-            if re.search(r"\b(stage\W*7|grade\W*6|class\W*6|year\W*6)\b", qn): detected_grades.add("Grade 6")
-            if re.search(r"\b(stage\W*8|grade\W*7|class\W*7|year\W*7)\b", qn): detected_grades.add("Grade 7")
-            if re.search(r"\b(stage\W*9|grade\W*8|class\W*8|year\W*8)\b", qn): detected_grades.add("Grade 8")
-
-        db_images =[]
-        if msg.get("images"):
-            db_images =[compress_image_for_db(img) for img in msg["images"] if img]
-        elif msg.get("db_images"): db_images = msg["db_images"]
-
-        safe_messages.append({
-            "role": str(role), "content": content_str, "is_greeting": bool(msg.get("is_greeting", False)),
-            "is_downloadable": bool(msg.get("is_downloadable", False)), "db_images":[i for i in db_images if i],
-            "image_models": msg.get("image_models",[])
+            subs, grs = detect_thread_metadata(content_str)
+            detected_subjects |= subs; detected_grades |= grs
+
+        if msg.get("image_keys"): refs, blobs = msg["image_keys"], [stored_image(k) if k else None for k in msg["image_keys"]]
+        else: refs = msg.get("image_refs") or []; blobs =[(payload_get(h) or legacy_blob(msg, h)) if h else None for h in refs]
+        image_refs =[]
+        for ref, blob in zip(refs, blobs):
+            if ref and not blob and msg.get("legacy_index") is not None: unresolved = True # keep the ref and the inline copy
+            h = hashlib.sha256(blob).hexdigest() if blob else (None if msg.get("image_keys") else ref)
+            if h and h not in saved_blobs and h not in new_blobs: write(blobs_ref.document(h), {"data": blob, "created_at": time.time()}); new_blobs.add(h)
+            image_refs.append(h)
+
+        msg["seq"] = cur["next_seq"]; cur["next_seq"] += 1
+        msg["image_refs"] = image_refs
+        write(coll_ref.document(thread_id).collection("messages").document(f"{msg['seq']:06d}"), {
+            "seq": msg["seq"], "role": str(role), "content": content_str, "is_greeting": bool(msg.get("is_greeting", False)),
+            "is_downloadable": bool(msg.get("is_downloadable", False)), "image_refs": image_refs,
+            "image_models": msg.get("image_models",[]), "created_at": time.time()
         })
 
-    try: coll_ref.document(st.session_state.current_thread_id).set({"messages": safe_messages, "updated_at": time.time(), "metadata": {"subjects": list(detected_subjects), "grades": list(detected_grades)}}, merge=True)
-    except Exception as e: st.toast(f"⚠️ DB Error: {e}")
+    thread_doc = {"updated_at": time.time(), "message_count": cur["next_seq"]}
+    # The inline legacy copy goes only once every migrated image is in image_blobs; otherwise the thread re-migrates
+    # (same seq docs) on its next load.
+    if not unresolved: thread_doc["messages"] = firestore.DELETE_FIELD
+    if title: thread_doc["title"] = title
+    # ArrayUnion rejects empty lists, so only touch the metadata keys that gained values
+    if metadata := {k: firestore.ArrayUnion(sorted(v)) for k, v in (("subjects", detected_subjects), ("grades", detected_grades)) if v}: thread_doc["metadata"] = metadata
+    write(coll_ref.document(thread_id), thread_doc, merge=True)
+    try:
+        for batch, _ in batches: batch.commit()
+        saved_blobs |= new_blobs
+        touch_cached_thread(thread_id, updated_at=thread_doc["updated_at"], message_count=cur["next_seq"], **({"title": title} if title else {}))
+    except Exception as e:
+        for msg in pending: msg.pop("seq", None) # retried on the next save
+        cur["next_seq"] -= len(pending)
+        st.toast(f"⚠️ DB Error: {e}")
+
+def delete_thread(thread_id):
+    coll_ref = get_threads_collection()
+    if coll_ref:
+        thread_ref = coll_ref.document(thread_id)
+        refs = {h for m in thread_ref.collection("messages").select(["image_refs"]).stream() for h in (m.to_dict().get("image_refs") or []) if h}
+        db.recursive_delete(thread_ref)
+        if refs:
+            st.session_state.get("saved_blobs", set()).difference_update(refs) # a later save must write them again
+            threading.Thread(target=sweep_image_blobs, args=(auth_object.email, refs), daemon=True).start()
+    invalidate_reads("threads")
+
+def sweep_image_blobs(email, candidates):
+    # Runs on its own thread, off the request path. image_blobs are shared by every thread and paper job of a user,
+    # so a blob from a deleted thread goes only once nothing left references it. A save racing the sweep can still
+    # lose an image; message_images shows such a ref as missing rather than failing.
+    try:
+        user_ref, live = db.collection("users").document(email), set()
+        for j in db.collection("paper_jobs").where(filter=firestore.FieldFilter("teacher", "==", email)).select(["image_refs"]).stream(): live.update(j.to_dict().get("image_refs") or [])
+        for thread in user_ref.collection("threads").list_documents():
+            left = sorted(candidates - live)
+            for i in range(0, len(left), 30): # array_contains_any takes at most 30 values
+                for m in thread.collection("messages").where(filter=firestore.FieldFilter("image_refs", "array_contains_any", left[i:i + 30])).select(["image_refs"]).stream(): live.update(m.to_dict().get("image_refs") or [])
+        if dead := candidates - live:
+            bw = db.bulk_writer()
+            for h in dead: bw.delete(user_ref.collection("image_blobs").document(h))
+            bw.close()
+    except Exception as e: print(f"Image Blob Sweep Error: {e}")
 
 # -----------------------------
 # GEMINI INIT & FILE HELPERS
@@ -308,32 +641,179 @@ if not api_key: st.error("🚨 GOOGLE_API_KEY not found."); st.stop()
 try: client = genai.Client(api_key=api_key)
 except Exception as e: st.error(f"🚨 GenAI Error: {e}"); st.stop()
 
+# -----------------------------
+# MODEL CALL SCHEDULER
+# -----------------------------
+# Every client.models.* call goes through one process-wide ModelScheduler (model_scheduler.py): per-model
+# concurrency limits (MODEL_CONCURRENCY in secrets overrides these), a queue that is fair across sessions, 429
+# backoff, and coalescing of identical in-flight visuals and papers. Visual jobs share one pool instead of a pool per turn.
+MODEL_CONCURRENCY = {"gemini-3.1-flash-lite-preview": 24, "gemini-2.5-flash-lite": 8, "gemini-2.5-pro": 4, "gemini-3-pro-image-preview": 4,
+                     "gemini-3.1-flash-image-preview": 6, "imagen-4.0-fast-generate-001": 6, "gemini-2.5-flash-image": 6, **dict(st.secrets.get("MODEL_CONCURRENCY", {}))}
+VISUAL_WORKERS = 32
+
+@st.cache_resource
+def get_model_scheduler():
+    return ModelScheduler(MODEL_CONCURRENCY)
+
+@st.cache_resource
+def get_visual_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=VISUAL_WORKERS, thread_name_prefix="visual")
+
+model_scheduler, visual_pool = get_model_scheduler(), get_visual_pool()
+session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex) # fairness key for this browser session
+
+# -----------------------------
+# TRACING
+# -----------------------------
+# Chat turns, titles, visuals, paper jobs and textbook syncs are timed as nested spans (tracing.py). The last few
+# hundred traces stay in memory for the AI Debug Lab; set TRACE_JSONL in secrets to also append them to a file.
+TRACE_JSONL = st.secrets.get("TRACE_JSONL")
+
+@st.cache_resource
+def get_tracer():
+    return Tracer(export_path=TRACE_JSONL)
+
+tracer = get_tracer()
+
 # -----------------------------
 # GLOBAL VISUAL GENERATOR
 # -----------------------------
-def process_visual_wrapper(vp):
+IMAGE_MODELS =[
+    'gemini-3-pro-image-preview',
+    'gemini-3.1-flash-image-preview',
+    'imagen-4.0-fast-generate-001',
+    'gemini-2.5-flash-image'
+]
+
+# -----------------------------
+# IMAGE MODEL HEALTH
+# -----------------------------
+# Per-process circuit breaker per image model: after IMAGE_BREAKER_FAILURES consecutive failures (errors or
+# attempts over IMAGE_ATTEMPT_TIMEOUT) the model is skipped for IMAGE_BREAKER_COOLDOWN, then one probe is let through.
+# With IMAGE_HEDGE_AFTER > 0, the next model is launched if the current one hasn't answered by then; first success wins.
+# The attempt timeout runs from the moment the scheduler grants a slot, so local queueing under load never counts
+# against a model's breaker; abandoned attempts still waiting for a slot are withdrawn from the queue.
+IMAGE_ATTEMPT_TIMEOUT = float(st.secrets.get("IMAGE_ATTEMPT_TIMEOUT", 45))
+IMAGE_HEDGE_AFTER = float(st.secrets.get("IMAGE_HEDGE_AFTER", 0))
+IMAGE_BREAKER_FAILURES = 3
+IMAGE_BREAKER_COOLDOWN = 120
+
+@st.cache_resource
+def get_image_model_health():
+    return {"lock": threading.Lock(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="image-attempt"),
+            "models": {m: {"consecutive": 0, "open_until": 0.0, "probing": False, "ok": 0, "failed": 0, "latency": None} for m in IMAGE_MODELS}}
+
+image_health = get_image_model_health()
+
+def image_model_available(m) -> bool:
+    with image_health["lock"]:
+        h = image_health["models"][m]
+        if h["consecutive"] < IMAGE_BREAKER_FAILURES: return True
+        if time.time() < h["open_until"] or h["probing"]: return False
+        h["probing"] = True # half-open: let exactly one request through
+        return True
+
+def release_image_probe(m):
+    # An attempt that never reached the model (cancelled before it ran) hands its half-open probe back
+    with image_health["lock"]: image_health["models"][m]["probing"] = False
+
+def record_image_attempt(m, ok: bool, latency: float):
+    with image_health["lock"]:
+        h = image_health["models"][m]
+        h["probing"] = False
+        if ok:
+            h.update(consecutive=0, ok=h["ok"] + 1, latency=latency if h["latency"] is None else 0.8 * h["latency"] + 0.2 * latency)
+        else:
+            h.update(consecutive=h["consecutive"] + 1, failed=h["failed"] + 1)
+            if h["consecutive"] >= IMAGE_BREAKER_FAILURES: h["open_until"] = time.time() + IMAGE_BREAKER_COOLDOWN
+
+@dataclass
+class ImageAttempt:
+    model: str
+    started: float = None # time.time() when the scheduler granted the slot; None while queued
+    cancel: threading.Event = field(default_factory=threading.Event)
+
+def call_image_model(model_name, v_data, session=None, attempt=None):
+    with tracer.span("image_model", model=model_name) as sp:
+        def on_start():
+            sp.slot_acquired()
+            # The first grant starts the deadline; a 429 retry re-queues but must not restart it
+            if attempt and attempt.started is None: attempt.started = time.time()
+        return model_scheduler.call(model_name, request_image, model_name, v_data, session=session, on_start=on_start, cancel=attempt.cancel if attempt else None)
+
+def request_image(model_name, v_data):
+    # A real per-request deadline: an abandoned attempt frees its image-attempt worker instead of running on
+    http = types.HttpOptions(timeout=int(IMAGE_ATTEMPT_TIMEOUT * 1000))
+    if "imagen" in model_name.lower():
+        result = client.models.generate_images(model=model_name, prompt=v_data, config=types.GenerateImagesConfig(number_of_images=1, aspect_ratio="4:3", http_options=http))
+        if result.generated_images: return result.generated_images[0].image.image_bytes
+    else:
+        result = client.models.generate_content(model=model_name, contents=[f"{v_data}\n\n(Important: Generate a 1k resolution image with a 4:3 aspect ratio.)"], config=types.GenerateContentConfig(response_modalities=["IMAGE"], http_options=http))
+        if result.candidates and result.candidates[0].content.parts:
+            for part in result.candidates[0].content.parts:
+                if getattr(part, "inline_data", None) and part.inline_data.data: return part.inline_data.data
+    raise ValueError("No image returned")
+
+def generate_image_with_fallback(v_data, error_logs, session=None):
+    queue = [m for m in IMAGE_MODELS if image_model_available(m)]
+    if not queue: # every breaker is open: try the one that recovers first rather than failing outright
+        queue = [min(IMAGE_MODELS, key=lambda m: image_health["models"][m]["open_until"])]
+    pending = {} # future -> ImageAttempt
+
+    def launch():
+        a = ImageAttempt(queue.pop(0))
+        pending[image_health["pool"].submit(call_image_model, a.model, v_data, session, a)] = a
+
+    try:
+        launch(); hedge_at = time.time() + IMAGE_HEDGE_AFTER
+        return hedged_image_attempts(pending, queue, launch, hedge_at, error_logs)
+    finally:
+        with image_health["lock"]: # half-open probes granted to models we never launched go back to the pool
+            for m in queue: image_health["models"][m]["probing"] = False
+
+def settle_image_attempt(f, a):
+    # done-callback for abandoned attempts: a call that got a slot still reports to the breaker when it finishes;
+    # one withdrawn from the scheduler queue never ran, so it says nothing about the model
+    exc = f.exception()
+    if isinstance(exc, concurrent.futures.CancelledError): release_image_probe(a.model)
+    else: record_image_attempt(a.model, exc is None, time.time() - (a.started or time.time()))
+
+def abandon_image_attempt(f, a):
+    model_scheduler.abandon(a.cancel)
+    if f.cancel(): release_image_probe(a.model)
+    else: f.add_done_callback(lambda f, a=a: settle_image_attempt(f, a))
+
+def hedged_image_attempts(pending, queue, launch, hedge_at, error_logs):
+    while pending:
+        now = time.time()
+        # Attempts still queued for a slot have no deadline yet; re-check them every second
+        wake = min([a.started + IMAGE_ATTEMPT_TIMEOUT for a in pending.values() if a.started] + [now + 1.0])
+        if IMAGE_HEDGE_AFTER > 0 and queue: wake = min(wake, hedge_at)
+        done, _ = concurrent.futures.wait(pending, timeout=max(0.0, wake - now), return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in done:
+            a = pending.pop(f)
+            try:
+                data = f.result()
+                record_image_attempt(a.model, True, time.time() - a.started)
+                for other, oa in pending.items(): abandon_image_attempt(other, oa) # hedged losers
+                return data, a.model
+            except Exception as e:
+                record_image_attempt(a.model, False, time.time() - (a.started or time.time())); error_logs.append(f"**{a.model} Error:** {str(e)}")
+        for f, a in list(pending.items()):
+            if a.started and time.time() >= a.started + IMAGE_ATTEMPT_TIMEOUT:
+                pending.pop(f); model_scheduler.abandon(a.cancel)
+                record_image_attempt(a.model, False, IMAGE_ATTEMPT_TIMEOUT); error_logs.append(f"**{a.model} Error:** timed out after {IMAGE_ATTEMPT_TIMEOUT:.0f}s")
+        if queue and (not pending or (IMAGE_HEDGE_AFTER > 0 and time.time() >= hedge_at)):
+            launch(); hedge_at = time.time() + IMAGE_HEDGE_AFTER
+    return None, None
+
+def generate_visual(vp, session=None):
     error_logs =[]
     try:
         v_type, v_data = vp
         if v_type == "IMAGE_GEN":
-            models_to_try =[
-                'gemini-3-pro-image-preview',
-                'gemini-3.1-flash-image-preview',
-                'imagen-4.0-fast-generate-001',
-                'gemini-2.5-flash-image'
-            ]
-            for model_name in models_to_try:
-                try:
-                    if "imagen" in model_name.lower():
-                        result = client.models.generate_images(model=model_name, prompt=v_data, config=types.GenerateImagesConfig(number_of_images=1, aspect_ratio="4:3"))
-                        if result.generated_images: return (result.generated_images[0].image.image_bytes, model_name, error_logs)
-                    else:
-                        result = client.models.generate_content(model=model_name, contents=[f"{v_data}\n\n(Important: Generate a 1k resolution image with a 4:3 aspect ratio.)"], config=types.GenerateContentConfig(response_modalities=["IMAGE"]))
-                        if result.candidates and result.candidates[0].content.parts:
-                            for part in result.candidates[0].content.parts:
-                                if getattr(part, "inline_data", None) and part.inline_data.data:
-                                    return (part.inline_data.data, model_name, error_logs)
-                except Exception as e: error_logs.append(f"**{model_name} Error:** {str(e)}")
+            data, model_name = generate_image_with_fallback(v_data, error_logs, session)
+            if data: return (data, model_name, error_logs)
             return (None, "All Models Failed", error_logs)
 
         elif v_type == "PIE_CHART":
@@ -353,73 +833,304 @@ def process_visual_wrapper(vp):
     except Exception as e: return (None, "Crash",[str(e)])
 
 # -----------------------------
-# PDF HELPER
+# VISUAL CACHE
 # -----------------------------
-def md_inline_to_rl(text: str) -> str:
-    s = (text or "").replace(r'\(', '').replace(r'\)', '').replace(r'\[', '').replace(r'\]', '').replace(r'\times', ' x ').replace(r'\div', ' ÷ ').replace(r'\circ', '°').replace(r'\pm', '±').replace(r'\leq', '≤').replace(r'\geq', '≥').replace(r'\neq', '≠').replace(r'\approx', '≈').replace(r'\pi', 'π').replace(r'\sqrt', '√').replace('\\', '')
-    s = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'\1/\2', s)
-    s = s.replace('$', '') # Strictly ban any remaining stray dollar signs
-    return re.sub(r"(?<!\*)\*(\S.+?)\*(?!\*)", r"<i>\1</i>", re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")))
+# Two tiers keyed by (directive type, normalized prompt, model chain): an in-process LRU shared by all sessions
+# and a size-capped disk store that survives restarts. Only successful renders are cached.
+VISUAL_CACHE_DIR = Path(".visual_cache")
+VISUAL_CACHE_MEM_ITEMS = 64
+VISUAL_CACHE_DISK_BYTES = 512 * 1024 * 1024
 
-def create_pdf(content: str, images=None, filename="Question_Paper.pdf"):
-    buffer = BytesIO(); doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=0.75*inch, leftMargin=0.75*inch, topMargin=0.75*inch, bottomMargin=0.75*inch)
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle("CustomTitle", parent=styles["Heading1"], fontSize=18, textColor=colors.HexColor("#00d4ff"), spaceAfter=12, alignment=TA_CENTER, fontName="Helvetica-Bold")
-    body_style = ParagraphStyle("CustomBody", parent=styles["BodyText"], fontSize=11, spaceAfter=8, alignment=TA_LEFT, fontName="Helvetica")
-    story, img_idx, table_rows = [], 0,[]
+@st.cache_resource
+def get_visual_cache():
+    return {"lock": threading.Lock(), "mem": OrderedDict(), "stats": {"mem_hits": 0, "disk_hits": 0, "misses": 0, "deduped": 0}}
+
+visual_cache = get_visual_cache() # bound at module level so worker threads never touch the Streamlit cache API
+
+def visual_cache_key(vp) -> str:
+    v_type, v_data = vp
+    model = "matplotlib" if v_type == "PIE_CHART" else "|".join(IMAGE_MODELS)
+    return hashlib.sha256(f"{v_type}\n{model}\n{' '.join(str(v_data).split()).casefold()}".encode()).hexdigest()
+
+def visual_cache_count(stat, n=1):
+    with visual_cache["lock"]: visual_cache["stats"][stat] += n
+
+def visual_cache_get(key):
+    vc = visual_cache
+    with vc["lock"]:
+        if key in vc["mem"]:
+            vc["mem"].move_to_end(key); vc["stats"]["mem_hits"] += 1
+            return vc["mem"][key]
+    path = VISUAL_CACHE_DIR / key
+    try:
+        model, data = path.read_bytes().split(b"\n", 1)
+        os.utime(path) # mtime doubles as the disk tier's LRU clock
+    except Exception: return None
+    visual_cache_put(key, data, model.decode(), disk=False)
+    visual_cache_count("disk_hits")
+    return data, model.decode()
+
+def visual_cache_put(key, data, model, disk=True):
+    vc = visual_cache
+    with vc["lock"]:
+        vc["mem"][key] = (data, model); vc["mem"].move_to_end(key)
+        while len(vc["mem"]) > VISUAL_CACHE_MEM_ITEMS: vc["mem"].popitem(last=False)
+    if not disk: return
+    try:
+        VISUAL_CACHE_DIR.mkdir(exist_ok=True)
+        tmp = VISUAL_CACHE_DIR / f".{key}.{uuid.uuid4().hex}"
+        tmp.write_bytes(model.encode() + b"\n" + data); tmp.replace(VISUAL_CACHE_DIR / key)
+        files = sorted((f.stat().st_mtime, f.stat().st_size, f) for f in VISUAL_CACHE_DIR.iterdir() if not f.name.startswith("."))
+        total = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if total <= VISUAL_CACHE_DISK_BYTES: break
+            f.unlink(missing_ok=True); total -= size
+    except Exception as e: print(f"Visual Cache Error: {e}")
+
+def visual_cache_disk_usage():
+    try: return sum(f.stat().st_size for f in VISUAL_CACHE_DIR.iterdir())
+    except Exception: return 0
+
+def process_visual_wrapper(vp, session=None):
+    key = visual_cache_key(vp)
+    if hit := visual_cache_get(key): return (hit[0], hit[1], [])
+    # The same directive requested by several sessions at once is rendered once and fanned out
+    return model_scheduler.coalesce(("visual", key), render_visual, vp, key, session)
+
+def render_visual(vp, key, session=None):
+    visual_cache_count("misses")
+    with tracer.trace("visual", kind=vp[0]): res = generate_visual(vp, session)
+    if res and res[0]: visual_cache_put(key, res[0], res[1])
+    return res
+
+def submit_visual(jobs: dict, vp, session=None):
+    # Identical directives within one response share a single job.
+    key = visual_cache_key(vp)
+    if key not in jobs:
+        jobs[key] = visual_pool.submit(process_visual_wrapper, vp, session)
+        if is_authenticated and db: jobs[key].add_done_callback(ingest_visual)
+    return jobs[key]
+
+def run_visual_jobs(v_prompts, jobs=None, session=None):
+    # `jobs` may already hold futures started while the response was streaming; they are reused, not resubmitted.
+    jobs = {} if jobs is None else jobs
+    futs =[submit_visual(jobs, vp, session) for vp in v_prompts]
+    visual_cache_count("deduped", len(futs) - len(set(map(id, futs))))
+    return [f.result() for f in futs]
 
-    def render_pending_table():
-        nonlocal table_rows
-        if not table_rows: return
-        ncols = max(len(r) for r in table_rows)
-        norm_rows = [[Paragraph(md_inline_to_rl(c), body_style) for c in list(r) + [""] * (ncols - len(r))] for r in table_rows]
-        t = Table(norm_rows, colWidths=[doc.width / max(1, ncols)] * ncols)
-        t.setStyle(TableStyle([("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#00d4ff")), ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke), ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"), ("VALIGN", (0, 0), (-1, -1), "TOP"), ("ALIGN", (0, 0), (-1, -1), "LEFT"), ("BOTTOMPADDING", (0, 0), (-1, 0), 8), ("BACKGROUND", (0, 1), (-1, -1), colors.HexColor("#f8f9fa")), ("GRID", (0, 0), (-1, -1), 0.5, colors.grey)]))
-        story.extend([t, Spacer(1, 0.18*inch)]); table_rows = []
+# -----------------------------
+# LAZY PDF DOWNLOADS
+# -----------------------------
+# PDFs are only built once the user asks for one, on a process-wide render pool (pdf_render.py), and memoized
+# across sessions by a digest of (content, images), so reruns and shared papers never rebuild the same document.
+# While a build runs, only a small fragment polls it; the script thread never waits on ReportLab.
+PDF_RENDER_WORKERS = 2
+PDF_MEMO_ITEMS = 32
+def pdf_digest(content, images) -> str:
+    h = hashlib.sha256((content or "").encode())
+    for img in images or []: h.update(hashlib.sha256(img).digest() if img else b"-")
+    return h.hexdigest()
 
-    lines =[re.sub(r"\s*\(Source:.*?\)", "", l).strip() for l in str(content or "⚠️ No content").split("\n") if "[PDF_READY]" not in l.upper() and not l.strip().startswith(("Source(s):", "**Source(s):**"))]
-    
-    for s in lines:
-        if s.startswith("|") and s.endswith("|") and s.count("|") >= 2:
-            cells =[c.strip() for c in s.split("|")[1:-1]]
-            if not all(re.fullmatch(r":?-+:?", c) for c in cells if c): table_rows.append(cells)
-            continue
-        render_pending_table()
-        if not s: story.append(Spacer(1, 0.14*inch)); continue
-        if s.startswith(("IMAGE_GEN:", "PIE_CHART:")):
-            if images and img_idx < len(images) and images[img_idx]:
-                try:
-                    img_stream = BytesIO(images[img_idx]); rl_reader = ImageReader(img_stream)
-                    iw, ih = rl_reader.getSize()
-                    story.extend([Spacer(1, 0.12*inch), RLImage(img_stream, width=4.6*inch, height=4.6*inch*(ih/float(iw))), Spacer(1, 0.12*inch)])
-                except Exception: pass
-            img_idx += 1; continue
-        if s.startswith("# "): story.append(Paragraph(md_inline_to_rl(s[2:].strip()), title_style))
-        elif s.startswith("## "): story.append(Paragraph(md_inline_to_rl(s[3:].strip()), ParagraphStyle("CustomHeading", parent=styles["Heading2"], fontSize=14, spaceAfter=10, spaceBefore=10, fontName="Helvetica-Bold")))
-        elif s.startswith("### "): story.append(Paragraph(f"<b>{md_inline_to_rl(s[4:].strip())}</b>", body_style))
-        else: story.append(Paragraph(md_inline_to_rl(s), body_style))
-    render_pending_table(); story.extend([Spacer(1, 0.28*inch), Paragraph("<i>Generated by helix.ai - Your CIE Tutor</i>", body_style)])
-    doc.build(story); buffer.seek(0)
-    return buffer
+@st.cache_resource
+def get_pdf_renders():
+    return {"lock": threading.Lock(), "jobs": OrderedDict(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=PDF_RENDER_WORKERS, thread_name_prefix="pdf-render")}
+
+pdf_renders = get_pdf_renders()
+
+def start_pdf_build(digest, content, images):
+    pr = pdf_renders
+    with pr["lock"]:
+        fut = pr["jobs"].get(digest)
+        if fut is None or (fut.done() and fut.exception()): fut = pr["jobs"][digest] = pr["pool"].submit(lambda: create_pdf(content, images).getvalue())
+        pr["jobs"].move_to_end(digest)
+        while len(pr["jobs"]) > PDF_MEMO_ITEMS: pr["jobs"].popitem(last=False)
+    return fut
+
+def wait_for_pdf(fut):
+    if fut.done(): st.rerun()
+    st.caption("⏳ Building PDF...")
+
+def lazy_pdf_download(label, content, images, file_name, key, digest=None):
+    digest = digest or pdf_digest(content, images)
+    requested = st.session_state.setdefault("pdf_requested", set())
+    if digest in requested:
+        fut = start_pdf_build(digest, content, images)
+        if not fut.done(): st.fragment(wait_for_pdf, run_every=0.5)(fut); return
+        st.download_button(label, data=fut.result(), file_name=file_name, mime="application/pdf", key=f"{key}_dl")
+    elif st.button(label, key=f"{key}_prep"):
+        requested.add(digest); start_pdf_build(digest, content, images); st.rerun()
 
 def safe_response_text(resp) -> str:
     try: return str(resp.text) if getattr(resp, "text", None) else "\n".join([p.text for c in (getattr(resp, "candidates", []) or[]) for p in (getattr(c.content, "parts", []) or[]) if getattr(p, "text", None)])
     except Exception: return ""
 
+# -----------------------------
+# STREAMING HELPERS
+# -----------------------------
+STREAM_CHAT = str(st.secrets.get("STREAM_CHAT", "true")).lower() != "false"
+
 def generate_chat_title(client, messages):
     try:
         user_msgs =[m.get("content", "") for m in messages if m.get("role") == "user"]
         if not user_msgs: return "New Chat"
-        response = client.models.generate_content(model="gemini-2.5-flash-lite", contents=["Summarize this into a short chat title (max 4 words). Context: " + "\n".join(user_msgs[-3:])], config=types.GenerateContentConfig(temperature=0.3, max_output_tokens=50))
+        prompt = "Summarize this into a short chat title (max 4 words). Context: " + "\n".join(user_msgs[-3:])
+        with tracer.span("model_call", model="gemini-2.5-flash-lite") as sp: response = model_scheduler.call("gemini-2.5-flash-lite", lambda: client.models.generate_content(model="gemini-2.5-flash-lite", contents=[prompt], config=types.GenerateContentConfig(temperature=0.3, max_output_tokens=50)), session="background:titles", on_start=sp.slot_acquired)
         return safe_response_text(response).strip().replace('"', '').replace("'", "") or "New Chat"
     except Exception: return "New Chat"
 
+# -----------------------------
+# BACKGROUND CHAT TITLES
+# -----------------------------
+# A new thread is saved with a local heuristic title straight away; the model-written title is produced on a
+# process-wide pool and written to the thread doc, and the sidebar picks it up on the session's next rerun.
+TITLE_WORKERS = 4
+
+@st.cache_resource
+def get_title_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=TITLE_WORKERS, thread_name_prefix="chat-title")
+
+title_pool = get_title_pool()
+
+def heuristic_chat_title(messages) -> str:
+    text = next((m.get("content") for m in messages if m.get("role") == "user" and (m.get("content") or "").strip()), "")
+    title = " ".join(re.sub(r"[^\w\s'?-]", " ", text).split()[:5])[:40].strip()
+    return title[:1].upper() + title[1:] if title else "New Chat"
+
+def refine_chat_title(thread_ref, messages):
+    # Runs on title_pool, so it must not touch any Streamlit API. A rename made meanwhile always wins.
+    with tracer.trace("chat_title"): title = generate_chat_title(client, messages)
+    if title == "New Chat": return None
+
+    @firestore.transactional
+    def apply(transaction):
+        snap = thread_ref.get(transaction=transaction)
+        if snap.exists and (snap.to_dict() or {}).get("user_edited_title"): return None
+        transaction.set(thread_ref, {"title": title}, merge=True)
+        return title
+    return apply(db.transaction())
+
+def start_title_job(thread_id, messages):
+    coll_ref = get_threads_collection()
+    if not coll_ref: return
+    user_msgs = [{"role": "user", "content": m.get("content", "")} for m in messages if m.get("role") == "user"]
+    st.session_state.setdefault("title_jobs", {})[thread_id] = title_pool.submit(refine_chat_title, coll_ref.document(thread_id), user_msgs)
+
+def collect_title_jobs():
+    jobs = st.session_state.get("title_jobs") or {}
+    for thread_id, fut in list(jobs.items()):
+        if not fut.done(): continue
+        del jobs[thread_id]
+        try: title = fut.result()
+        except Exception as e: print(f"Chat Title Error: {e}"); continue
+        if title: touch_cached_thread(thread_id, title=title)
+
+# -----------------------------
+# CONVERSATION HISTORY BUDGET
+# -----------------------------
+# Each turn sends at most HISTORY_TOKEN_BUDGET tokens of prior messages (chars / 4, cached on the message). Saved
+# turns that fall outside the window are folded into a rolling summary on summary_pool and stored on the thread doc
+# (summary, summary_upto = first seq not covered); a refresh keeps only HISTORY_KEEP_TOKENS verbatim so it is not
+# needed again for several turns. Guest threads are never saved, so they only get the window.
+HISTORY_TOKEN_BUDGET = int(st.secrets.get("HISTORY_TOKEN_BUDGET", 8000))
+HISTORY_KEEP_TOKENS = HISTORY_TOKEN_BUDGET // 2
+SUMMARY_MODEL = "gemini-2.5-flash-lite"
+SUMMARY_MSG_CHARS = 2000 # per message fed to the summarizer; generated papers only need their gist
+SUMMARY_WORKERS = 4
+
+@st.cache_resource
+def get_summary_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="history-summary")
+
+summary_pool = get_summary_pool()
+
+def estimate_tokens(text) -> int:
+    return len(text or "") // 4 + 4
+
+def message_tokens(m) -> int:
+    if "tokens" not in m: m["tokens"] = estimate_tokens(m.get("content"))
+    return m["tokens"]
+
+def history_summary():
+    s = st.session_state.get("history_summary") or {}
+    return s if s.get("thread") == st.session_state.current_thread_id else {"thread": st.session_state.current_thread_id, "text": "", "upto": 0}
+
+def budgeted_history(messages):
+    # -> (alternating Contents for the newest turns within the budget, summary of everything before them)
+    s, contents, used, exp_role, truncated = history_summary(), [], 0, "model", False
+    visible = [m for m in messages if not m.get("is_greeting") and (m.get("seq") is None or m["seq"] >= s["upto"])]
+    for m in reversed(visible):
+        r = "user" if m.get("role") == "user" else "model"
+        txt = m.get("content") or ""
+        if not (txt.strip() and r == exp_role): continue
+        if used + message_tokens(m) > HISTORY_TOKEN_BUDGET:
+            truncated = True
+            if contents: break
+            txt = txt[:HISTORY_TOKEN_BUDGET * 4] # a single oversized message (a full paper) still goes in, cut down
+        contents.insert(0, types.Content(role=r, parts=[types.Part.from_text(text=txt)]))
+        used += min(message_tokens(m), HISTORY_TOKEN_BUDGET); exp_role = "user" if exp_role == "model" else "model"
+        if truncated: break
+    if contents and contents[0].role == "model": contents.pop(0)
+    # Also behind: the loaded page starts after a saved message the summary does not cover yet. The greeting is
+    # seq 0, so a thread loaded from its start (or never paged) never counts as behind.
+    oldest = min((m["seq"] for m in messages if m.get("seq") is not None), default=0)
+    if truncated or oldest > s["upto"]: start_summary_job(messages, s)
+    return contents, s["text"], used
+
+def summarize_history(thread_ref, summary, upto, cutoff, fold):
+    # Runs on summary_pool, so it must not touch any Streamlit API. Saved messages older than the page the session
+    # has loaded are read here. A summary that already reaches further (another tab) is kept.
+    with tracer.trace("history_summary", upto=upto, cutoff=cutoff):
+        first = fold[0]["seq"] if fold else cutoff
+        if first > upto:
+            fold = [d.to_dict() for d in thread_ref.collection("messages").where(filter=firestore.FieldFilter("seq", ">=", upto)).where(filter=firestore.FieldFilter("seq", "<", first)).order_by("seq").stream()] + fold
+        transcript = "\n\n".join(f"{'Student' if m.get('role') == 'user' else 'Helix'}: {str(m.get('content', ''))[:SUMMARY_MSG_CHARS]}" for m in fold if not m.get("is_greeting") and str(m.get("content") or "").strip())
+        if not transcript: return None
+        prompt = ("Summarize this tutoring conversation between a student and Helix for use as context in later turns. Keep the subject, grade, "
+                  "topics covered, questions or papers set (with their key numbers), the student's answers, mistakes and weak points, and anything "
+                  "the student asked to be remembered. Plain prose, at most 200 words.\n\n"
+                  + (f"Summary so far:\n{summary}\n\nConversation since:\n" if summary else "Conversation:\n") + transcript)
+        with tracer.span("model_call", model=SUMMARY_MODEL) as sp: response = model_scheduler.call(SUMMARY_MODEL, lambda: client.models.generate_content(model=SUMMARY_MODEL, contents=[prompt], config=types.GenerateContentConfig(temperature=0.2, max_output_tokens=400)), session="background:summaries", on_start=sp.slot_acquired)
+        if not (text := safe_response_text(response).strip()): return None
+
+    @firestore.transactional
+    def apply(transaction):
+        snap = thread_ref.get(transaction=transaction)
+        cur = (snap.to_dict() or {}) if snap.exists else {}
+        if cur.get("summary_upto", 0) >= cutoff: return {"text": cur.get("summary", ""), "upto": cur["summary_upto"]}
+        transaction.set(thread_ref, {"summary": text, "summary_upto": cutoff}, merge=True)
+        return {"text": text, "upto": cutoff}
+    return apply(db.transaction())
+
+def start_summary_job(messages, s):
+    coll_ref, thread_id = get_threads_collection(), st.session_state.current_thread_id
+    jobs = st.session_state.setdefault("summary_jobs", {})
+    if not coll_ref or thread_id in jobs: return
+    saved, kept = [m for m in messages if m.get("seq") is not None and not m.get("is_greeting")], 0
+    cutoff = saved[0]["seq"] if saved else None
+    for m in reversed(saved):
+        kept += message_tokens(m)
+        if kept > HISTORY_KEEP_TOKENS: cutoff = m["seq"] + 1; break
+    if len(saved) >= 2: cutoff = min(cutoff, saved[-2]["seq"]) # the last exchange always stays verbatim
+    if cutoff is None or cutoff <= s["upto"]: return
+    fold = [{"seq": m["seq"], "role": m.get("role"), "content": m.get("content", "")} for m in saved if s["upto"] <= m["seq"] < cutoff]
+    jobs[thread_id] = summary_pool.submit(summarize_history, coll_ref.document(thread_id), s["text"], s["upto"], cutoff, fold)
+
+def collect_summary_jobs():
+    jobs = st.session_state.get("summary_jobs") or {}
+    for thread_id, fut in list(jobs.items()):
+        if not fut.done(): continue
+        del jobs[thread_id]
+        try: s = fut.result()
+        except Exception as e: print(f"History Summary Error: {e}"); continue
+        if s: st.session_state.history_summary = {"thread": thread_id, **s}
+
 # -----------------------------
 # 3) SESSION STATE & DIALOGS
 # -----------------------------
 if "current_thread_id" not in st.session_state: st.session_state.current_thread_id = str(uuid.uuid4())
 if "messages" not in st.session_state: st.session_state.messages = get_default_greeting()
 if "delete_requested_for" not in st.session_state: st.session_state.delete_requested_for = None
+collect_title_jobs(); collect_summary_jobs()
 
 @st.dialog("⚠️ Maximum Chats")
 def confirm_new_chat_dialog(oldest_thread_id):
@@ -427,7 +1138,7 @@ def confirm_new_chat_dialog(oldest_thread_id):
     c1, c2 = st.columns(2)
     if c1.button("Cancel", use_container_width=True): st.rerun()
     if c2.button("Yes", type="primary", use_container_width=True):
-        try: get_threads_collection().document(oldest_thread_id).delete()
+        try: delete_thread(oldest_thread_id)
         except Exception: pass
         st.session_state.current_thread_id = str(uuid.uuid4()); st.session_state.messages = get_default_greeting(); st.rerun()
 
@@ -437,7 +1148,7 @@ def confirm_delete_chat_dialog(thread_id_to_delete):
     c1, c2 = st.columns(2)
     if c1.button("Cancel", use_container_width=True): st.session_state.delete_requested_for = None; st.rerun()
     if c2.button("Yes", type="primary", use_container_width=True):
-        try: get_threads_collection().document(thread_id_to_delete).delete()
+        try: delete_thread(thread_id_to_delete)
         except Exception: pass
         if st.session_state.current_thread_id == thread_id_to_delete: st.session_state.current_thread_id = str(uuid.uuid4()); st.session_state.messages = get_default_greeting()
         st.session_state.delete_requested_for = None; st.rerun()
@@ -448,7 +1159,8 @@ def chat_settings_dialog(thread_data):
     st.caption(f"🎓 **Grades:** {', '.join(thread_data.get('metadata', {}).get('grades',[])) or 'None'}")
     new_title = st.text_input("Rename Chat", value=thread_data.get("title", "New Chat"))
     if st.button("💾 Save", use_container_width=True):
-        get_threads_collection().document(thread_data["id"]).set({"title": new_title, "user_edited_title": True}, merge=True); st.rerun()
+        get_threads_collection().document(thread_data["id"]).set({"title": new_title, "user_edited_title": True}, merge=True)
+        touch_cached_thread(thread_data["id"], title=new_title, user_edited_title=True); st.rerun()
     if st.button("🗑️ Delete", type="primary", use_container_width=True):
         st.session_state.delete_requested_for = thread_data['id']; st.rerun()
 
@@ -473,6 +1185,207 @@ ADMIN_CSS = """
 </style>
 """
 
+def count_query(query) -> int:
+    # Server-side COUNT aggregation: billed as one read per 1000 matches and never ships documents to the app.
+    try:
+        count_reads()
+        return int(query.count(alias="n").get()[0][0].value)
+    except Exception as e:
+        print(f"Count Aggregation Error: {e}")
+        return sum(1 for _ in query.select([]).stream())
+
+def get_dashboard_counts(school):
+    users, classes = db.collection("users"), db.collection("classes")
+    if school != "All Schools":
+        users = users.where(filter=firestore.FieldFilter("school", "==", school))
+        classes = classes.where(filter=firestore.FieldFilter("school", "==", school))
+    return {"students": count_query(users.where(filter=firestore.FieldFilter("role", "==", "student"))),
+            "teachers": count_query(users.where(filter=firestore.FieldFilter("role", "==", "teacher"))),
+            "classes": count_query(classes)}
+
+def get_admin_school_list():
+    teachers = db.collection("users").where(filter=firestore.FieldFilter("role", "==", "teacher")).select(["school"]).stream()
+    return sorted(set(u.to_dict().get("school") for u in teachers if u.to_dict().get("school")).union(SCHOOL_CODES.values()))
+
+# -----------------------------
+# PAGINATED ROSTERS
+# -----------------------------
+# Listings page through Firestore with cursors (document-id order, or display_name order for name search), so no
+# page ever materializes a whole collection. "Load more" appends the next page to what the session already holds.
+ROSTER_PAGE_SIZES = [25, 50, 100]
+
+def roster_base_query(kind, school=None):
+    coll = db.collection("classes" if kind == "classes" else "users")
+    q = coll if kind == "classes" else coll.where(filter=firestore.FieldFilter("role", "==", kind))
+    if school and school != "All Schools": q = q.where(filter=firestore.FieldFilter("school", "==", school))
+    return coll, q
+
+def roster_page_query(coll, base, search_field, prefix):
+    if search_field == "Name":
+        q = base.order_by("display_name")
+        return q.start_at([prefix]).end_at([prefix + "\uf8ff"]) if prefix else q
+    q = base.order_by(FieldPath.document_id())
+    return q.start_at([coll.document(prefix)]).end_at([coll.document(prefix + "\uf8ff")]) if prefix else q
+
+def render_roster(key, coll_and_query, row_fn, empty_msg, search_fields=("Email", "Name"), scope=None):
+    coll, base = coll_and_query
+    c1, c2, c3 = st.columns([0.25, 0.5, 0.25])
+    field = c1.selectbox("Search by", search_fields, key=f"{key}_field")
+    prefix = c2.text_input("Starts with", key=f"{key}_prefix").strip()
+    if field == "Email": prefix = prefix.lower()
+    elif field == "Class ID": prefix = prefix.upper()
+    size = c3.selectbox("Page size", ROSTER_PAGE_SIZES, key=f"{key}_size")
+    rosters = st.session_state.setdefault("rosters", {})
+    state_key = (field, prefix, size, scope)
+    state = rosters.get(key)
+    if not state or state["key"] != state_key: state = rosters[key] = {"key": state_key, "rows": [], "cursor": None, "done": False}
+
+    def load_page():
+        q = roster_page_query(coll, base, field, prefix)
+        if state["cursor"] is not None: q = q.start_after(state["cursor"])
+        docs = list(q.limit(size).stream()); count_reads(max(1, len(docs)))
+        state["rows"] += [row_fn({"id": d.id, **d.to_dict()}) for d in docs]
+        state["cursor"] = docs[-1] if docs else state["cursor"]
+        state["done"] = len(docs) < size
+
+    if not state["rows"] and not state["done"]: load_page()
+    if state["rows"]: st.dataframe(state["rows"], use_container_width=True, hide_index=True)
+    else: st.info(empty_msg)
+    if not state["done"] and st.button(f"⬇️ Load {size} more", key=f"{key}_more"): load_page(); st.rerun()
+    st.caption(f"Showing {len(state['rows'])}{'' if state['done'] else '+'} result(s)")
+
+# -----------------------------
+# BULK DELETION JOBS
+# -----------------------------
+# Deletions are planned into an ordered list of idempotent steps persisted in admin_jobs/{id}. A worker advances
+# next_step after each one, so a job interrupted by a restart is resumed from its first unfinished step. The job
+# heartbeats from a side thread for its whole run, so one long step is not mistaken for a dead worker and resumed twice.
+DELETE_JOB_WORKERS = 4
+DELETE_JOB_STALE_AFTER = 90
+DELETE_JOB_HEARTBEAT = 30
+
+@st.cache_resource
+def get_admin_job_runner():
+    return {"lock": threading.Lock(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="admin-job"), "running": set()}
+
+admin_jobs = get_admin_job_runner()
+
+def keep_alive(job_ref, every):
+    # Heartbeats job_ref from a side thread until the returned event is set (the job's finally).
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(every):
+            try: job_ref.update({"heartbeat": time.time()})
+            except Exception as e: print(f"Job Heartbeat Error {job_ref.id}: {e}")
+    threading.Thread(target=beat, daemon=True, name=f"heartbeat-{job_ref.id}").start()
+    return stop
+
+def plan_deletion(kind, target, cascade=True):
+    if kind == "student":
+        return [{"op": "unlink_classes", "email": target}, {"op": "delete_tree" if cascade else "delete_doc", "path": f"users/{target}"}]
+    if kind == "class":
+        return [{"op": "release_class_students", "class_id": target}, {"op": "delete_tree", "path": f"classes/{target}"}]
+    steps = []
+    for c in db.collection("classes").where(filter=firestore.FieldFilter("created_by", "==", target)).select([]).stream():
+        steps += plan_deletion("class", c.id)
+    return steps + [{"op": "clear_teacher", "email": target}, {"op": "delete_paper_jobs", "email": target}, {"op": "delete_tree", "path": f"users/{target}"}]
+
+def submit_delete_job(kind, target, cascade=True):
+    target = target.strip()
+    job_ref = db.collection("admin_jobs").document()
+    job_ref.set({"type": "delete", "kind": kind, "target": target, "steps": plan_deletion(kind, target, cascade), "next_step": 0, "deleted": 0,
+                 "status": "queued", "created_by": auth_object.email, "created_at": time.time(), "heartbeat": time.time()})
+    start_admin_job(job_ref.id)
+    return job_ref.id
+
+def start_admin_job(job_id):
+    with admin_jobs["lock"]:
+        if job_id in admin_jobs["running"]: return
+        admin_jobs["running"].add(job_id)
+    alive = keep_alive(db.collection("admin_jobs").document(job_id), DELETE_JOB_HEARTBEAT)
+    try: admin_jobs["pool"].submit(run_delete_job, job_id, alive)
+    except Exception:
+        alive.set()
+        with admin_jobs["lock"]: admin_jobs["running"].discard(job_id)
+        raise
+
+def bulk_update(refs, data):
+    bw = db.bulk_writer()
+    for r in refs: bw.update(r, data)
+    bw.close()
+    return len(refs)
+
+def delete_tree(path):
+    ref = db.document(path)
+    with concurrent.futures.ThreadPoolExecutor(DELETE_JOB_WORKERS) as exe:
+        deleted = sum(exe.map(db.recursive_delete, list(ref.collections())))
+    ref.delete()
+    return deleted + 1
+
+def run_delete_step(step):
+    op = step["op"]
+    if op == "unlink_classes":
+        refs = [c.reference for c in db.collection("classes").where(filter=firestore.FieldFilter("students", "array_contains", step["email"])).select([]).stream()]
+        bulk_update(refs, {"students": firestore.ArrayRemove([step["email"]])}); return 0
+    if op == "clear_teacher":
+        refs = [d.reference for d in db.collection("users").where(filter=firestore.FieldFilter("teacher_id", "==", step["email"])).select([]).stream()]
+        bulk_update(refs, {"teacher_id": None}); return 0
+    if op == "release_class_students": # students added through this class stop pointing at its teacher
+        snap = db.collection("classes").document(step["class_id"]).get()
+        if not snap.exists: return 0
+        owner, emails = snap.get("created_by"), snap.to_dict().get("students") or []
+        refs = [u.reference for u in db.get_all([db.collection("users").document(e) for e in emails]) if u.exists and u.to_dict().get("teacher_id") == owner]
+        bulk_update(refs, {"teacher_id": None}); return 0
+    if op == "delete_paper_jobs": # their image_refs point into the teacher's image_blobs, deleted with users/{email}
+        refs = [j.reference for j in db.collection("paper_jobs").where(filter=firestore.FieldFilter("teacher", "==", step["email"])).select([]).stream()]
+        bw = db.bulk_writer()
+        for r in refs: bw.delete(r)
+        bw.close(); return len(refs)
+    if op == "delete_doc": db.document(step["path"]).delete(); return 1
+    if op == "delete_tree": return delete_tree(step["path"])
+    raise ValueError(f"Unknown step {op}")
+
+def run_delete_job(job_id, alive):
+    job_ref = db.collection("admin_jobs").document(job_id)
+    try:
+        job = job_ref.get().to_dict() or {}
+        deleted = job.get("deleted", 0)
+        for i in range(job.get("next_step", 0), len(job.get("steps", []))):
+            job_ref.update({"status": "running", "heartbeat": time.time()})
+            deleted += run_delete_step(job["steps"][i])
+            job_ref.update({"next_step": i + 1, "deleted": deleted, "heartbeat": time.time()})
+        job_ref.update({"status": "done", "finished_at": time.time(), "heartbeat": time.time()})
+    except Exception as e:
+        print(f"Delete Job Error {job_id}: {e}")
+        try: job_ref.update({"status": "failed", "error": str(e), "heartbeat": time.time()})
+        except Exception: pass
+    finally:
+        alive.set()
+        with admin_jobs["lock"]: admin_jobs["running"].discard(job_id)
+
+def resume_stale_jobs():
+    # Jobs whose worker stopped heartbeating (process restart) are picked up again by whichever admin opens the console.
+    for j in db.collection("admin_jobs").where(filter=firestore.FieldFilter("status", "in", ["queued", "running"])).stream():
+        if j.to_dict().get("heartbeat", 0) < time.time() - DELETE_JOB_STALE_AFTER: start_admin_job(j.id)
+
+def render_admin_jobs():
+    @st.fragment(run_every=3 if st.session_state.get("admin_jobs_active") else None)
+    def jobs_panel():
+        jobs = [{"id": j.id, **j.to_dict()} for j in db.collection("admin_jobs").order_by("created_at", direction=firestore.Query.DESCENDING).limit(8).stream()]
+        was_active, active = st.session_state.get("admin_jobs_active", False), any(j.get("status") in ("queued", "running") for j in jobs)
+        st.session_state.admin_jobs_active = active
+        st.markdown('<div class="section-header">🧹 Deletion Jobs</div>', unsafe_allow_html=True)
+        if not jobs: st.caption("No deletion jobs yet.")
+        for j in jobs:
+            total = max(1, len(j.get("steps", [])))
+            icon = {"done": "✅", "failed": "❌", "running": "⏳", "queued": "🕒"}.get(j.get("status"), "•")
+            st.progress(min(1.0, j.get("next_step", 0) / total), text=f"{icon} {j.get('kind', '?').title()} {j.get('target', '')} — step {j.get('next_step', 0)}/{total}, {j.get('deleted', 0)} docs deleted" + (f" · {j['error']}" if j.get("error") else ""))
+        if failed := next((j for j in jobs if j.get("status") == "failed"), None):
+            if st.button("🔁 Retry failed job", key=f"retry_{failed['id']}"):
+                db.collection("admin_jobs").document(failed["id"]).update({"status": "queued", "error": None}); start_admin_job(failed["id"]); st.session_state.admin_jobs_active = True; st.rerun()
+        if was_active != active: st.rerun() # switch auto-refresh on/off
+    jobs_panel()
+
 def render_admin_panel():
     st.markdown(ADMIN_CSS, unsafe_allow_html=True)
     
@@ -486,6 +1399,11 @@ def render_admin_panel():
                 st.session_state.update(admin_authenticated=True, admin_email=auth_object.email); st.rerun()
         return
 
+    if not st.session_state.get("admin_jobs_resumed"):
+        try: resume_stale_jobs()
+        except Exception as e: print(f"Job Resume Error: {e}")
+        st.session_state.admin_jobs_resumed = True
+
     st.markdown(f'<div class="admin-header"><div class="admin-title">⚙️ Helix Admin Console</div><div style="color:rgba(255,150,160,0.6);font-size:0.85rem;margin-top:4px;">Logged in as {auth_object.email}</div></div>', unsafe_allow_html=True)
 
     admin_school_filter = "All Schools"
@@ -495,7 +1413,7 @@ def render_admin_panel():
         
         st.markdown("---")
         st.markdown("<b style='color:#ff4d6d'>🏫 SCHOOL FILTER</b>", unsafe_allow_html=True)
-        all_schools = sorted(list(set([u.to_dict().get("school") for u in db.collection("users").where(filter=firestore.FieldFilter("role", "==", "teacher")).stream() if u.to_dict().get("school")]).union(SCHOOL_CODES.values())))
+        all_schools = cached_read(("admin_schools",), get_admin_school_list, ttl=300)
         admin_school_filter = st.selectbox("School Filter", ["All Schools"] + all_schools, label_visibility="collapsed")
         
         st.markdown("---")
@@ -503,28 +1421,15 @@ def render_admin_panel():
 
     if admin_page == "📊 Dashboard":
         st.markdown(f'<div class="section-header">📊 System Overview ({admin_school_filter})</div>', unsafe_allow_html=True)
-        u_query = db.collection("users").stream() if admin_school_filter == "All Schools" else db.collection("users").where(filter=firestore.FieldFilter("school", "==", admin_school_filter)).stream()
-        users =[u.to_dict() for u in u_query]
+        counts = cached_read(("admin_counts", admin_school_filter), lambda: get_dashboard_counts(admin_school_filter), ttl=30)
         c1, c2, c3 = st.columns(3)
-        c1.markdown(f'<div class="stat-card"><div class="stat-number">{sum(1 for u in users if u.get("role") == "student")}</div><div class="stat-label">Students</div></div>', unsafe_allow_html=True)
-        c2.markdown(f'<div class="stat-card"><div class="stat-number">{sum(1 for u in users if u.get("role") == "teacher")}</div><div class="stat-label">Teachers</div></div>', unsafe_allow_html=True)
-        
-        classes_count = len(list(db.collection("classes").stream() if admin_school_filter == "All Schools" else db.collection("classes").where(filter=firestore.FieldFilter("school", "==", admin_school_filter)).stream()))
-        c3.markdown(f'<div class="stat-card"><div class="stat-number">{classes_count}</div><div class="stat-label">Classes</div></div>', unsafe_allow_html=True)
+        c1.markdown(f'<div class="stat-card"><div class="stat-number">{counts["students"]}</div><div class="stat-label">Students</div></div>', unsafe_allow_html=True)
+        c2.markdown(f'<div class="stat-card"><div class="stat-number">{counts["teachers"]}</div><div class="stat-label">Teachers</div></div>', unsafe_allow_html=True)
+        c3.markdown(f'<div class="stat-card"><div class="stat-number">{counts["classes"]}</div><div class="stat-label">Classes</div></div>', unsafe_allow_html=True)
 
     elif admin_page == "🎓 Students":
         st.markdown(f'<div class="section-header">🎓 Manage Students ({admin_school_filter})</div>', unsafe_allow_html=True)
-        try:
-            if admin_school_filter == "All Schools":
-                students =[{"id": d.id, **d.to_dict()} for d in db.collection("users").where(filter=firestore.FieldFilter("role", "==", "student")).stream()]
-            else:
-                school_users = db.collection("users").where(filter=firestore.FieldFilter("school", "==", admin_school_filter)).stream()
-                students =[{"id": d.id, **d.to_dict()} for d in school_users if d.to_dict().get("role") == "student"]
-            
-            if students:
-                st.table([{"Name": s.get("display_name", "—"), "Email": s.get("id", "—"), "Grade": s.get("grade", "—"), "School": s.get("school", "—")} for s in students])
-            else:
-                st.info("No students registered for this filter.")
+        try: render_roster("admin_students", roster_base_query("student", admin_school_filter), lambda s: {"Name": s.get("display_name", "—"), "Email": s.get("id", "—"), "Grade": s.get("grade", "—"), "School": s.get("school", "—")}, "No students registered for this filter.", scope=admin_school_filter)
         except Exception as e: st.error(str(e))
         
         st.markdown('<div class="section-header">🗑️ Delete Student</div>', unsafe_allow_html=True)
@@ -532,68 +1437,86 @@ def render_admin_panel():
         cascade = st.checkbox("Also delete their chat threads and analytics history", value=True)
         if st.button("Permanently Delete Student", type="primary"):
             if del_id:
-                try:
-                    db.collection("users").document(del_id).delete()
-                    if cascade:
-                        for t in db.collection("users").document(del_id).collection("threads").stream(): t.reference.delete()
-                        for a in db.collection("users").document(del_id).collection("analytics").stream(): a.reference.delete()
-                    st.success(f"Deleted student {del_id}")
+                try: submit_delete_job("student", del_id, cascade); st.success(f"Queued deletion of student {del_id}")
                 except Exception as e: st.error(str(e))
+        render_admin_jobs()
 
     elif admin_page == "👩‍🏫 Teachers":
         st.markdown(f'<div class="section-header">👩‍🏫 Manage Teachers ({admin_school_filter})</div>', unsafe_allow_html=True)
-        try:
-            if admin_school_filter == "All Schools":
-                teachers =[{"id": d.id, **d.to_dict()} for d in db.collection("users").where(filter=firestore.FieldFilter("role", "==", "teacher")).stream()]
-            else:
-                school_users = db.collection("users").where(filter=firestore.FieldFilter("school", "==", admin_school_filter)).stream()
-                teachers =[{"id": d.id, **d.to_dict()} for d in school_users if d.to_dict().get("role") == "teacher"]
-
-            if teachers:
-                st.table([{"Name": t.get("display_name", "—"), "Email": t.get("id", "—"), "School": t.get("school", "—")} for t in teachers])
-            else:
-                st.info("No teachers registered for this filter.")
+        try: render_roster("admin_teachers", roster_base_query("teacher", admin_school_filter), lambda t: {"Name": t.get("display_name", "—"), "Email": t.get("id", "—"), "School": t.get("school", "—")}, "No teachers registered for this filter.", scope=admin_school_filter)
         except Exception as e: st.error(str(e))
         
         st.markdown('<div class="section-header">🗑️ Delete Teacher</div>', unsafe_allow_html=True)
         del_t = st.text_input("Enter Teacher Email to delete")
+        st.caption("Also deletes the teacher's classes and unlinks their students.")
         if st.button("Delete Teacher", type="primary") and del_t:
-            db.collection("users").document(del_t).delete()
-            st.success("Deleted")
+            try: submit_delete_job("teacher", del_t); st.success(f"Queued deletion of teacher {del_t}")
+            except Exception as e: st.error(str(e))
+        render_admin_jobs()
 
     elif admin_page == "🏫 Classes":
         st.markdown(f'<div class="section-header">🏫 Manage Classes ({admin_school_filter})</div>', unsafe_allow_html=True)
-        try:
-            if admin_school_filter == "All Schools":
-                classes =[{"id": d.id, **d.to_dict()} for d in db.collection("classes").stream()]
-            else:
-                classes =[{"id": d.id, **d.to_dict()} for d in db.collection("classes").where(filter=firestore.FieldFilter("school", "==", admin_school_filter)).stream()]
-
-            if classes:
-                st.table([{"Class ID": c.get("id", "—"), "Grade": c.get("grade", "—"), "School": c.get("school", "—")} for c in classes])
-            else:
-                st.info("No classes created for this filter.")
+        try: render_roster("admin_classes", roster_base_query("classes", admin_school_filter), lambda c: {"Class ID": c.get("id", "—"), "Grade": c.get("grade", "—"), "School": c.get("school", "—"), "Students": len(c.get("students") or [])}, "No classes created for this filter.", search_fields=("Class ID",), scope=admin_school_filter)
         except Exception as e: st.error(str(e))
         
         st.markdown('<div class="section-header">🗑️ Delete Class</div>', unsafe_allow_html=True)
         del_c = st.text_input("Enter Class ID to delete")
         if st.button("Delete Class", type="primary") and del_c:
-            db.collection("classes").document(del_c).delete()
-            st.success("Deleted")
+            try: submit_delete_job("class", del_c.strip().upper()); st.success(f"Queued deletion of class {del_c.strip().upper()}")
+            except Exception as e: st.error(str(e))
+        render_admin_jobs()
 
     elif admin_page == "🧪 AI Debug Lab":
         st.markdown('<div class="section-header">🧪 AI Debug Lab</div>', unsafe_allow_html=True)
+        hist = session_reads["history"]
+        with read_stats["lock"]: g_reads, g_reruns, g_hits = read_stats["reads"], read_stats["reruns"], read_stats["hits"]
+        r1, r2, r3 = st.columns(3)
+        r1.metric("Firestore Reads (last rerun)", hist[-1] if hist else 0); r2.metric("Avg Reads / Rerun (session)", f"{sum(hist) / max(1, len(hist)):.1f}"); r3.metric("Avg Reads / Rerun (all sessions)", f"{g_reads / max(1, g_reruns):.2f}")
+        st.caption(f"Session read-cache hits since start: {g_hits} · reruns: {g_reruns}")
+        vstats = dict(visual_cache["stats"])
+        lookups = vstats["mem_hits"] + vstats["disk_hits"] + vstats["misses"]
+        v1, v2, v3, v4 = st.columns(4)
+        v1.metric("Visual Cache Hits (RAM)", vstats["mem_hits"]); v2.metric("Hits (Disk)", vstats["disk_hits"]); v3.metric("Misses", vstats["misses"]); v4.metric("Deduplicated", vstats["deduped"])
+        st.caption(f"Hit rate: {(vstats['mem_hits'] + vstats['disk_hits']) / max(1, lookups):.0%} · RAM entries: {len(visual_cache['mem'])}/{VISUAL_CACHE_MEM_ITEMS} · Disk: {visual_cache_disk_usage() / 1e6:.1f} / {VISUAL_CACHE_DISK_BYTES / 1e6:.0f} MB")
+        pg = payload_gauges()
+        p1, p2, p3, p4 = st.columns(4)
+        p1.metric("Payload RAM", f"{pg['mem_bytes'] / 1e6:.1f} / {PAYLOAD_MEM_BYTES / 1e6:.0f} MB"); p2.metric("Payload Disk", f"{payload_disk_usage() / 1e6:.1f} MB")
+        p3.metric("Sessions Tracked", len(pg["sessions"])); p4.metric("This Session", f"{pg['sessions'].get(payload_session['id'], 0) / 1e6:.2f} MB")
+        st.caption(f"Payload blobs in RAM: {pg['mem_items']} · hits: {pg['stats']['hits']} · disk hits: {pg['stats']['disk_hits']} · misses: {pg['stats']['misses']} · spilled: {pg['stats']['spilled']}")
+        if pg["sessions"]: st.dataframe(pd.DataFrame([{"Session": sid[:8], "MB": round(b / 1e6, 2)} for sid, b in sorted(pg["sessions"].items(), key=lambda kv: -kv[1])[:20]]), use_container_width=True, hide_index=True)
+        with image_ingest["lock"]: ig = dict(image_ingest["stats"])
+        i1, i2, i3, i4 = st.columns(4)
+        i1.metric(f"Images Stored ({IMAGE_DB_FORMAT})", ig["images"]); i2.metric("Encode Memo Hits", ig["memo_hits"])
+        i3.metric("Stored / Raw", f"{ig['stored_bytes'] / 1e6:.1f} / {ig['raw_bytes'] / 1e6:.1f} MB", f"-{1 - ig['stored_bytes'] / max(1, ig['raw_bytes']):.0%}", delta_color="off"); i4.metric("Avg Encode", f"{ig['encode_s'] * 1000 / max(1, ig['images']):.0f} ms")
+        st.caption(f"Already stored-size (kept as is): {ig['passthrough']} · memoized encodes: {len(image_ingest['memo'])}/{IMAGE_INGEST_MEMO}")
+        if sched := model_scheduler.snapshot():
+            st.dataframe(pd.DataFrame([{"Model": m, "Limit": v["limit"], "Active": v["active"], "Queued": v["queued"], "Calls": v["calls"], "Coalesced": v["coalesced"], "429s": v["throttled"],
+                                        "Failed": v["failed"], "Paused (s)": round(v["paused"], 1), "Avg Wait (s)": round(v["wait"] / max(1, v["calls"]), 2)} for m, v in sched.items()]), use_container_width=True, hide_index=True)
+            st.caption(f"Coalesced visuals across sessions: {model_scheduler.coalesced['visual']}")
+        with image_health["lock"]: health_rows = [{"Model": m, "Breaker": "🔴 open" if h["consecutive"] >= IMAGE_BREAKER_FAILURES and time.time() < h["open_until"] else "🟢 closed", "OK": h["ok"], "Failed": h["failed"], "Consecutive Fails": h["consecutive"], "Avg Latency (s)": round(h["latency"], 1) if h["latency"] is not None else "—"} for m, h in image_health["models"].items()]
+        st.table(health_rows)
+        st.markdown("**⏱️ Latency**")
+        if stages := tracer.stage_stats():
+            st.dataframe(pd.DataFrame([{"Trace": r["trace"], "Stage": r["stage"], "Count": r["count"], "p50 (s)": round(r["p50"], 2), "p95 (s)": round(r["p95"], 2), "Max (s)": round(r["max"], 2)} for r in stages]), use_container_width=True, hide_index=True)
+        if models := tracer.model_stats():
+            st.dataframe(pd.DataFrame([{"Model": r["model"], "Calls": r["count"], "Errors": r["errors"], "p50 (s)": round(r["p50"], 2), "p95 (s)": round(r["p95"], 2),
+                                        "Queue p50 (s)": round(r["queue_p50"], 2), "Queue p95 (s)": round(r["queue_p95"], 2)} for r in models]), use_container_width=True, hide_index=True)
+            st.caption("Model latency is measured from the moment the scheduler grants a slot; time spent waiting for one is the queue column.")
+        for t in tracer.slowest("chat_turn", 5):
+            with st.expander(f"{t['duration']:.1f}s · {time.strftime('%H:%M:%S', time.localtime(t['at']))} · {t.get('attrs', {}).get('role', '')}"):
+                st.dataframe(pd.DataFrame([{"Stage": s["name"], "Start (s)": s["offset"], "Duration (s)": s["duration"], "Detail": ", ".join(f"{k}={v}" for k, v in s.get("attrs", {}).items()), "Error": s.get("error", "")} for s in walk(t.get("spans", ()))]), use_container_width=True, hide_index=True)
+        if not stages: st.caption("No traces recorded in this process yet.")
         m_choice = st.selectbox("Model",["gemini-3.1-flash-lite-preview", "gemini-2.5-flash", "gemini-3-pro-image-preview", "gemini-3.1-flash-image-preview", "gemini-2.5-flash-lite", "gemini-2.5-pro", "gemini-3.1-pro-preview"])
         d_prompt = st.text_area("Prompt")
         if st.button("▶️ Run"):
             with st.spinner("Running..."):
                 try:
                     if "image" in m_choice.lower():
-                        res = process_visual_wrapper(("IMAGE_GEN", d_prompt))
+                        res = generate_visual(("IMAGE_GEN", d_prompt), session_id)
                         if res[0]: st.image(res[0])
                         else: st.error(res[2])
                     else:
-                        st.code(safe_response_text(client.models.generate_content(model=m_choice, contents=d_prompt)))
+                        st.code(safe_response_text(model_scheduler.call(m_choice, lambda: client.models.generate_content(model=m_choice, contents=d_prompt), session=session_id)))
                 except Exception as e: st.error(e)
 
 if st.session_state.get("current_page") == "admin": render_admin_panel(); st.stop()
@@ -618,6 +1541,7 @@ with st.sidebar:
                 with st.expander("🎓 Are you a Teacher?"):
                     if st.button("Verify Code") and (code_input := st.text_input("Teacher Code", type="password")) in SCHOOL_CODES:
                         db.collection("users").document(user_email).update({"role": "teacher", "school": SCHOOL_CODES[code_input]})
+                        invalidate_reads("profile", "class")
                         st.success("Verified!"); time.sleep(1); st.rerun()
             else:
                 c = get_student_class_data(user_email)
@@ -636,18 +1560,62 @@ with st.sidebar:
 
 if st.session_state.delete_requested_for: confirm_delete_chat_dialog(st.session_state.delete_requested_for)
 
+# -----------------------------
+# TEXTBOOK CATALOG
+# -----------------------------
+# Built once from the CIE_<stage>_<type>_<subject>[_<part>][_ANSWERS].pdf naming convention and indexed by
+# (stage, subject). Selection, captions and upload bucketing all read these entries instead of re-parsing names.
+SUBJECT_NAMES = {"math": "Math", "sci": "Science", "eng": "English"}
+BOOK_QUERY_KEYWORDS = {
+    "stage_7": ("stage 7", "grade 6", "year 7"), "stage_8": ("stage 8", "grade 7", "year 8"), "stage_9": ("stage 9", "grade 8", "year 9"),
+    "math": ("math", "algebra", "number", "fraction", "geometry", "calculate", "equation"),
+    "sci": ("sci", "biology", "physics", "chemistry", "experiment", "cell", "gravity"),
+    "eng": ("eng", "poem", "story", "essay", "writing", "grammar"),
+}
+BOOK_QUERY_RE = re.compile("|".join(f"(?P<{g}>{'|'.join(map(re.escape, kws))})" for g, kws in BOOK_QUERY_KEYWORDS.items()))
+
+@dataclass
+class TextbookEntry:
+    filename: str            # lower-cased, the key used by the upload registry
+    stage: str               # "7" / "8" / "9"
+    subject: str             # key of SUBJECT_NAMES, or None when the name has no subject token
+    book_type: str           # "Textbook" / "Workbook"
+    part: str                # "1" / "2" / ""
+    answers: bool
+    friendly_name: str
+    path: Path = None
+    handle: types.File = None # swapped in place by the textbook refresher
+
+def parse_textbook_name(filename: str, path: Path = None):
+    parts = Path(filename or "").stem.split("_")
+    if len(parts) < 3 or parts[0].upper() != "CIE": return None
+    tokens = [p.lower() for p in parts[2:]]
+    stage = parts[1]
+    subject = next((code for code in SUBJECT_NAMES for t in tokens if t.startswith(code)), None)
+    book_type = "Workbook" if "wb" in tokens else "Textbook"
+    answers = "answers" in tokens
+    part = "1" if "1" in tokens else "2" if "2" in tokens else ""
+    grade = STAGE_TO_GRADE.get(f"Stage {stage}", "Unknown Grade")
+    friendly = f"Cambridge {SUBJECT_NAMES.get(subject, 'Subject')} {book_type}{' Answers' if answers else ''} - Stage {stage} ({grade}){f' (Part {part})' if part else ''}"
+    return TextbookEntry(filename.lower(), stage, subject, book_type, part, answers, friendly, path)
+
+class TextbookCatalog:
+    def __init__(self, entries):
+        self.entries = {e.filename: e for e in entries}
+        self.index = {}
+        for e in sorted(self.entries.values(), key=lambda e: e.filename): self.index.setdefault((e.stage, e.subject), []).append(e)
+
+    def books(self, stage: str, subject: str, answers: bool = True):
+        return [e.handle for e in self.index.get((stage, subject), ()) if e.handle and (answers or not e.answers)]
+
+@st.cache_resource(show_spinner=False)
+def get_textbook_catalog() -> TextbookCatalog:
+    # Every CIE pdf under the app folder; names outside the convention or without a subject are never selectable.
+    return TextbookCatalog([e for p in Path.cwd().rglob("*.pdf") if (e := parse_textbook_name(p.name, p)) and e.subject])
+
 def get_friendly_name(filename: str) -> str:
-    name = (filename or "").replace(".pdf", "").replace(".PDF", "")
-    parts = name.split("_")
-    if len(parts) < 3 or parts[0] != "CIE": return name or "Textbook"
-    
-    stage_num = parts[1]
-    grade_num = STAGE_TO_GRADE.get(f"Stage {stage_num}", "Unknown Grade")
-    book_type = "Workbook" if "WB" in parts else "Textbook"
-    if "ANSWERS" in parts: book_type += " Answers"
-    subject = "Science" if "Sci" in parts else "Math" if "Math" in parts else "English" if "Eng" in parts else "Subject"
-    part_str = " (Part 1)" if "1" in parts[2:] else " (Part 2)" if "2" in parts[2:] else ""
-    return f"Cambridge {subject} {book_type} - Stage {stage_num} ({grade_num}){part_str}".strip()
+    e = get_textbook_catalog().entries.get((filename or "").lower()) or parse_textbook_name(filename)
+    return e.friendly_name if e else (filename or "").replace(".pdf", "").replace(".PDF", "") or "Textbook"
 
 def guess_mime(filename: str, fallback: str = "application/octet-stream") -> str:
     n = (filename or "").lower()
@@ -655,74 +1623,608 @@ def guess_mime(filename: str, fallback: str = "application/octet-stream") -> str
 
 def is_image_mime(m: str) -> bool: return (m or "").lower().startswith("image/")
 
+# -----------------------------
+# TEXTBOOK UPLOAD REGISTRY
+# -----------------------------
+# Remote handles are keyed by the SHA-256 of each local PDF and persisted (Firestore doc, or a local manifest
+# without Firestore), so a fresh replica can rebuild its handles without any list/upload call.
+TEXTBOOK_MANIFEST = Path(".textbook_registry.json")
+FILES_API_TTL = 47 * 3600        # Files API deletes uploads after 48h
+TEXTBOOK_REFRESH_MARGIN = 6 * 3600
+TEXTBOOK_REFRESH_INTERVAL = 15 * 60
+
+def file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+def load_textbook_registry() -> dict:
+    try:
+        if db:
+            doc = db.collection("system").document("textbook_registry").get()
+            return (doc.to_dict() or {}).get("books", {}) if doc.exists else {}
+        return json.loads(TEXTBOOK_MANIFEST.read_text()) if TEXTBOOK_MANIFEST.exists() else {}
+    except Exception as e: print(f"Registry Load Error: {e}"); return {}
+
+@st.cache_resource
+def get_manifest_lock():
+    # The local manifest is a read-modify-write from the upload pool; cached so every rerun and session shares it.
+    return threading.Lock()
+
+def store_textbook_registry(entries: dict):
+    try:
+        if db: db.collection("system").document("textbook_registry").set({"books": entries, "updated_at": time.time()}, merge=True)
+        else:
+            with get_manifest_lock(): TEXTBOOK_MANIFEST.write_text(json.dumps({**load_textbook_registry(), **entries}, indent=1))
+    except Exception as e: print(f"Registry Save Error: {e}")
+
+def handle_from_entry(e: dict):
+    return types.File(name=e["name"], uri=e["uri"], display_name=e["display_name"], mime_type="application/pdf", state=types.FileState.ACTIVE)
+
+def wait_until_active(up, deadline: float, delay: float = 0.5, max_delay: float = 4.0):
+    # Polls a Files API upload with exponential backoff until it leaves PROCESSING or the deadline passes.
+    while up.state.name == "PROCESSING" and time.time() < deadline:
+        time.sleep(min(delay, max(0.0, deadline - time.time())))
+        delay = min(delay * 2, max_delay)
+        up = client.files.get(name=up.name)
+    return up
+
+def upload_textbook(path: Path, sha: str):
+    try:
+        up = client.files.upload(file=str(path), config={"mime_type": "application/pdf", "display_name": path.name})
+        up = wait_until_active(up, time.time() + 90)
+        if up.state.name != "ACTIVE": return None
+        expires = up.expiration_time.timestamp() if getattr(up, "expiration_time", None) else time.time() + FILES_API_TTL
+        entry = {"name": up.name, "uri": up.uri, "display_name": path.name, "expires_at": expires, "uploaded_at": time.time()}
+        store_textbook_registry({sha: entry})
+        return entry
+    except Exception as e: print(f"Upload Error {path.name}: {e}"); return None
+
+def refresh_expiring_textbooks(catalog, hashes):
+    registry = load_textbook_registry() # re-read: another replica may already have refreshed
+    for e in catalog.entries.values():
+        r = registry.get(hashes[e.filename])
+        fresh = r if r and r.get("expires_at", 0) > time.time() + TEXTBOOK_REFRESH_MARGIN else upload_textbook(e.path, hashes[e.filename])
+        if fresh and (e.handle is None or e.handle.uri != fresh["uri"]): e.handle = handle_from_entry(fresh)
+
+def start_textbook_refresher(catalog, hashes):
+    def loop():
+        while True:
+            time.sleep(TEXTBOOK_REFRESH_INTERVAL)
+            try: refresh_expiring_textbooks(catalog, hashes)
+            except Exception as e: print(f"Textbook Refresh Error: {e}")
+    threading.Thread(target=loop, name="textbook-refresher", daemon=True).start()
+
 @st.cache_resource(show_spinner=False)
 def upload_textbooks():
-    active_files = {"sci":[], "math":[], "eng":[]}
-    
-    # 1. Dynamically find ALL CIE pdfs in your folder! No more hardcoding names.
-    pdf_map = {p.name.lower(): p for p in Path.cwd().rglob("*.pdf") if "cie" in p.name.lower()}
-    target_files = list(pdf_map.keys())
-    
-    try: existing = {f.display_name.lower(): f for f in client.files.list() if f.display_name}
-    except Exception: existing = {}
-    
-    with st.chat_message("assistant"): st.markdown(f"""<div class="thinking-container"><span class="thinking-text">📚 Synchronizing {len(target_files)} Textbooks...</span><div class="thinking-dots"><div class="thinking-dot"></div><div class="thinking-dot"></div><div class="thinking-dot"></div></div></div>""", unsafe_allow_html=True)
+    catalog = get_textbook_catalog()
+    target_files = list(catalog.entries)
+    registry = load_textbook_registry()
     
+    def is_fresh(t): return registry.get(hashes[t], {}).get("expires_at", 0) > time.time() + 600
     def process_single_book(t):
-        if t in existing and existing[t].state.name == "ACTIVE": return t, existing[t]
-        if t in pdf_map:
-            try:
-                up = client.files.upload(file=str(pdf_map[t]), config={"mime_type": "application/pdf", "display_name": pdf_map[t].name})
-                timeout = time.time() + 90
-                while up.state.name == "PROCESSING" and time.time() < timeout:
-                    time.sleep(3)
-                    up = client.files.get(name=up.name)
-                if up.state.name == "ACTIVE": return t, up
-            except Exception as e: print(f"Upload Error {t}: {e}")
-        return t, None
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        results = list(executor.map(process_single_book, target_files))
-
-    for t, file_obj in results:
-        if file_obj:
-            if "sci" in t: active_files["sci"].append(file_obj)
-            elif "math" in t: active_files["math"].append(file_obj)
-            elif "eng" in t: active_files["eng"].append(file_obj)
-    return active_files
+        e = registry.get(hashes[t]) if is_fresh(t) else upload_textbook(catalog.entries[t].path, hashes[t])
+        if e: catalog.entries[t].handle = handle_from_entry(e)
+
+    with tracer.trace("upload_textbooks", books=len(target_files)):
+        with tracer.span("hash_files"), concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            hashes = dict(zip(target_files, executor.map(lambda t: file_sha256(catalog.entries[t].path), target_files)))
+        
+        if stale := [t for t in target_files if not is_fresh(t)]:
+            with st.chat_message("assistant"): st.markdown(f"""<div class="thinking-container"><span class="thinking-text">📚 Synchronizing {len(stale)} Textbooks...</span><div class="thinking-dots"><div class="thinking-dot"></div><div class="thinking-dot"></div><div class="thinking-dot"></div></div></div>""", unsafe_allow_html=True)
+        
+        with tracer.span("sync_books", stale=len(stale)), concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(process_single_book, target_files))
+
+    start_textbook_refresher(catalog, hashes)
+    return catalog
 
 if is_authenticated and "textbook_handles" not in st.session_state:
     with st.spinner("Preparing curriculum..."): st.session_state.textbook_handles = upload_textbooks()
 
-def select_relevant_books(query, file_dict, user_grade="Grade 6"):
-    qn = normalize_stage_text(query)
-    s7 = any(k in qn for k in["stage 7", "grade 6", "year 7"])
-    s8 = any(k in qn for k in["stage 8", "grade 7", "year 8"])
-    s9 = any(k in qn for k in["stage 9", "grade 8", "year 9"])
-    
-    im = any(k in qn for k in["math", "algebra", "number", "fraction", "geometry", "calculate", "equation"])
-    isc = any(k in qn for k in["sci", "biology", "physics", "chemistry", "experiment", "cell", "gravity"])
-    ien = any(k in qn for k in["eng", "poem", "story", "essay", "writing", "grammar"])
-    
-    if not (s7 or s8 or s9):
-        if user_grade == "Grade 6": s7 = True
-        elif user_grade == "Grade 7": s8 = True
-        elif user_grade == "Grade 8": s9 = True
-        else: s8 = True
-        
-    if not (im or isc or ien): im = isc = ien = True
-    sel =[]
-    def add(k, act):
-        if act: 
-            for b in file_dict.get(k,[]):
-                n = b.display_name.lower()
-                # Blacklist answer keys from being selected for students
-                if "answers" in n and user_role != "teacher": continue
-                if (s7 and "cie_7" in n) or (s8 and "cie_8" in n) or (s9 and "cie_9" in n): sel.append(b)
-    
-    add("math", im); add("sci", isc); add("eng", ien)
+# -----------------------------
+# ATTACHMENT UPLOADS
+# -----------------------------
+# Chat PDFs go to the Files API straight from memory. Handles are shared across sessions by the SHA-256 of the
+# bytes (in-process LRU of upload futures, plus attachment_handles/{sha} in Firestore), so a re-sent worksheet is
+# never uploaded twice and concurrent sends of the same file share one upload.
+ATTACHMENT_POLL_DEADLINE = 60
+ATTACHMENT_REFRESH_MARGIN = 600
+ATTACHMENT_MEM_ITEMS = 256
+
+@st.cache_resource
+def get_attachment_uploads():
+    return {"lock": threading.Lock(), "jobs": OrderedDict(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="attachment-upload")}
+
+attachment_uploads = get_attachment_uploads()
+
+def upload_attachment(sha: str, data: bytes, mime: str, name: str) -> dict:
+    # Runs on the attachment pool: never touches the Streamlit API.
+    e = None
+    if db:
+        try: e = (snap := db.collection("attachment_handles").document(sha).get()).exists and snap.to_dict()
+        except Exception as ex: print(f"Attachment Lookup Error: {ex}")
+    if e and e.get("expires_at", 0) > time.time() + ATTACHMENT_REFRESH_MARGIN: return e
+    up = client.files.upload(file=BytesIO(data), config={"mime_type": mime, "display_name": name or f"attachment-{sha[:12]}"})
+    up = wait_until_active(up, time.time() + ATTACHMENT_POLL_DEADLINE)
+    if up.state.name != "ACTIVE": raise TimeoutError(f"{name or 'Attachment'} still {up.state.name} after {ATTACHMENT_POLL_DEADLINE}s")
+    e = {"name": up.name, "uri": up.uri, "mime_type": mime, "uploaded_at": time.time(),
+         "expires_at": up.expiration_time.timestamp() if getattr(up, "expiration_time", None) else time.time() + FILES_API_TTL}
+    if db:
+        try: db.collection("attachment_handles").document(sha).set(e)
+        except Exception as ex: print(f"Attachment Save Error: {ex}")
+    return e
+
+def start_attachment_upload(data: bytes, mime: str, name: str = None):
+    # -> future resolving to a registry entry ({"uri", "mime_type", ...}); started early so it overlaps the turn setup
+    sha, au = hashlib.sha256(data).hexdigest(), attachment_uploads
+    with au["lock"]:
+        fut = au["jobs"].get(sha)
+        stale = fut and fut.done() and (fut.exception() or fut.result()["expires_at"] < time.time() + ATTACHMENT_REFRESH_MARGIN)
+        if fut is None or stale: fut = au["jobs"][sha] = au["pool"].submit(upload_attachment, sha, data, mime, name)
+        au["jobs"].move_to_end(sha)
+        while len(au["jobs"]) > ATTACHMENT_MEM_ITEMS: au["jobs"].popitem(last=False)
+    return fut
+
+def select_relevant_books(query, catalog, user_grade="Grade 6"):
+    hits = {m.lastgroup for m in BOOK_QUERY_RE.finditer(normalize_stage_text(query))}
+    stages = [s for s in ("7", "8", "9") if f"stage_{s}" in hits] or [GRADE_TO_STAGE.get(user_grade, "Stage 8").split()[1]]
+    subjects = [s for s in SUBJECT_NAMES if s in hits] or list(SUBJECT_NAMES)
+    # Answer keys are blacklisted for students
+    sel = [b for subj in subjects for stage in stages for b in catalog.books(stage, subj, answers=user_role == "teacher")]
     return sel[:5] # Bumped limit to 5 so Answer Keys aren't skipped!
 
+# -----------------------------
+# TEXTBOOK PAGE RETRIEVAL
+# -----------------------------
+# Chat turns send only the top-k BM25 pages of the selected books (textbook_index.py) instead of whole PDFs.
+# Without a usable index (not built yet, stale, or pypdf missing), or when nothing matched, they fall back to
+# attaching the books. Papers and quizzes (teacher jobs, and chat requests matching PAPER_REQUEST_RE) always get the
+# whole books for syllabus-wide coverage.
+RETRIEVAL_TOP_K = int(st.secrets.get("RETRIEVAL_TOP_K", 6))
+PAPER_REQUEST_RE = re.compile(r"\b(?:papers?|quiz(?:zes)?|worksheets?|mock\s+(?:tests?|exams?)|practice\s+(?:tests?|questions)|mark\s+scheme)\b", re.I)
+
+@st.cache_resource(show_spinner=False)
+def get_textbook_index_state():
+    return {"index": textbook_index.TextbookIndex.load(), "building": False, "lock": threading.Lock()}
+
+def get_textbook_index():
+    state, paths = get_textbook_index_state(), [e.path for e in get_textbook_catalog().entries.values()]
+    idx = state["index"]
+    if idx and idx.is_current(paths): return idx
+    with state["lock"]:
+        if state["building"] or textbook_index.PdfReader is None: return None
+        state["building"] = True # one background (re)build per process; the CLI is the normal way to build
+    def build():
+        try: textbook_index.build_index(paths, in_process=True); state["index"] = textbook_index.TextbookIndex.load()
+        except Exception as e: print(f"Textbook Index Error: {e}")
+    threading.Thread(target=build, name="textbook-indexer", daemon=True).start()
+    return None
+
+def retrieve_textbook_pages(query, books):
+    # -> non-empty list of hits, or None when the caller should attach the whole books instead
+    names = [b.display_name for b in books]
+    if not names or PAPER_REQUEST_RE.search(query or "") or not (idx := get_textbook_index()) or not idx.covers(names): return None
+    try: return idx.search(query, k=RETRIEVAL_TOP_K, books=names) or None
+    except Exception as e: print(f"Textbook Search Error: {e}"); return None
+
+def excerpt_parts(hits):
+    body = "\n\n".join(f"[{get_friendly_name(h.book)}, p. {h.page}]\n{h.text}" for h in hits)
+    return [types.Part.from_text(text=f"--- START OF TEXTBOOK EXCERPTS (cite as [Book, p. N]) ---\n{body}\n--- END OF TEXTBOOK EXCERPTS ---")]
+
+def excerpt_citations(hits):
+    pages = {}
+    for h in hits: pages.setdefault(get_friendly_name(h.book), []).append(h.page)
+    return "; ".join(f"{name} (p. {', '.join(map(str, sorted(p)))})" for name, p in pages.items())
+
+# -----------------------------
+# CONTEXT CACHE MANAGER
+# -----------------------------
+# One model-side cached content per (model, system prompt, textbook bundle). The bundle is whatever
+# select_relevant_books returns, so it already encodes stage, subjects and answer-key visibility.
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_RENEW_MARGIN = 300
+CHAT_TOOLS = [{"google_search": {}}]
+
+def textbook_parts(books):
+    parts = []
+    for b in books:
+        parts.append(types.Part.from_text(text=f"--- START OF SOURCE TEXTBOOK: {b.display_name} ---"))
+        parts.append(types.Part.from_uri(file_uri=b.uri, mime_type="application/pdf"))
+        parts.append(types.Part.from_text(text="--- END OF SOURCE TEXTBOOK ---"))
+    return parts
+
+@st.cache_resource
+def get_context_cache_registry():
+    return {"lock": threading.Lock(), "entries": {}, "building": set()}
+
+def context_cache_key(model, system_instruction, books, tools=None) -> str:
+    # Tools are fixed when a cache is created, so callers with different tool lists must not share one
+    tools = [t.model_dump(mode="json", exclude_none=True) if hasattr(t, "model_dump") else t for t in tools or []]
+    return hashlib.sha256(json.dumps([model, system_instruction, sorted(b.uri for b in books), tools], sort_keys=True).encode()).hexdigest()[:32]
+
+def build_context_cache(reg, key, model, system_instruction, books, tools):
+    try:
+        old = reg["entries"].get(key)
+        if old and old.get("expires_at", 0) > time.time() + 30:
+            try: # still alive: extending the TTL is much cheaper than re-uploading the bundle
+                c = client.caches.update(name=old["name"], config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL}s"))
+                reg["entries"][key] = {**old, "expires_at": c.expire_time.timestamp() if c.expire_time else time.time() + CONTEXT_CACHE_TTL}
+                return
+            except Exception: pass
+        label = ", ".join(get_friendly_name(b.display_name) for b in books)
+        c = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+            display_name=f"helix {model} {key[:8]}", system_instruction=system_instruction, tools=tools,
+            contents=[types.Content(role="user", parts=textbook_parts(books))], ttl=f"{CONTEXT_CACHE_TTL}s"))
+        reg["entries"][key] = {"name": c.name, "label": label, "model": model, "created_at": time.time(), "expires_at": c.expire_time.timestamp() if c.expire_time else time.time() + CONTEXT_CACHE_TTL}
+    except Exception as e:
+        print(f"Context Cache Error {model}: {e}")
+        reg["entries"][key] = {"name": None, "expires_at": time.time() + 600} # back off before retrying this bundle
+    finally:
+        with reg["lock"]: reg["building"].discard(key)
+
+def get_cached_bundle(model, system_instruction, books, tools=None):
+    # Returns a live cache name, or None (caller attaches the PDFs inline). Creation and renewal run in the
+    # background so no request ever waits on them.
+    if not books: return None
+    reg, key = get_context_cache_registry(), context_cache_key(model, system_instruction, books, tools)
+    e = reg["entries"].get(key) or {}
+    if e.get("expires_at", 0) > time.time() + CONTEXT_CACHE_RENEW_MARGIN: return e.get("name")
+    with reg["lock"]:
+        if key in reg["building"]: return e.get("name") if e.get("expires_at", 0) > time.time() + 30 else None
+        reg["building"].add(key)
+    threading.Thread(target=build_context_cache, args=(reg, key, model, system_instruction, books, tools), daemon=True).start()
+    return e.get("name") if e.get("expires_at", 0) > time.time() + 30 else None
+
+# -----------------------------
+# STUDENT ANALYTICS ROLLUPS
+# -----------------------------
+# Analytics writes run on analytics_pool, off the chat turn. Each one is a single transaction that adds the raw doc
+# and folds it into users/{email}/rollups/analytics (read-modify-write, but only that student ever writes it) and into
+# one of ROLLUP_CLASS_SHARDS class shards as blind Increment merges, so a whole class answering at once neither
+# contends nor piles onto one doc. The tab reads one doc per student plus the class shards, merged at read time.
+# chapters / weak_points keep their ROLLUP_MAX_KEYS most frequent entries; class shards are pruned on a sampled write.
+ROLLUP_RECENT = 20
+ROLLUP_MAX_KEYS = 200
+ROLLUP_CLASS_SHARDS = 8
+ROLLUP_COMPACT_EVERY = 50 # roughly one class-shard write in this many also prunes that shard's maps
+ANALYTICS_WORKERS = 4
+
+@st.cache_resource
+def get_analytics_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=ANALYTICS_WORKERS, thread_name_prefix="analytics")
+
+analytics_pool = get_analytics_pool()
+
+def analytics_score(ad):
+    try: return float(str(ad.get("score")).strip().rstrip("%"))
+    except Exception: return None
+
+def normalize_weak_point(w):
+    w = " ".join(str(w or "").split()).strip(" .").lower()[:60]
+    return None if w in ("", "none", "n/a", "na", "null", "nothing") else w
+
+def chapter_entry(ad, subject):
+    key = f"{subject}|{ad.get('chapter_number', '')}|{ad.get('chapter_name', '')}"
+    return key, {"subject": subject, "chapter": f"{ad.get('chapter_number', '')} {ad.get('chapter_name', '')}".strip() or "Unknown"}
+
+def cap_rollup_maps(r):
+    for k, weight in (("chapters", lambda v: v.get("n", 0)), ("weak_points", lambda v: v)):
+        if len(m := r.get(k) or {}) > ROLLUP_MAX_KEYS: r[k] = dict(sorted(m.items(), key=lambda kv: -weight(kv[1]))[:ROLLUP_MAX_KEYS])
+    return r
+
+def apply_analytics_to_rollup(r, ad, ts):
+    score, subject = analytics_score(ad), str(ad.get("subject") or "Unknown")
+    r["count"] = r.get("count", 0) + 1
+    if score is not None:
+        r["scored"], r["score_sum"] = r.get("scored", 0) + 1, r.get("score_sum", 0) + score
+        subj = r.setdefault("subjects", {}).setdefault(subject, {"n": 0, "sum": 0})
+        subj["n"] += 1; subj["sum"] += score
+        ch_key, labels = chapter_entry(ad, subject)
+        ch = r.setdefault("chapters", {}).setdefault(ch_key, {**labels, "n": 0, "sum": 0})
+        ch["n"] += 1; ch["sum"] += score
+        r["recent"] = (r.get("recent", []) + [{"t": ts, "score": score, "subject": subject}])[-ROLLUP_RECENT:]
+    if wp := normalize_weak_point(ad.get("weak_point")):
+        r.setdefault("weak_points", {})[wp] = r.get("weak_points", {}).get(wp, 0) + 1
+    r["updated_at"] = ts
+    return cap_rollup_maps(r)
+
+def rollup_increments(ad, ts):
+    # The class-side fold as a merge of Increments: no read, so it never joins a transaction's contention set.
+    score, subject = analytics_score(ad), str(ad.get("subject") or "Unknown")
+    inc = {"count": firestore.Increment(1), "updated_at": ts}
+    if score is not None:
+        ch_key, labels = chapter_entry(ad, subject)
+        inc.update(scored=firestore.Increment(1), score_sum=firestore.Increment(score),
+                   subjects={subject: {"n": firestore.Increment(1), "sum": firestore.Increment(score)}},
+                   chapters={ch_key: {**labels, "n": firestore.Increment(1), "sum": firestore.Increment(score)}})
+    if wp := normalize_weak_point(ad.get("weak_point")): inc["weak_points"] = {wp: firestore.Increment(1)}
+    return inc
+
+def merge_rollups(parts):
+    out = {}
+    for p in parts:
+        for k in ("count", "scored", "score_sum"): out[k] = out.get(k, 0) + p.get(k, 0)
+        for k in ("subjects", "chapters"):
+            for key, v in (p.get(k) or {}).items():
+                o = out.setdefault(k, {}).setdefault(key, {**v, "n": 0, "sum": 0})
+                o["n"] += v.get("n", 0); o["sum"] += v.get("sum", 0)
+        for key, n in (p.get("weak_points") or {}).items(): out.setdefault("weak_points", {})[key] = out.get("weak_points", {}).get(key, 0) + n
+    return cap_rollup_maps(out)
+
+def student_rollup_ref(email):
+    return db.collection("users").document(email).collection("rollups").document("analytics")
+
+def class_rollup_refs(class_id):
+    # Shard 0 keeps the original doc id, so rollups written before sharding are still counted.
+    coll = db.collection("classes").document(class_id).collection("rollups")
+    return [coll.document("analytics" if i == 0 else f"analytics-{i}") for i in range(ROLLUP_CLASS_SHARDS)]
+
+def submit_analytics(email, ad):
+    # Resolve the class on the script thread (session read cache); the worker must not touch Streamlit.
+    cls = get_student_class_data(email)
+    analytics_pool.submit(record_analytics, email, cls["id"] if cls else None, ad).add_done_callback(log_analytics_failure)
+
+def log_analytics_failure(f):
+    if e := f.exception(): print(f"Analytics Write Error: {e}")
+
+def record_analytics(email, class_id, ad):
+    ts, student_ref = time.time(), student_rollup_ref(email)
+    raw_ref = db.collection("users").document(email).collection("analytics").document()
+    shard = class_rollup_refs(class_id)[random.randrange(ROLLUP_CLASS_SHARDS)] if class_id else None
+
+    @firestore.transactional
+    def fold(transaction):
+        snap = student_ref.get(transaction=transaction)
+        transaction.set(raw_ref, {"timestamp": ts, **ad})
+        transaction.set(student_ref, apply_analytics_to_rollup(snap.to_dict() or {} if snap.exists else {}, ad, ts))
+        if shard: transaction.set(shard, rollup_increments(ad, ts), merge=True)
+    with tracer.trace("analytics_write"): fold(db.transaction())
+    if shard and random.random() < 1 / ROLLUP_COMPACT_EVERY: compact_class_shard(shard)
+
+def compact_class_shard(ref):
+    @firestore.transactional
+    def prune(transaction):
+        snap = ref.get(transaction=transaction)
+        r = snap.to_dict() or {} if snap.exists else {}
+        if max(len(r.get("chapters") or {}), len(r.get("weak_points") or {})) > ROLLUP_MAX_KEYS: transaction.set(ref, cap_rollup_maps(r))
+    prune(db.transaction())
+
+def rebuild_class_rollups(class_id, students):
+    # One-off backfill from the raw per-turn docs for data written before rollups existed.
+    class_rollup = {}
+    for email in students:
+        r = {}
+        for a in db.collection("users").document(email).collection("analytics").order_by("timestamp").stream():
+            ad = a.to_dict(); apply_analytics_to_rollup(r, ad, ad.get("timestamp", 0)); apply_analytics_to_rollup(class_rollup, ad, ad.get("timestamp", 0))
+        if r: student_rollup_ref(email).set(r)
+    class_rollup.pop("recent", None)
+    if class_rollup:
+        batch, (first, *rest) = db.batch(), class_rollup_refs(class_id)
+        batch.set(first, class_rollup)
+        for ref in rest: batch.delete(ref)
+        batch.commit()
+
+def load_class_rollups(class_id, students):
+    snaps = db.get_all(student_rollup_ref(e) for e in students)
+    by_email = {snap.reference.parent.parent.id: snap.to_dict() for snap in snaps if snap.exists}
+    shards = [s.to_dict() for s in db.get_all(class_rollup_refs(class_id)) if s.exists]
+    count_reads(len(students) + ROLLUP_CLASS_SHARDS)
+    return by_email, merge_rollups(shards) if shards else {}
+
+def summarize_class(by_email):
+    # Flatten all rollups into long-form arrays once, then aggregate with vectorized pandas ops.
+    rows = [(e, subj, v["n"], v["sum"]) for e, r in by_email.items() for subj, v in (r.get("subjects") or {}).items()]
+    subj_df = pd.DataFrame(rows, columns=["student", "subject", "n", "sum"])
+    recent = pd.DataFrame([(e, i, x["score"]) for e, r in by_email.items() for i, x in enumerate(r.get("recent") or [])], columns=["student", "i", "score"])
+    students = pd.DataFrame([(e, r.get("count", 0), r.get("scored", 0), r.get("score_sum", 0), max((r.get("weak_points") or {"—": 0}).items(), key=lambda kv: kv[1])[0]) for e, r in by_email.items()],
+                            columns=["student", "attempts", "scored", "score_sum", "top_weak_point"]).set_index("student")
+    students["mean_score"] = (students["score_sum"] / students["scored"].where(students["scored"] > 0)).round(1)
+    if not recent.empty:
+        recent["pos"] = recent.groupby("student")["i"].rank(ascending=False) # 1 = newest
+        last5 = recent[recent["pos"] <= 5].groupby("student")["score"].mean()
+        prev5 = recent[(recent["pos"] > 5) & (recent["pos"] <= 10)].groupby("student")["score"].mean()
+        students["trend"] = (last5 - prev5).round(1)
+    else: students["trend"] = float("nan")
+    per_subject = subj_df.pivot_table(index="student", columns="subject", values=["n", "sum"], aggfunc="sum", fill_value=0) if not subj_df.empty else None
+    if per_subject is not None:
+        means = (per_subject["sum"] / per_subject["n"].where(per_subject["n"] > 0)).round(1)
+        students = students.join(means.add_prefix("avg "))
+    return students.drop(columns=["score_sum", "scored"]).reset_index()
+
+def render_student_analytics(my_classes):
+    if not my_classes: st.info("Create a class and add students to see their analytics."); return
+    cid = st.selectbox("Class", [c.id for c in my_classes], key="analytics_class")
+    cls = next(c for c in my_classes if c.id == cid).to_dict()
+    students = cls.get("students") or []
+    if not students: st.info("No students in this class yet."); return
+    by_email, class_rollup = load_class_rollups(cid, students)
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Students Active", f"{len(by_email)}/{len(students)}")
+    m2.metric("Class Average", f"{class_rollup['score_sum'] / class_rollup['scored']:.1f}" if class_rollup.get("scored") else "—")
+    m3.metric("Questions Tracked", class_rollup.get("count", 0))
+
+    if by_email:
+        st.markdown("**Students**")
+        st.dataframe(summarize_class(by_email), use_container_width=True, hide_index=True)
+    if chapters := class_rollup.get("chapters"):
+        st.markdown("**Average score by chapter**")
+        st.bar_chart(pd.DataFrame([{"chapter": f"{v['subject']} · {v['chapter']}", "avg": v["sum"] / v["n"]} for v in chapters.values() if v["n"]]).set_index("chapter"))
+    if weak := class_rollup.get("weak_points"):
+        st.markdown("**Most frequent weak points**")
+        st.bar_chart(pd.Series(weak, name="times reported").sort_values(ascending=False).head(12))
+
+    if by_email:
+        sel = st.selectbox("Student detail", sorted(by_email), key="analytics_student")
+        r = by_email[sel]
+        if r.get("recent"): st.line_chart(pd.DataFrame(r["recent"])[["score"]], y="score")
+        if r.get("chapters"): st.dataframe([{"Subject": v["subject"], "Chapter": v["chapter"], "Attempts": v["n"], "Avg": round(v["sum"] / v["n"], 1)} for v in r["chapters"].values() if v["n"]], use_container_width=True, hide_index=True)
+
+    with st.expander("Rebuild analytics from history"):
+        st.caption("Only needed once for activity recorded before rollups existed.")
+        if st.button("Rebuild", key="rebuild_rollups"):
+            with st.spinner("Rebuilding..."): rebuild_class_rollups(cid, students)
+            st.rerun()
+
+# -----------------------------
+# PAPER GENERATION JOBS
+# -----------------------------
+# Every requested paper (subject x variant) is a paper_jobs/{id} doc advanced by an in-process worker. The text is
+# stored as soon as the model returns and the images go to the teacher's content-addressed image_blobs, so a job
+# whose worker stopped heartbeating (restart) resumes from its last stored stage when the teacher reopens the tab.
+# A job heartbeats every PAPER_JOB_HEARTBEAT seconds from submission to finish, so a long scheduler wait or paper call
+# is never mistaken for a dead worker. The job list needs the composite index paper_jobs (teacher ASC, created_at DESC);
+# until it is deployed the list falls back to an unordered query sorted in memory and logs the index link.
+PAPER_JOB_WORKERS = 3
+PAPER_JOB_STALE_AFTER = 600
+PAPER_JOB_HEARTBEAT = 60
+PAPER_JOB_LIST = 12
+PAPER_MODEL = "gemini-2.5-pro"
+PAPER_VARIANT_LABELS = "ABCDEF"
+
+@st.cache_resource
+def get_paper_job_runner():
+    return {"lock": threading.Lock(), "pool": concurrent.futures.ThreadPoolExecutor(max_workers=PAPER_JOB_WORKERS, thread_name_prefix="paper-job"), "running": set()}
+
+paper_jobs = get_paper_job_runner()
+
+def paper_prompt(job):
+    # REVISED PROMPT TO ENFORCE INDIRECTNESS & NO TOPIC TITLES & PROPER TITLING
+    variant = f"- This is Variant {job['variant']} of {job['variants']}: use scenarios and numbers that differ from every other variant.\n" if job.get("variants", 1) > 1 else ""
+    return (
+        f"Task: Generate a CIE {job['subject']} question paper for {job['grade']} students.\n"
+        f"Difficulty: {job['difficulty']} (Ensure questions are complex, indirect, and harder than standard textbook problems. No childish logic).\n"
+        f"Marks: {job['marks']}.\n"
+        f"Extra Instructions: {job['extra']}\n\n"
+        f"CRITICAL REMINDERS:\n"
+        f"- Write the top Title exactly as:\n"
+        f"# Helix A.I.\n## Practice Paper\n### {job['subject']} - {job['grade']}\n"
+        f"- Do NOT output the word 'Stage' anywhere in the paper.\n"
+        f"- Do NOT use topic titles or headings above questions (e.g. No 'Geometry:', No 'Fractions:'). Just write '1.', '2.', etc. The student must deduce the concept.\n"
+        f"- Balance the syllabus questions evenly.\n"
+        f"{variant}"
+        f"- Append [PDF_READY] at the end."
+    )
+
+def submit_paper_jobs(title, subjects, grade, difficulty, marks, extra, variants=1):
+    batch, now, ids = uuid.uuid4().hex[:8], time.time(), []
+    for subject in subjects:
+        for v in PAPER_VARIANT_LABELS[:variants]:
+            suffix = " · ".join(x for x in (subject if len(subjects) > 1 else "", f"Variant {v}" if variants > 1 else "") if x)
+            job = {"teacher": auth_object.email, "batch": batch, "title": f"{title} ({suffix})" if suffix else title, "subject": subject, "grade": grade,
+                   "difficulty": difficulty, "marks": int(marks), "extra": extra, "variant": v, "variants": variants,
+                   "status": "queued", "visuals_done": 0, "visuals_total": 0, "created_at": now, "heartbeat": now}
+            ref = db.collection("paper_jobs").document()
+            ref.set(job); ids.append(ref.id)
+            start_paper_job(ref.id, job)
+    return ids
+
+def start_paper_job(job_id, job):
+    # Books and the context cache are resolved here, on the script thread; the worker never touches Streamlit APIs.
+    with paper_jobs["lock"]:
+        if job_id in paper_jobs["running"]: return
+        paper_jobs["running"].add(job_id)
+    alive = keep_alive(db.collection("paper_jobs").document(job_id), PAPER_JOB_HEARTBEAT)
+    try:
+        books = select_relevant_books(f"{job['subject']} {job['grade']}", st.session_state.textbook_handles, job["grade"])
+        cache_name = get_cached_bundle(PAPER_MODEL, PAPER_SYSTEM, books)
+        paper_jobs["pool"].submit(run_paper_job, job_id, books, cache_name, alive)
+    except Exception:
+        alive.set()
+        with paper_jobs["lock"]: paper_jobs["running"].discard(job_id)
+        raise
+
+def run_paper_visuals(job_ref, v_prompts, session):
+    jobs = {}
+    futs = [submit_visual(jobs, vp, session) for vp in v_prompts]
+    job_ref.update({"visuals_total": len(set(futs)), "heartbeat": time.time()})
+    for n, _ in enumerate(concurrent.futures.as_completed(set(futs)), 1): job_ref.update({"visuals_done": n, "heartbeat": time.time()})
+    return [f.result() for f in futs]
+
+def run_paper_job(job_id, books, cache_name, alive):
+    job_ref = db.collection("paper_jobs").document(job_id)
+    try:
+        with tracer.trace("paper_job", job=job_id):
+            job = job_ref.get().to_dict() or {}
+            session = f"papers:{job.get('teacher')}"
+            if not (paper := job.get("paper")):
+                job_ref.update({"status": "writing", "error": None, "heartbeat": time.time()})
+                parts = ([] if cache_name else textbook_parts(books)) + [types.Part.from_text(text=paper_prompt(job))]
+                config = types.GenerateContentConfig(cached_content=cache_name, temperature=0.1) if cache_name else types.GenerateContentConfig(system_instruction=PAPER_SYSTEM, temperature=0.1)
+                # Identical papers requested while one is being written (same prompt and books) share that call
+                key = hashlib.sha256(json.dumps([paper_prompt(job), cache_name, sorted(b.uri for b in books)]).encode()).hexdigest()
+                with tracer.span("model_call", model=PAPER_MODEL) as sp: paper = safe_response_text(model_scheduler.call(PAPER_MODEL, lambda: client.models.generate_content(model=PAPER_MODEL, contents=parts, config=config), session=session, key=key, on_start=sp.slot_acquired))
+                if not paper.strip(): raise ValueError("The model returned an empty paper")
+                job_ref.update({"paper": paper, "heartbeat": time.time()})
+
+            job_ref.update({"status": "visuals", "visuals_done": 0, "heartbeat": time.time()})
+            blobs_ref, bw = db.collection("users").document(job["teacher"]).collection("image_blobs"), db.bulk_writer()
+            refs, models, errors = [], [], []
+            with tracer.span("visuals"): visuals = run_paper_visuals(job_ref, VISUAL_DIRECTIVE_RE.findall(paper), session)
+            with tracer.span("store_images", count=len(visuals)):
+                for (data, model, logs), fut in zip(visuals, [ingest_image(v[0]) if v[0] else None for v in visuals]):
+                    blob = fut.result() if fut else None
+                    h = hashlib.sha256(blob).hexdigest() if blob else None
+                    if h: bw.set(blobs_ref.document(h), {"data": blob, "created_at": time.time()})
+                    else: errors += [str(l) for l in logs] or [f"{model}: no image"]
+                    refs.append(h); models.append(model if blob else "Failed")
+                bw.close()
+            job_ref.update({"status": "done", "image_refs": refs, "image_models": models, "errors": errors[:10], "finished_at": time.time(), "heartbeat": time.time()})
+    except Exception as e:
+        print(f"Paper Job Error {job_id}: {e}")
+        try: job_ref.update({"status": "failed", "error": str(e), "heartbeat": time.time()})
+        except Exception: pass
+    finally:
+        alive.set()
+        with paper_jobs["lock"]: paper_jobs["running"].discard(job_id)
+
+def resume_stale_paper_jobs(teacher):
+    for j in db.collection("paper_jobs").where(filter=firestore.FieldFilter("teacher", "==", teacher)).where(filter=firestore.FieldFilter("status", "in", ["queued", "writing", "visuals"])).stream():
+        job = j.to_dict()
+        if job.get("heartbeat", 0) < time.time() - PAPER_JOB_STALE_AFTER and j.id not in paper_jobs["running"]: start_paper_job(j.id, job)
+
+def list_paper_jobs(teacher):
+    q = db.collection("paper_jobs").where(filter=firestore.FieldFilter("teacher", "==", teacher))
+    try: return [{"id": j.id, **j.to_dict()} for j in q.order_by("created_at", direction=firestore.Query.DESCENDING).limit(PAPER_JOB_LIST).stream()]
+    except FailedPrecondition as e:
+        # Composite index not deployed yet: the error message carries the console link that creates it.
+        if not st.session_state.get("paper_jobs_index_logged"): print(f"Paper Jobs Index Error: {e}"); st.session_state.paper_jobs_index_logged = True
+        return sorted(({"id": j.id, **j.to_dict()} for j in q.stream()), key=lambda j: -j.get("created_at", 0))[:PAPER_JOB_LIST]
+
+def paper_job_progress(j):
+    if j.get("status") == "done": return 1.0
+    if j.get("status") == "visuals": return 0.3 + 0.7 * j.get("visuals_done", 0) / max(1, j.get("visuals_total", 0))
+    return 0.1 if j.get("status") == "writing" else 0.0
+
+def render_paper_jobs():
+    @st.fragment(run_every=3 if st.session_state.get("paper_jobs_active") else None)
+    def jobs_panel():
+        jobs = list_paper_jobs(auth_object.email)
+        count_reads(max(1, len(jobs)))
+        was_active, active = st.session_state.get("paper_jobs_active", False), any(j.get("status") in ("queued", "writing", "visuals") for j in jobs)
+        st.session_state.paper_jobs_active = active
+        st.markdown("**🗂️ Generated Papers**")
+        if not jobs: st.caption("No papers generated yet.")
+        for j in jobs:
+            status = j.get("status")
+            label = {"queued": "🕒 queued", "writing": "✍️ writing", "visuals": f"🎨 drawing {j.get('visuals_done', 0)}/{j.get('visuals_total', 0)}", "done": "✅ ready", "failed": f"❌ {j.get('error', 'failed')}"}.get(status, status)
+            st.progress(paper_job_progress(j), text=f"{j.get('title', 'Paper')} — {label}")
+            if status == "done" and st.toggle("Preview", key=f"paper_preview_{j['id']}"):
+                st.markdown(j.get("paper", "").replace("[PDF_READY]", ""))
+                imgs = message_images({"image_refs": j.get("image_refs") or []})
+                for i, m in zip(imgs, j.get("image_models") or []):
+                    if i: st.image(i, caption=m)
+                for err in j.get("errors") or []: st.error(f"Image Error: {err}")
+                try: lazy_pdf_download("Download PDF", j.get("paper", ""), imgs, f"{j.get('title', 'Paper')}.pdf", f"paper_{j['id']}")
+                except Exception as e: st.error(f"PDF Gen Error: {e}")
+            elif status == "failed" and st.button("🔁 Retry", key=f"paper_retry_{j['id']}"):
+                db.collection("paper_jobs").document(j["id"]).update({"status": "queued", "error": None, "heartbeat": time.time()})
+                start_paper_job(j["id"], j); st.session_state.paper_jobs_active = True; st.rerun()
+        if was_active != active: st.rerun() # switch auto-refresh on/off
+    jobs_panel()
+
 # ==========================================
 # APP ROUTING: TEACHER DASHBOARD
 # ==========================================
@@ -734,7 +2236,7 @@ if user_role == "teacher":
     st.text("helix.ai Teacher Dashboard: Manage Cambridge (CIE) classes, track student analytics, and generate detailed, multi-step question papers.")
     
     user_school = user_profile.get("school")
-    roster =[u for u in db.collection("users").where(filter=firestore.FieldFilter("school", "==", user_school)).stream() if u.to_dict().get("role") == "student"] if user_school else list(db.collection("users").where(filter=firestore.FieldFilter("teacher_id", "==", user_email)).stream())
+    roster = roster_base_query("student", user_school) if user_school else (db.collection("users"), db.collection("users").where(filter=firestore.FieldFilter("teacher_id", "==", user_email)))
 
     teacher_menu = st.radio("Menu",["Class Management", "Student Analytics", "Assign Papers", "AI Chat"], horizontal=True, label_visibility="collapsed")
     st.divider()
@@ -758,62 +2260,39 @@ if user_role == "teacher":
                 if st.form_submit_button("Add") and em:
                     db.collection("users").document(em.strip().lower()).set({"role": "student", "teacher_id": user_email, "school": user_school}, merge=True)
                     db.collection("classes").document(sc).update({"students": firestore.ArrayUnion([em.strip().lower()])})
+                    st.session_state.get("rosters", {}).pop("teacher_roster", None)
                     st.success("Added!"); time.sleep(1); st.rerun()
 
+        st.subheader("🎓 Students")
+        try: render_roster("teacher_roster", roster, lambda s: {"Name": s.get("display_name", "—"), "Email": s.get("id", "—"), "Grade": s.get("grade", "—")}, "No students yet.", scope=user_school)
+        except Exception as e: st.error(str(e))
+
+    elif teacher_menu == "Student Analytics":
+        st.subheader("📈 Student Analytics")
+        try: render_student_analytics(list(db.collection("classes").where(filter=firestore.FieldFilter("created_by", "==", user_email)).stream()))
+        except Exception as e: st.error(str(e))
+
     elif teacher_menu == "Assign Papers":
         st.subheader("📝 Assignment Creator")
         c1, c2 = st.columns(2)
         assign_title = c1.text_input("Title", "Chapter Quiz")
-        assign_subject = c1.selectbox("Subject",["Math", "Biology", "Chemistry", "Physics", "English"])
+        assign_subjects = c1.multiselect("Subjects",["Math", "Biology", "Chemistry", "Physics", "English"], default=["Math"])
         assign_grade = c1.selectbox("Grade",["Grade 6", "Grade 7", "Grade 8"])
         assign_difficulty = c2.selectbox("Difficulty",["Easy", "Medium", "Hard"])
         assign_marks = c2.number_input("Marks", 10, 100, 30, 5)
+        assign_variants = c2.number_input("Variants per subject (A, B, C...)", 1, len(PAPER_VARIANT_LABELS), 1)
         assign_extra = st.text_area("Extra Instructions")
 
-        if st.button("🤖 Generate with Helix AI", type="primary", use_container_width=True):
-            with st.spinner("Writing paper..."):
-                books = select_relevant_books(f"{assign_subject} {assign_grade}", st.session_state.textbook_handles, assign_grade)
-                parts =[]
-                for b in books: parts.extend([types.Part.from_text(text=f"[Source: {b.display_name}]"), types.Part.from_uri(file_uri=b.uri, mime_type="application/pdf")])
-                
-                # REVISED PROMPT TO ENFORCE INDIRECTNESS & NO TOPIC TITLES & PROPER TITLING
-                prompt_text = (
-                    f"Task: Generate a CIE {assign_subject} question paper for {assign_grade} students.\n"
-                    f"Difficulty: {assign_difficulty} (Ensure questions are complex, indirect, and harder than standard textbook problems. No childish logic).\n"
-                    f"Marks: {assign_marks}.\n"
-                    f"Extra Instructions: {assign_extra}\n\n"
-                    f"CRITICAL REMINDERS:\n"
-                    f"- Write the top Title exactly as:\n"
-                    f"# Helix A.I.\n## Practice Paper\n### {assign_subject} - {assign_grade}\n"
-                    f"- Do NOT output the word 'Stage' anywhere in the paper.\n"
-                    f"- Do NOT use topic titles or headings above questions (e.g. No 'Geometry:', No 'Fractions:'). Just write '1.', '2.', etc. The student must deduce the concept.\n"
-                    f"- Balance the syllabus questions evenly.\n"
-                    f"- Append [PDF_READY] at the end."
-                )
-                parts.append(types.Part.from_text(text=prompt_text))
-                
-                try:
-                    resp = client.models.generate_content(model="gemini-2.5-pro", contents=parts, config=types.GenerateContentConfig(system_instruction=PAPER_SYSTEM, temperature=0.1))
-                    gen_paper = safe_response_text(resp)
-                    
-                    draft_imgs, draft_mods = [],[]
-                    if v_prompts := re.findall(r"(IMAGE_GEN|PIE_CHART):\s*\[(.*?)\]", gen_paper):
-                        with concurrent.futures.ThreadPoolExecutor(5) as exe:
-                            for r in exe.map(process_visual_wrapper, v_prompts):
-                                draft_imgs.append(r[0]); draft_mods.append(r[1])
-                                if not r[0] and len(r)>2: st.error(f"Image Error: {r[2]}")
-
-                    st.session_state.update(draft_paper=gen_paper, draft_images=draft_imgs, draft_models=draft_mods, draft_title=assign_title); st.rerun()
-                except Exception as e: st.error(e)
+        if st.button("🤖 Generate with Helix AI", type="primary", use_container_width=True, disabled=not assign_subjects):
+            try:
+                n = len(submit_paper_jobs(assign_title, assign_subjects, assign_grade, assign_difficulty, assign_marks, assign_extra, int(assign_variants)))
+                st.session_state.paper_jobs_active = True
+                st.toast(f"Queued {n} paper{'s' if n > 1 else ''}. You can leave this tab; they keep generating.")
+            except Exception as e: st.error(e)
 
-        if st.session_state.get("draft_paper"):
-            with st.expander("Preview", expanded=True):
-                st.markdown(st.session_state.draft_paper.replace("[PDF_READY]", ""))
-                if st.session_state.draft_images:
-                    for i, m in zip(st.session_state.draft_images, st.session_state.draft_models):
-                        if i: st.image(i, caption=m)
-                try: st.download_button("Download PDF", data=create_pdf(st.session_state.draft_paper, st.session_state.draft_images), file_name=f"{st.session_state.draft_title}.pdf", mime="application/pdf")
-                except Exception as e: st.error(f"PDF Gen Error: {e}")
+        try: resume_stale_paper_jobs(user_email)
+        except Exception as e: print(f"Paper Job Resume Error: {e}")
+        render_paper_jobs()
 
     elif teacher_menu == "AI Chat": render_chat_interface = True 
 
@@ -827,31 +2306,29 @@ else:
 # UNIVERSAL CHAT VIEW 
 # ==========================================
 if render_chat_interface:
+    cursor = st.session_state.get("thread_cursor") or {}
+    if cursor.get("thread") == st.session_state.current_thread_id and cursor.get("oldest_seq"):
+        if st.button("⬆️ Load earlier messages", use_container_width=True): load_earlier_messages(); st.rerun()
+    track_session_payloads(st.session_state.messages)
     for idx, msg in enumerate(st.session_state.messages):
         with st.chat_message(msg["role"]):
-            # Aggressive Regex Sweeper: Removes tags, JSON blocks, and conversational leak text
-            disp = msg.get("content") or ""
-            disp = re.sub(r"(?i)(?:Here is the )?(?:Analytics|JSON).*?(?:for student)?s?\s*[:-]?\s*", "", disp)
-            disp = re.sub(r"===ANALYTICS_START===.*?===ANALYTICS_END===", "", disp, flags=re.IGNORECASE|re.DOTALL)
-            disp = re.sub(r"```json\s*\{[^{]*?\"weak_point\".*?\}\s*```", "", disp, flags=re.IGNORECASE|re.DOTALL)
-            disp = re.sub(r"\{[^{]*?\"weak_point\".*?\}", "", disp, flags=re.IGNORECASE|re.DOTALL)
-            disp = re.sub(r"\[PDF_READY\]", "", disp, flags=re.IGNORECASE).strip()
+            # Sanitized once per message (new replies arrive pre-cleaned), never on every rerun
+            if "display" not in msg: msg["display"] = clean_display(msg.get("content"))
+            st.markdown(msg["display"])
             
-            st.markdown(disp)
-            
-            for img, mod in zip(msg.get("images") or[], msg.get("image_models",["Unknown"]*10)):
-                if img: st.image(img, use_container_width=True, caption=f"✨ Generated by helix.ai ({mod})")
-            for b64, mod in zip(msg.get("db_images") or [], msg.get("image_models", ["Unknown"]*10)):
-                if b64:
-                    try: st.image(base64.b64decode(b64), use_container_width=True, caption=f"✨ Generated by helix.ai ({mod})")
+            for img, mod in zip(message_images(msg), msg.get("image_models",["Unknown"]*10)):
+                if img:
+                    try: st.image(img, use_container_width=True, caption=f"✨ Generated by helix.ai ({mod})")
                     except: pass
-            if msg.get("user_attachment_bytes"):
+            if msg.get("user_attachment_key"):
                 mime, name = msg.get("user_attachment_mime", ""), msg.get("user_attachment_name", "File")
-                if "image" in mime: st.image(msg["user_attachment_bytes"], use_container_width=True)
+                if "image" in mime and (data := payload_get(msg["user_attachment_key"])): st.image(data, use_container_width=True)
                 else: st.caption(f"📎 Attached: {name}")
 
             if msg["role"] == "assistant" and msg.get("is_downloadable"):
-                try: st.download_button("📄 Download PDF", data=create_pdf(msg.get("content") or "", msg.get("images") or[base64.b64decode(b) for b in msg.get("db_images",[]) if b]), file_name=f"Paper_{idx}.pdf", mime="application/pdf", key=f"dl_{idx}")
+                try:
+                    if "pdf_digest" not in msg: msg["pdf_digest"] = pdf_digest(msg.get("content"), message_images(msg))
+                    lazy_pdf_download("📄 Download PDF", msg.get("content") or "", message_images(msg), f"Paper_{idx}.pdf", f"dl_{idx}", msg["pdf_digest"])
                 except Exception as e: st.error(f"PDF Error: {e}")
 
     if chat_input := st.chat_input("Ask Helix...", accept_file=True, file_type=["jpg","png","pdf","txt"]):
@@ -861,91 +2338,89 @@ if render_chat_interface:
         f_mime = chat_input.files[0].type if chat_input.files else None
         f_name = chat_input.files[0].name if chat_input.files else None
         
-        st.session_state.messages.append({"role": "user", "content": chat_input.text or "", "user_attachment_bytes": f_bytes, "user_attachment_mime": f_mime, "user_attachment_name": f_name})
-        save_chat_history(); st.rerun()
+        st.session_state.messages.append({"role": "user", "content": chat_input.text or "", "user_attachment_key": payload_put(f_bytes), "user_attachment_mime": f_mime, "user_attachment_name": f_name})
+        first_turn = is_authenticated and sum(1 for m in st.session_state.messages if m["role"] == "user") == 1
+        with tracer.trace("send_message", first_turn=first_turn): save_chat_history(title=heuristic_chat_title(st.session_state.messages) if first_turn else None)
+        if first_turn: start_title_job(st.session_state.current_thread_id, st.session_state.messages)
+        st.rerun()
 
     if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
         msg_data = st.session_state.messages[-1]
         with st.chat_message("assistant"):
-            think = st.empty(); think.markdown("""<div class="thinking-container"><span class="thinking-text">Thinking</span><div class="thinking-dots"><div class="thinking-dot"></div><div class="thinking-dot"></div><div class="thinking-dot"></div></div></div>""", unsafe_allow_html=True)
-            
-            try:
-                valid_history =[]
-                exp_role = "model"
-                for m in reversed([m for m in st.session_state.messages[:-1] if not m.get("is_greeting")]):
-                    r = "user" if m.get("role") == "user" else "model"
-                    txt = m.get("content") or ""
-                    if txt.strip() and r == exp_role:
-                        valid_history.insert(0, types.Content(role=r, parts=[types.Part.from_text(text=txt)]))
-                        exp_role = "user" if exp_role == "model" else "model"
-                if valid_history and valid_history[0].role == "model": valid_history.pop(0)
-
-                curr_parts =[]
-                # Explicitly pass the student's grade to make book matching bulletproof
-                student_grade = user_profile.get("grade", "Grade 6")
-                books = select_relevant_books(" ".join([m.get("content","") for m in st.session_state.messages[-3:]]), st.session_state.textbook_handles, student_grade)
-                
-                if books:
-                    st.caption(f"📚 **Reading Textbooks:** {', '.join([get_friendly_name(b.display_name) for b in books])}")
-                    for b in books: 
-                        curr_parts.append(types.Part.from_text(text=f"--- START OF SOURCE TEXTBOOK: {b.display_name} ---"))
-                        curr_parts.append(types.Part.from_uri(file_uri=b.uri, mime_type="application/pdf"))
-                        curr_parts.append(types.Part.from_text(text=f"--- END OF SOURCE TEXTBOOK ---"))
-                
-                if f_bytes := msg_data.get("user_attachment_bytes"):
-                    mime = msg_data.get("user_attachment_mime") or guess_mime(msg_data.get("user_attachment_name"))
-                    if is_image_mime(mime): curr_parts.append(types.Part.from_bytes(data=f_bytes, mime_type=mime))
-                    elif "pdf" in mime:
-                        tmp = f"temp_{time.time()}.pdf"
-                        with open(tmp, "wb") as f: f.write(f_bytes)
-                        up = client.files.upload_file(tmp)
-                        while up.state.name == "PROCESSING": time.sleep(1); up = client.files.get(name=up.name)
-                        curr_parts.append(types.Part.from_uri(file_uri=up.uri, mime_type="application/pdf"))
-                        os.remove(tmp)
-
-                curr_parts.append(types.Part.from_text(text=f"Please analyze the attached Cambridge textbooks and files. You MUST use the book's facts and terminology.\n\nUser Query: {msg_data.get('content')}"))
-                
-                resp = client.models.generate_content(
-                    model="gemini-3.1-flash-lite-preview",
-                    contents=valid_history +[types.Content(role="user", parts=curr_parts)],
-                    config=types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, temperature=0.3, tools=[{"google_search": {}}])
-                )
-                bot_txt = safe_response_text(resp) or "⚠️ *Failed to generate text.*"
-                
-                # Strict Boundary Analytics Extraction (With conversational text removal)
-                match_full = re.search(r"===ANALYTICS_START===(.*?)===ANALYTICS_END===", bot_txt, flags=re.IGNORECASE|re.DOTALL)
-                if not match_full:
-                    # Fallback
-                    match_full = re.search(r"(?:(?:Here is the )?Analytics.*?:?\s*|```json\s*)?(\{[\s\S]*?\"weak_point\"[\s\S]*?\})(?:\s*```)?", bot_txt, flags=re.IGNORECASE)
-                
-                if match_full:
-                    try:
-                        ad = json.loads(match_full.group(1))
-                        # Find the index where the match starts, and strip out any conversational lead-in before it
-                        start_idx = match_full.start()
-                        bot_txt = bot_txt[:start_idx].strip()
-                        # Also replace any stray prefix lines that might have slipped through
-                        bot_txt = re.sub(r"(?i)(?:Here is the )?(?:Analytics|JSON).*?(?:for student)?s?\s*[:-]?\s*$", "", bot_txt).strip()
-                        
-                        if is_authenticated and db: db.collection("users").document(user_email).collection("analytics").add({"timestamp": time.time(), **ad})
-                    except Exception: pass
-
-                think.empty()
-                
-                imgs, mods = [],[]
-                if v_prompts := re.findall(r"(IMAGE_GEN|PIE_CHART):\s*\[(.*?)\]", bot_txt):
-                    with concurrent.futures.ThreadPoolExecutor(5) as exe:
-                        for r in exe.map(process_visual_wrapper, v_prompts):
-                            if r and r[0]: imgs.append(r[0]); mods.append(r[1])
-                            else: imgs.append(None); mods.append("Failed")
+            with tracer.trace("chat_turn", role=user_role, attachment=msg_data.get("user_attachment_mime")):
+                think = st.empty(); think.markdown("""<div class="thinking-container"><span class="thinking-text">Thinking</span><div class="thinking-dots"><div class="thinking-dot"></div><div class="thinking-dot"></div><div class="thinking-dot"></div></div></div>""", unsafe_allow_html=True)
                 
-                dl = bool(re.search(r"\[PDF_READY\]", bot_txt, re.IGNORECASE) or (re.search(r"##\s*Mark Scheme", bot_txt, re.IGNORECASE) and re.search(r"\[\d+\]", bot_txt)))
-                st.session_state.messages.append({"role": "assistant", "content": bot_txt, "is_downloadable": dl, "images": imgs, "image_models": mods})
-                
-                if is_authenticated and sum(1 for m in st.session_state.messages if m["role"] == "user") == 1:
-                    t = generate_chat_title(client, st.session_state.messages)
-                    if t: get_threads_collection().document(st.session_state.current_thread_id).set({"title": t}, merge=True)
-                
-                save_chat_history(); st.rerun()
-                
-            except Exception as e: think.empty(); st.error(f"Error: {e}")
+                try:
+                    f_bytes, attachment = payload_get(msg_data.get("user_attachment_key")), None
+                    mime = (msg_data.get("user_attachment_mime") or guess_mime(msg_data.get("user_attachment_name"))) if f_bytes else None
+                    if f_bytes and not is_image_mime(mime) and "pdf" in mime: attachment = start_attachment_upload(f_bytes, "application/pdf", msg_data.get("user_attachment_name"))
+
+                    with tracer.span("history") as sp:
+                        valid_history, summary, sp.attrs["tokens"] = budgeted_history(st.session_state.messages[:-1])
+                        sp.attrs["summary"] = bool(summary)
+
+                    curr_parts =[types.Part.from_text(text=f"Summary of the earlier part of this conversation:\n{summary}")] if summary else []
+                    # Explicitly pass the student's grade to make book matching bulletproof
+                    student_grade = user_profile.get("grade", "Grade 6")
+                    with tracer.span("select_relevant_books"): books = select_relevant_books(" ".join([m.get("content","") for m in st.session_state.messages[-3:]]), st.session_state.textbook_handles, student_grade)
+                    
+                    with tracer.span("retrieve_textbook_pages") as sp:
+                        hits = retrieve_textbook_pages(" ".join(m.get("content", "") for m in st.session_state.messages[-3:] if m.get("role") == "user"), books)
+                        sp.attrs["hits"] = len(hits) if hits is not None else None
+                    if hits:
+                        cache_name = None
+                        st.caption(f"📚 **Reading Textbooks:** {excerpt_citations(hits)}")
+                        curr_parts.extend(excerpt_parts(hits))
+                    else:
+                        cache_name = get_cached_bundle("gemini-3.1-flash-lite-preview", SYSTEM_INSTRUCTION, books, tools=CHAT_TOOLS)
+                        if books:
+                            st.caption(f"📚 **Reading Textbooks:** {', '.join([get_friendly_name(b.display_name) for b in books])}")
+                            if not cache_name: curr_parts.extend(textbook_parts(books))
+                    
+                    if f_bytes and is_image_mime(mime): curr_parts.append(types.Part.from_bytes(data=f_bytes, mime_type=mime))
+                    elif attachment:
+                        with tracer.span("attachment_upload"): curr_parts.append(types.Part.from_uri(file_uri=attachment.result()["uri"], mime_type="application/pdf"))
+
+                    source = "the textbook excerpts above and any attached files. You MUST use the book's facts and terminology and cite pages as [Book, p. N]" if hits else "the attached Cambridge textbooks and files. You MUST use the book's facts and terminology"
+                    curr_parts.append(types.Part.from_text(text=f"Please analyze {source}.\n\nUser Query: {msg_data.get('content')}"))
+                    
+                    chat_kwargs = dict(
+                        model="gemini-3.1-flash-lite-preview",
+                        contents=valid_history +[types.Content(role="user", parts=curr_parts)],
+                        config=types.GenerateContentConfig(cached_content=cache_name, temperature=0.3) if cache_name else types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, temperature=0.3, tools=CHAT_TOOLS)
+                    )
+                    out, san, visual_jobs = st.empty(), StreamSanitizer(), {}
+                    chat_model = chat_kwargs["model"]
+                    # Visual jobs start as soon as their directive line is complete, while the rest of the answer streams in.
+                    with tracer.span("model_call", model=chat_model) as sp:
+                        for chunk in (model_scheduler.stream(chat_model, lambda: client.models.generate_content_stream(**chat_kwargs), session=session_id, on_start=sp.slot_acquired) if STREAM_CHAT else [model_scheduler.call(chat_model, lambda: client.models.generate_content(**chat_kwargs), session=session_id, on_start=sp.slot_acquired)]):
+                            sp.attrs.setdefault("first_chunk", round(time.perf_counter() - sp.start - sp.attrs.get("queued", 0.0), 3))
+                            for vp in san.feed(safe_response_text(chunk)): submit_visual(visual_jobs, vp, session_id)
+                            if vis := san.visible().strip(): think.empty(); out.markdown(vis + " ▌")
+                    for vp in san.finish(): submit_visual(visual_jobs, vp, session_id)
+                    bot_txt = san.raw or "⚠️ *Failed to generate text.*"
+                    
+                    # Single-pass extraction: display text without the analytics tail, markers or lead-in prose
+                    pdf_ready = "[PDF_READY]" in bot_txt.upper()
+                    bot_txt, ad = sanitize_response(bot_txt)
+                    bot_txt = bot_txt or "⚠️ *Failed to generate text.*"
+                    if ad and is_authenticated and db:
+                        try: submit_analytics(user_email, ad)
+                        except Exception as e: print(f"Analytics Write Error: {e}")
+
+                    think.empty()
+                    
+                    imgs, mods = [],[]
+                    if v_prompts := VISUAL_DIRECTIVE_RE.findall(bot_txt):
+                        with tracer.span("visuals", count=len(v_prompts)):
+                            for r in run_visual_jobs(v_prompts, visual_jobs, session_id):
+                                if r and r[0]: imgs.append(r[0]); mods.append(r[1])
+                                else: imgs.append(None); mods.append("Failed")
+                    
+                    dl = bool(pdf_ready or (re.search(r"##\s*Mark Scheme", bot_txt, re.IGNORECASE) and re.search(r"\[\d+\]", bot_txt)))
+                    st.session_state.messages.append({"role": "assistant", "content": bot_txt, "display": bot_txt, "is_downloadable": dl, "image_keys": [payload_put(i) for i in imgs], "image_models": mods})
+                    
+                    with tracer.span("save_chat_history"): save_chat_history()
+                    st.rerun() # raises a control-flow BaseException; the trace still closes on the way out
+                    
+                except Exception as e: think.empty(); st.error(f"Error: {e}")
@@ -0,0 +1,167 @@
+"""Offline benchmark of app.py's hot paths against the stand-ins in bench/fakes.py (no Google services needed).
+
+Runs the real script through streamlit's AppTest:
+  chat   a student thread grown turn by turn (chat turn, visuals, save_chat_history), one row per turn
+  paper  a teacher's "Generate with Helix AI" job, from the paper call through visuals and image storage
+  pure   create_pdf, md_inline_to_rl and the sanitizer on the papers in bench/corpus
+Stage p50/p95 come from the app's own traces (TRACE_JSONL), Firestore reads / writes / bytes from FakeFirestore.
+Run from the repo root:  python bench/bench_app.py [--turns 8] [--scale 3] [--latency 0.05] [--json out.json]
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import streamlit as st  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+from google import genai  # noqa: E402
+from google.cloud import firestore  # noqa: E402
+from google.oauth2 import service_account  # noqa: E402
+
+from fakes import FakeFirestore, FakeGenaiClient, fake_transactional, fake_user  # noqa: E402
+from bench_pdf import model_render, best_ms  # noqa: E402
+from tracing import percentile, walk  # noqa: E402
+from pdf_render import create_pdf, md_inline_to_rl  # noqa: E402
+from sanitizer import VISUAL_DIRECTIVE_RE, StreamSanitizer, sanitize_response, clean_display  # noqa: E402
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+STUDENT, TEACHER = "student@example.com", "teacher@example.com"
+ANALYTICS = '\n\n===ANALYTICS_START===\n{"subject": "Math", "grade": "Grade 7", "chapter_number": 4, "chapter_name": "Fractions", "score": 80, "weak_point": "Adding unlike fractions", "question_asked": "Make me a paper"}\n===ANALYTICS_END==='
+
+def corpus(scale):
+    return {p.stem: "\n".join([p.read_text()] * scale) for p in sorted(CORPUS.glob("*.md"))}
+
+def offline(db, gclient, user):
+    # Every Google entry point app.py touches, pointed at the in-memory stand-ins for the whole process
+    stack = ExitStack()
+    stack.enter_context(mock.patch.object(genai, "Client", lambda *a, **kw: gclient))
+    stack.enter_context(mock.patch.object(firestore, "Client", lambda *a, **kw: db))
+    stack.enter_context(mock.patch.object(firestore, "transactional", fake_transactional))
+    stack.enter_context(mock.patch.object(service_account.Credentials, "from_service_account_info", lambda info: None))
+    stack.enter_context(mock.patch.object(st, "user", user, create=True))
+    return stack
+
+def app_test(args, trace_path):
+    at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=args.timeout)
+    at.secrets["GOOGLE_API_KEY"], at.secrets["firebase"], at.secrets["TRACE_JSONL"] = "bench", {"project_id": "bench"}, str(trace_path)
+    return at
+
+def delta(db, gclient, before):
+    stats, calls = db.stats.snapshot(), len(gclient.calls)
+    return {**{k: stats[k] - before[0][k] for k in stats}, "model_calls": calls - before[1]}
+
+def mark(db, gclient):
+    return db.stats.snapshot(), len(gclient.calls)
+
+def trace_stats(path, names):
+    rows = {}
+    for line in path.read_text().splitlines() if path.exists() else []:
+        t = json.loads(line)
+        if t["name"] not in names: continue
+        rows.setdefault((t["name"], "(total)"), []).append(t["duration"])
+        for s in walk(t.get("spans", ())): rows.setdefault((t["name"], s["name"]), []).append(s["duration"])
+    return [{"trace": k[0], "stage": k[1], "count": len(v), "p50_ms": percentile(v, 50) * 1000, "p95_ms": percentile(v, 95) * 1000} for k, v in sorted(rows.items())]
+
+def thread_bytes(db, email):
+    return sum(len(json.dumps(d, default=str)) for p, d in db._docs.items() if p.startswith(f"users/{email}/threads/"))
+
+def run_chat(args, db, gclient, trace_path):
+    rows = []
+    with offline(db, gclient, fake_user(STUDENT)):
+        at = app_test(args, trace_path); at.run()
+        for turn in range(args.turns):
+            before, t0 = mark(db, gclient), time.perf_counter()
+            at.chat_input[0].set_value(f"Question {turn + 1}: make me a practice paper on fractions with diagrams").run()
+            if at.exception: raise RuntimeError(at.exception[0].message)
+            rows.append({"turn": turn + 1, "ms": (time.perf_counter() - t0) * 1000, **delta(db, gclient, before), "thread_kb": thread_bytes(db, STUDENT) / 1024})
+    return rows
+
+def run_paper(args, db, gclient, trace_path):
+    db.collection("users").document(TEACHER).set({"role": "teacher", "display_name": "Bench Teacher", "school": None, "grade": "Grade 7"})
+    with offline(db, gclient, fake_user(TEACHER, "Bench Teacher")):
+        at = app_test(args, trace_path); at.run()
+        next(r for r in at.radio if r.label == "Menu").set_value("Assign Papers").run()
+        next(n for n in at.number_input if n.label.startswith("Variants")).set_value(args.variants).run()
+        before, t0 = mark(db, gclient), time.perf_counter()
+        next(b for b in at.button if "Generate with Helix AI" in b.label).click().run()
+        jobs = db.collection("paper_jobs").where(filter=firestore.FieldFilter("teacher", "==", TEACHER))
+        while time.perf_counter() - t0 < args.timeout:
+            states = [d["status"] for p, d in list(db._docs.items()) if p.startswith("paper_jobs/") and d.get("teacher") == TEACHER]
+            if states and all(s in ("done", "failed") for s in states): break
+            time.sleep(0.05)
+        ms = (time.perf_counter() - t0) * 1000
+        done = [j.to_dict() for j in jobs.stream()]
+    return {"jobs": len(done), "failed": sum(1 for j in done if j["status"] != "done"), "ms": ms, **delta(db, gclient, before)}
+
+def run_pure(args):
+    rows = []
+    for name, paper in corpus(args.scale).items():
+        lines, reply = paper.split("\n"), paper + ANALYTICS
+        images = [model_render(i) for i in range(len(VISUAL_DIRECTIVE_RE.findall(paper)))]
+        chunks = [reply[i:i + 64] for i in range(0, len(reply), 64)]
+
+        def stream():
+            san = StreamSanitizer()
+            for c in chunks: san.feed(c); san.visible()
+            return san.finish()
+        rows.append({"paper": name, "kb": len(paper) / 1024, "imgs": len(images),
+                     "inline_ms": best_ms(lambda: [md_inline_to_rl(l) for l in lines], args.repeat * 10)[0],
+                     "sanitize_ms": best_ms(lambda: sanitize_response(reply), args.repeat * 10)[0],
+                     "display_ms": best_ms(lambda: clean_display(reply), args.repeat * 10)[0],
+                     "stream_ms": best_ms(stream, args.repeat)[0],
+                     "pdf_ms": best_ms(lambda: create_pdf(paper, images), args.repeat)[0]})
+    return rows
+
+def table(rows, cols):
+    print("".join(f"{c:>{w}}" for c, w, _ in cols))
+    for r in rows: print("".join(f"{r[c]:>{w}{f}}" for c, w, f in cols))
+    print()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", choices=["chat", "paper", "pure"], action="append")
+    ap.add_argument("--turns", type=int, default=8)
+    ap.add_argument("--variants", type=int, default=2)
+    ap.add_argument("--scale", type=int, default=3, help="concatenate each corpus paper this many times")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per fake text / image call")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--json", help="also write every result to this file")
+    args = ap.parse_args()
+    only = set(args.only or ["chat", "paper", "pure"])
+
+    out = {"args": vars(args)}
+    if only & {"chat", "paper"}:
+        papers = corpus(args.scale)
+        FakeGenaiClient.configure(latency={"text": args.latency, "image": args.latency, "upload": 0.0}, chat_text=papers["math_grade7"] + ANALYTICS, paper_text=papers["science_grade8"] + "\n[PDF_READY]")
+        db, gclient = FakeFirestore(), FakeGenaiClient()
+        gclient.image_bytes = model_render(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        trace_path = Path(tmp) / "traces.jsonl"
+        if "chat" in only:
+            out["chat"] = run_chat(args, db, gclient, trace_path)
+            print("CHAT TURNS")
+            table(out["chat"], [("turn", 6, "d"), ("ms", 10, ".0f"), ("reads", 8, "d"), ("writes", 8, "d"), ("bytes_written", 15, "d"), ("bytes_read", 12, "d"), ("model_calls", 13, "d"), ("thread_kb", 11, ".1f")])
+        if "paper" in only:
+            out["paper"] = run_paper(args, db, gclient, trace_path)
+            print("PAPER JOBS")
+            table([out["paper"]], [("jobs", 6, "d"), ("failed", 8, "d"), ("ms", 10, ".0f"), ("reads", 8, "d"), ("writes", 8, "d"), ("bytes_written", 15, "d"), ("model_calls", 13, "d")])
+        if only & {"chat", "paper"}:
+            out["stages"] = trace_stats(trace_path, {"send_message", "chat_turn", "chat_title", "history_summary", "analytics_write", "visual", "paper_job", "upload_textbooks"})
+            print("STAGES (from app traces)")
+            table(out["stages"], [("trace", 18, ""), ("stage", 26, ""), ("count", 7, "d"), ("p50_ms", 10, ".1f"), ("p95_ms", 10, ".1f")])
+            out["model_calls"] = gclient.call_counts()
+    if "pure" in only:
+        out["pure"] = run_pure(args)
+        print(f"PURE HELPERS (best of {args.repeat})")
+        table(out["pure"], [("paper", 16, ""), ("kb", 7, ".1f"), ("imgs", 6, "d"), ("inline_ms", 11, ".2f"), ("sanitize_ms", 13, ".2f"), ("display_ms", 12, ".2f"), ("stream_ms", 11, ".2f"), ("pdf_ms", 9, ".0f")])
+    if args.json: Path(args.json).write_text(json.dumps(out, indent=1, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark: pdf_render.create_pdf vs the old per-call-styles renderer on the papers in bench/corpus.
+
+Every IMAGE_GEN / PIE_CHART slot gets a 2048x1536 render, the size the image models return.
+Run from the repo root:  python bench/bench_pdf.py [--repeat 3] [--scale 3]
+"""
+import re
+import sys
+import time
+import argparse
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from pdf_render import create_pdf, md_inline_to_rl  # noqa: E402
+from sanitizer import VISUAL_DIRECTIVE_RE  # noqa: E402
+
+from reportlab.lib.pagesizes import A4  # noqa: E402
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle  # noqa: E402
+from reportlab.lib.units import inch  # noqa: E402
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle  # noqa: E402
+from reportlab.lib.utils import ImageReader  # noqa: E402
+from reportlab.lib.enums import TA_LEFT, TA_CENTER  # noqa: E402
+from reportlab.lib import colors  # noqa: E402
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+
+def old_md_inline_to_rl(text: str) -> str:
+    # As it was in app.py before pdf_render.py
+    s = (text or "").replace(r'\(', '').replace(r'\)', '').replace(r'\[', '').replace(r'\]', '').replace(r'\times', ' x ').replace(r'\div', ' ÷ ').replace(r'\circ', '°').replace(r'\pm', '±').replace(r'\leq', '≤').replace(r'\geq', '≥').replace(r'\neq', '≠').replace(r'\approx', '≈').replace(r'\pi', 'π').replace(r'\sqrt', '√').replace('\\', '')
+    s = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'\1/\2', s)
+    s = s.replace('$', '')
+    return re.sub(r"(?<!\*)\*(\S.+?)\*(?!\*)", r"<i>\1</i>", re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")))
+
+def old_create_pdf(content: str, images=None):
+    buffer = BytesIO(); doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=0.75*inch, leftMargin=0.75*inch, topMargin=0.75*inch, bottomMargin=0.75*inch)
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle("CustomTitle", parent=styles["Heading1"], fontSize=18, textColor=colors.HexColor("#00d4ff"), spaceAfter=12, alignment=TA_CENTER, fontName="Helvetica-Bold")
+    body_style = ParagraphStyle("CustomBody", parent=styles["BodyText"], fontSize=11, spaceAfter=8, alignment=TA_LEFT, fontName="Helvetica")
+    story, img_idx, table_rows = [], 0, []
+
+    def render_pending_table():
+        nonlocal table_rows
+        if not table_rows: return
+        ncols = max(len(r) for r in table_rows)
+        t = Table([[Paragraph(old_md_inline_to_rl(c), body_style) for c in list(r) + [""] * (ncols - len(r))] for r in table_rows], colWidths=[doc.width / max(1, ncols)] * ncols)
+        t.setStyle(TableStyle([("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#00d4ff")), ("GRID", (0, 0), (-1, -1), 0.5, colors.grey)]))
+        story.extend([t, Spacer(1, 0.18*inch)]); table_rows = []
+
+    for s in [re.sub(r"\s*\(Source:.*?\)", "", l).strip() for l in content.split("\n") if "[PDF_READY]" not in l.upper()]:
+        if s.startswith("|") and s.endswith("|") and s.count("|") >= 2:
+            cells = [c.strip() for c in s.split("|")[1:-1]]
+            if not all(re.fullmatch(r":?-+:?", c) for c in cells if c): table_rows.append(cells)
+            continue
+        render_pending_table()
+        if not s: story.append(Spacer(1, 0.14*inch)); continue
+        if s.startswith(("IMAGE_GEN:", "PIE_CHART:")):
+            if images and img_idx < len(images) and images[img_idx]:
+                img_stream = BytesIO(images[img_idx]); iw, ih = ImageReader(img_stream).getSize()
+                story.extend([Spacer(1, 0.12*inch), RLImage(img_stream, width=4.6*inch, height=4.6*inch*(ih/float(iw))), Spacer(1, 0.12*inch)])
+            img_idx += 1; continue
+        if s.startswith("# "): story.append(Paragraph(old_md_inline_to_rl(s[2:].strip()), title_style))
+        elif s.startswith("## "): story.append(Paragraph(old_md_inline_to_rl(s[3:].strip()), ParagraphStyle("CustomHeading", parent=styles["Heading2"], fontSize=14, spaceAfter=10, spaceBefore=10, fontName="Helvetica-Bold")))
+        elif s.startswith("### "): story.append(Paragraph(f"<b>{old_md_inline_to_rl(s[4:].strip())}</b>", body_style))
+        else: story.append(Paragraph(old_md_inline_to_rl(s), body_style))
+    render_pending_table()
+    doc.build(story); buffer.seek(0)
+    return buffer
+
+def model_render(i: int) -> bytes:
+    img = Image.new("RGB", (2048, 1536), "white"); d = ImageDraw.Draw(img)
+    for x in range(0, 2048, 64): d.line([(x, 0), (x, 1536)], fill=(200, 200, 200), width=2)
+    for y in range(0, 1536, 64): d.line([(0, y), (2048, y)], fill=(200, 200, 200), width=2)
+    d.polygon([(300 + i * 40, 300), (1200, 400 + i * 30), (700, 1200)], outline=(0, 120, 200), width=8)
+    buf = BytesIO(); img.save(buf, format="PNG"); return buf.getvalue()
+
+def best_ms(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter(); out = fn(); best = min(best, time.perf_counter() - t0)
+    return best * 1000, out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--scale", type=int, default=1, help="concatenate each paper this many times")
+    args = ap.parse_args()
+    print(f"{'paper':<20}{'lines':>7}{'imgs':>6}{'old inline ms':>15}{'new inline ms':>15}{'old pdf ms':>12}{'new pdf ms':>12}{'old KB':>9}{'new KB':>9}")
+    for path in sorted(CORPUS.glob("*.md")):
+        paper = "\n".join([path.read_text()] * args.scale)
+        lines, images = paper.split("\n"), [model_render(i) for i in range(len(VISUAL_DIRECTIVE_RE.findall(paper)))]
+        old_inline, _ = best_ms(lambda: [old_md_inline_to_rl(l) for l in lines], args.repeat * 10)
+        new_inline, _ = best_ms(lambda: [md_inline_to_rl(l) for l in lines], args.repeat * 10)
+        old_pdf, old_buf = best_ms(lambda: old_create_pdf(paper, images), args.repeat)
+        new_pdf, new_buf = best_ms(lambda: create_pdf(paper, images), args.repeat)
+        print(f"{path.stem:<20}{len(lines):>7}{len(images):>6}{old_inline:>15.2f}{new_inline:>15.2f}{old_pdf:>12.0f}{new_pdf:>12.0f}{len(old_buf.getvalue()) // 1024:>9}{len(new_buf.getvalue()) // 1024:>9}")
+
+if __name__ == "__main__":
+    main()
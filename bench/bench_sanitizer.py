@@ -0,0 +1,80 @@
+"""Micro-benchmark: single-pass sanitizer vs the old regex cascade on ~50 KB practice papers.
+
+Run from the repo root:  python bench/bench_sanitizer.py [--kb 50] [--repeat 20]
+"""
+import re
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from sanitizer import sanitize_response  # noqa: E402
+
+ANALYTICS = {"subject": "Math", "grade": "Grade 7", "chapter_number": 4, "chapter_name": "Fractions", "score": 85, "weak_point": "Adding unlike fractions", "question_asked": "Make me a paper"}
+
+def old_extract(bot_txt):
+    # Chat-turn extraction as it was before sanitizer.py
+    ad = None
+    match_full = re.search(r"===ANALYTICS_START===(.*?)===ANALYTICS_END===", bot_txt, flags=re.IGNORECASE|re.DOTALL)
+    if not match_full:
+        match_full = re.search(r"(?:(?:Here is the )?Analytics.*?:?\s*|```json\s*)?(\{[\s\S]*?\"weak_point\"[\s\S]*?\})(?:\s*```)?", bot_txt, flags=re.IGNORECASE)
+    if match_full:
+        try:
+            ad = json.loads(match_full.group(1))
+            bot_txt = bot_txt[:match_full.start()].strip()
+            bot_txt = re.sub(r"(?i)(?:Here is the )?(?:Analytics|JSON).*?(?:for student)?s?\s*[:-]?\s*$", "", bot_txt).strip()
+        except Exception: pass
+    return bot_txt, ad
+
+def old_display(disp):
+    # Renderer sweep as it was before sanitizer.py (ran for every message on every rerun)
+    disp = re.sub(r"(?i)(?:Here is the )?(?:Analytics|JSON).*?(?:for student)?s?\s*[:-]?\s*", "", disp)
+    disp = re.sub(r"===ANALYTICS_START===.*?===ANALYTICS_END===", "", disp, flags=re.IGNORECASE|re.DOTALL)
+    disp = re.sub(r"```json\s*\{[^{]*?\"weak_point\".*?\}\s*```", "", disp, flags=re.IGNORECASE|re.DOTALL)
+    disp = re.sub(r"\{[^{]*?\"weak_point\".*?\}", "", disp, flags=re.IGNORECASE|re.DOTALL)
+    return re.sub(r"\[PDF_READY\]", "", disp, flags=re.IGNORECASE).strip()
+
+def make_paper(kb: int) -> str:
+    q, lines = 0, ["## Section A: Fractions and Algebra", ""]
+    while sum(len(l) + 1 for l in lines) < kb * 1024 * 0.7: # mark scheme fills the rest
+        q += 1
+        lines += [f"**Q{q}.** Simplify $\\frac{{{q}}}{{{q + 3}}} + \\frac{{2}}{{{q + 5}}}$ and explain each step of your working. [3]",
+                  f"   a) Write the answer as a mixed number {{if possible}}. [1]",
+                  f"   IMAGE_GEN: [Number line from 0 to {q} with fractions marked]" if q % 25 == 0 else "", ""]
+    lines += ["## Mark Scheme"] + [f"{i}. Correct common denominator (M1), final answer (A1). [2]" for i in range(1, q + 1)]
+    return "\n".join(lines)
+
+def variants(kb: int):
+    # name -> (reply, payload the sanitizer must recover)
+    paper = make_paper(kb)
+    return {
+        "marked block": (paper + "\n[PDF_READY]\n\n===ANALYTICS_START===\n" + json.dumps(ANALYTICS, indent=2) + "\n===ANALYTICS_END===", ANALYTICS),
+        "leaked fence": (paper + "\n[PDF_READY]\n\nHere is the analytics for the student:\n```json\n" + json.dumps(ANALYTICS) + "\n```", ANALYTICS),
+        "truncated json": (paper + '\n[PDF_READY]\n\n{"subject": "Math", "weak_point": "Adding unlike', None),
+        "no analytics": (paper + "\n[PDF_READY]", None),
+    }
+
+def timed(fn, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter(); fn(text); best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--kb", type=int, default=50)
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+    print(f"{'case':<16}{'size':>8}{'old turn ms':>13}{'old render ms':>15}{'new ms':>9}{'speedup':>9}")
+    for name, (text, expected) in variants(args.kb).items():
+        old_turn = timed(old_extract, text, args.repeat)
+        old_render = timed(old_display, old_extract(text)[0], args.repeat)
+        new = timed(sanitize_response, text, args.repeat)
+        clean, payload = sanitize_response(text)
+        assert payload == expected and "[PDF_READY]" not in clean and "weak_point" not in clean, name
+        print(f"{name:<16}{len(text) // 1024:>6}KB{old_turn:>13.2f}{old_render:>15.2f}{new:>9.2f}{(old_turn + old_render) / new:>8.1f}x  old payload {'ok' if old_extract(text)[1] == expected else 'MISSED'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""Offline stand-ins for the Google services app.py talks to.
+
+FakeFirestore implements the subset of the google-cloud-firestore surface the app uses (collections, documents,
+where/order_by/cursors, stream, count aggregations, batches, bulk writers, transactions, recursive deletes) on top of
+an in-memory dict, and counts reads, writes and bytes. FakeGenaiClient returns canned text, image and Files API
+responses with configurable latency.
+"""
+import copy
+import itertools
+import json
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.genai import types
+
+# -----------------------------
+# FIRESTORE
+# -----------------------------
+@dataclass
+class FirestoreStats:
+    reads: int = 0
+    writes: int = 0
+    deletes: int = 0
+    bytes_written: int = 0
+    bytes_read: int = 0
+    queries: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **kw):
+        with self.lock:
+            for k, v in kw.items(): setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self):
+        return {k: getattr(self, k) for k in ("reads", "writes", "deletes", "bytes_written", "bytes_read", "queries")}
+
+def _doc_bytes(data):
+    return len(json.dumps(data, default=lambda o: f"<{len(o)}b>" if isinstance(o, bytes) else str(o)).encode()) + sum(
+        len(v) for v in _walk(data) if isinstance(v, bytes))
+
+def _walk(v):
+    if isinstance(v, dict):
+        for x in v.values(): yield from _walk(x)
+    elif isinstance(v, list):
+        for x in v: yield from _walk(x)
+    else: yield v
+
+def _get_path(data, dotted):
+    cur = data
+    for part in dotted.split("."):
+        if not isinstance(cur, dict) or part not in cur: return None
+        cur = cur[part]
+    return cur
+
+def _apply_value(old, new):
+    if new is transforms.DELETE_FIELD: return _DELETE
+    if isinstance(new, transforms.ArrayUnion): return list(old or []) + [v for v in new.values if v not in (old or [])]
+    if isinstance(new, transforms.ArrayRemove): return [v for v in (old or []) if v not in new.values]
+    if isinstance(new, transforms.Increment): return (old or 0) + new.value
+    if new is transforms.SERVER_TIMESTAMP: return time.time()
+    return copy.deepcopy(new)
+
+_DELETE = object()
+
+def _merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict): _merge(dst[k], v)
+        elif isinstance(v, dict): dst[k] = {}; _merge(dst[k], v)
+        else:
+            nv = _apply_value(dst.get(k), v)
+            if nv is _DELETE: dst.pop(k, None)
+            else: dst[k] = nv
+
+def _strip_transforms(src):
+    out = {}
+    for k, v in src.items():
+        if isinstance(v, dict): out[k] = _strip_transforms(v)
+        elif v is transforms.DELETE_FIELD: continue
+        else: out[k] = _apply_value(None, v)
+    return out
+
+class FakeSnapshot:
+    def __init__(self, ref, data):
+        self.reference, self._data = ref, data
+
+    id = property(lambda self: self.reference.id)
+    exists = property(lambda self: self._data is not None)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return _get_path(self._data or {}, field_path)
+
+class FakeDocRef:
+    def __init__(self, db, path):
+        self._db, self.path = db, path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollection(self._db, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def collections(self):
+        prefix, depth = self.path + "/", self.path.count("/") + 1
+        names = sorted({p.split("/")[depth] for p in self._db._docs if p.startswith(prefix)})
+        return [self.collection(n) for n in names]
+
+    def get(self, transaction=None, field_paths=None):
+        data = self._db._docs.get(self.path)
+        self._db.stats.add(reads=1, bytes_read=_doc_bytes(data) if data else 0)
+        return FakeSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data, merge=False):
+        self._db._write(self.path, data, merge=merge)
+
+    def update(self, data):
+        if self.path not in self._db._docs: raise KeyError(f"No document to update: {self.path}")
+        nested = {}
+        for k, v in data.items():
+            cur = nested
+            parts = k.split(".")
+            for p in parts[:-1]: cur = cur.setdefault(p, {})
+            cur[parts[-1]] = v
+        self._db._write(self.path, nested, merge=True)
+
+    def create(self, data):
+        if self.path in self._db._docs: raise ValueError("Document already exists")
+        self.set(data)
+
+    def delete(self):
+        self._db._delete(self.path)
+
+    def __eq__(self, other): return isinstance(other, FakeDocRef) and other.path == self.path
+    def __hash__(self): return hash(self.path)
+
+class FakeAggregation:
+    def __init__(self, query, alias):
+        self._query, self._alias = query, alias
+
+    def get(self, transaction=None):
+        n = sum(1 for _ in self._query._matches())
+        self._query._db.stats.add(reads=max(1, (n + 999) // 1000), queries=1)
+        return [[SimpleNamespace(alias=self._alias, value=n)]]
+
+class FakeQuery:
+    def __init__(self, db, path, filters=(), orders=(), limit=None, start=None, end=None, projection=None):
+        self._db, self._path = db, path
+        self._filters, self._orders, self._limit = list(filters), list(orders), limit
+        self._start, self._end, self._projection = start, end, projection
+
+    def _copy(self, **kw):
+        d = dict(filters=self._filters, orders=self._orders, limit=self._limit, start=self._start, end=self._end, projection=self._projection)
+        d.update(kw)
+        return FakeQuery(self._db, self._path, **d)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None: field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        name = "__name__" if field_path == FieldPath.document_id() or field_path == "__name__" else field_path
+        return self._copy(orders=self._orders + [(name, direction)])
+
+    def limit(self, n): return self._copy(limit=n)
+    def select(self, field_paths): return self._copy(projection=list(field_paths))
+    def start_at(self, values): return self._copy(start=(values, True))
+    def start_after(self, values): return self._copy(start=(values, False))
+    def end_at(self, values): return self._copy(end=(values, True))
+    def end_before(self, values): return self._copy(end=(values, False))
+    def count(self, alias=None): return FakeAggregation(self, alias)
+
+    def _value(self, path, data, name):
+        if name == "__name__": return path.rsplit("/", 1)[-1]
+        return _get_path(data, name)
+
+    def _cursor_key(self, values):
+        if isinstance(values, FakeSnapshot):
+            return tuple(self._value(values.reference.path, values._data or {}, n) for n, _ in self._orders)
+        if isinstance(values, dict): values = [values[n] for n, _ in self._orders]
+        return tuple(v.id if isinstance(v, FakeDocRef) else v for v in values)
+
+    def _matches(self):
+        depth = self._path.count("/") + 1
+        rows = []
+        for p, data in list(self._db._docs.items()):
+            if not p.startswith(self._path + "/") or p.count("/") != depth: continue
+            if all(self._test(self._value(p, data, f), op, v) for f, op, v in self._filters): rows.append((p, data))
+        orders = self._orders or [("__name__", "ASCENDING")]
+        for name, direction in reversed(orders):
+            rows.sort(key=lambda r: (self._value(r[0], r[1], name) is None, self._value(r[0], r[1], name) or 0) if not isinstance(self._value(r[0], r[1], name), str) else (False, self._value(r[0], r[1], name)),
+                      reverse=direction in ("DESCENDING", "desc"))
+        keyed = [(tuple(self._value(p, d, n) for n, _ in self._orders), p, d) for p, d in rows]
+        if self._start:
+            k, incl = self._cursor_key(self._start[0]), self._start[1]
+            desc = self._orders and self._orders[0][1] in ("DESCENDING", "desc")
+            keyed = [r for r in keyed if (r[0][:len(k)] >= k if not desc else r[0][:len(k)] <= k) and (incl or r[0][:len(k)] != k)]
+        if self._end:
+            k, incl = self._cursor_key(self._end[0]), self._end[1]
+            keyed = [r for r in keyed if r[0][:len(k)] <= k and (incl or r[0][:len(k)] != k)]
+        for _, p, d in keyed[: self._limit] if self._limit is not None else keyed: yield p, d
+
+    @staticmethod
+    def _test(actual, op, value):
+        try:
+            if op == "==": return actual == value
+            if op == "!=": return actual != value
+            if op == "array_contains": return value in (actual or [])
+            if op == "array_contains_any": return any(v in (actual or []) for v in value)
+            if op == "in": return actual in value
+            if op == "not-in": return actual not in value
+            if op == "<": return actual is not None and actual < value
+            if op == "<=": return actual is not None and actual <= value
+            if op == ">": return actual is not None and actual > value
+            if op == ">=": return actual is not None and actual >= value
+        except TypeError: return False
+        raise NotImplementedError(op)
+
+    def stream(self, transaction=None):
+        self._db.stats.add(queries=1)
+        rows = list(self._matches())
+        if not rows: self._db.stats.add(reads=1)
+        for p, data in rows:
+            out = {k: copy.deepcopy(data[k]) for k in self._projection if k in data} if self._projection is not None else copy.deepcopy(data)
+            self._db.stats.add(reads=1, bytes_read=_doc_bytes(out))
+            yield FakeSnapshot(FakeDocRef(self._db, p), out)
+
+    def get(self, transaction=None): return list(self.stream())
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeDocRef(self._db, self._path.rsplit("/", 1)[0]) if "/" in self._path else None
+
+    def document(self, doc_id=None):
+        return FakeDocRef(self._db, f"{self._path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return time.time(), ref
+
+    def list_documents(self):
+        depth = self._path.count("/") + 1
+        return [FakeDocRef(self._db, p) for p in list(self._db._docs) if p.startswith(self._path + "/") and p.count("/") == depth]
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db, self._ops = db, []
+
+    def set(self, ref, data, merge=False): self._ops.append(lambda: ref.set(data, merge=merge))
+    def update(self, ref, data): self._ops.append(lambda: ref.update(data))
+    def delete(self, ref): self._ops.append(ref.delete)
+    def create(self, ref, data): self._ops.append(lambda: ref.create(data))
+    def __len__(self): return len(self._ops)
+
+    def commit(self):
+        if len(self._ops) > 500: raise ValueError("maximum 500 writes allowed per request")
+        with self._db._lock:
+            for op in self._ops: op()
+        self._ops = []
+
+class FakeBulkWriter(FakeBatch):
+    def commit(self):
+        with self._db._lock:
+            for op in self._ops: op()
+        self._ops = []
+
+    flush = close = commit
+
+class FakeTransaction(FakeBatch):
+    pass
+
+class FakeFirestore:
+    def __init__(self, *args, **kwargs):
+        self._docs, self._lock, self.stats = {}, threading.RLock(), FirestoreStats()
+
+    def collection(self, name): return FakeCollection(self, name)
+    def document(self, path): return FakeDocRef(self, path)
+    def batch(self): return FakeBatch(self)
+    def bulk_writer(self, **kw): return FakeBulkWriter(self)
+    def transaction(self, **kw): return FakeTransaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for ref in list(references): yield ref.get()
+
+    def recursive_delete(self, reference, bulk_writer=None, chunk_size=5000):
+        prefix = reference.path if isinstance(reference, FakeDocRef) else reference._path
+        with self._lock:
+            doomed = [p for p in self._docs if p == prefix or p.startswith(prefix + "/")]
+            for p in doomed: self._delete(p)
+        return len(doomed)
+
+    def _write(self, path, data, merge=False):
+        with self._lock:
+            if merge and path in self._docs: _merge(self._docs[path], data)
+            elif merge: self._docs[path] = {}; _merge(self._docs[path], data)
+            else: self._docs[path] = _strip_transforms(data)
+            self.stats.add(writes=1, bytes_written=_doc_bytes(data))
+
+    def _delete(self, path):
+        with self._lock:
+            if self._docs.pop(path, None) is not None: self.stats.add(deletes=1)
+
+def fake_transactional(fn):
+    # Stand-in for firestore.transactional: run once with a transaction whose writes commit on success.
+    def run(transaction, *args, **kwargs):
+        result = fn(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+    return run
+
+# -----------------------------
+# GEMINI
+# -----------------------------
+def _png(w=64, h=48, color=(0, 212, 255)):
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", (w, h), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+def _text_response(text):
+    return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))])
+
+class FakeModels:
+    def __init__(self, client):
+        self._c = client
+
+    def _sleep(self, kind):
+        time.sleep(self._c.latency.get(kind, 0))
+
+    def _pick_text(self, model, contents, config):
+        system = str(getattr(config, "system_instruction", "") or "")
+        cached = getattr(config, "cached_content", None)
+        flat = json.dumps([str(c) for c in (contents if isinstance(contents, list) else [contents])])
+        if "question paper" in flat or "PDF_READY" in system and "Task:" in flat or (cached and "paper" in str(cached)):
+            return self._c.paper_text
+        if "short chat title" in flat: return "Fractions Practice Help"
+        if "Summarize" in flat or "summary" in flat.lower() and "conversation" in flat.lower(): return "Student practised fractions and ratio problems."
+        return self._c.chat_text
+
+    def generate_content(self, model, contents, config=None):
+        self._c.record("generate_content", model)
+        if config is not None and getattr(config, "response_modalities", None) == ["IMAGE"]:
+            self._sleep("image")
+            return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(inline_data=types.Blob(data=self._c.image_bytes, mime_type="image/png"))]))])
+        self._sleep("text")
+        return _text_response(self._pick_text(model, contents, config))
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._c.record("generate_content_stream", model)
+        text = self._pick_text(model, contents, config)
+        n = max(1, self._c.stream_chunks)
+        step = max(1, len(text) // n)
+        for i in range(0, len(text), step):
+            time.sleep(self._c.latency.get("text", 0) / n)
+            yield _text_response(text[i:i + step])
+
+    def generate_images(self, model, prompt, config=None):
+        self._c.record("generate_images", model)
+        self._sleep("image")
+        return types.GenerateImagesResponse(generated_images=[types.GeneratedImage(image=types.Image(image_bytes=self._c.image_bytes, mime_type="image/png"))])
+
+    def count_tokens(self, model, contents, config=None):
+        self._c.record("count_tokens", model)
+        return types.CountTokensResponse(total_tokens=len(json.dumps([str(c) for c in contents])) // 4)
+
+class FakeFiles:
+    def __init__(self, client):
+        self._c, self._files = client, {}
+
+    def upload(self, file, config=None):
+        self._c.record("files.upload", None)
+        self._c.uploaded_bytes += len(file.getvalue()) if hasattr(file, "getvalue") else Path(file).stat().st_size
+        time.sleep(self._c.latency.get("upload", 0))
+        cfg = config if isinstance(config, dict) else (config.model_dump(exclude_none=True) if config else {})
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        f = types.File(name=name, uri=f"https://fake.googleapis.com/{name}", display_name=cfg.get("display_name") or name, mime_type=cfg.get("mime_type"),
+                       state=types.FileState.PROCESSING if self._c.processing_polls else types.FileState.ACTIVE)
+        self._files[name] = [f, self._c.processing_polls]
+        return f
+
+    upload_file = upload
+
+    def get(self, name):
+        self._c.record("files.get", None)
+        entry = self._files[name]
+        entry[1] -= 1
+        if entry[1] <= 0: entry[0] = entry[0].model_copy(update={"state": types.FileState.ACTIVE})
+        return entry[0]
+
+    def list(self, **kw):
+        self._c.record("files.list", None)
+        return [e[0] for e in self._files.values()]
+
+    def delete(self, name): self._files.pop(name, None)
+
+class FakeCaches:
+    def __init__(self, client):
+        self._c = client
+
+    def create(self, model, config=None):
+        self._c.record("caches.create", model)
+        from datetime import datetime, timedelta, timezone
+        kind = "paper" if "PDF_READY" in str(getattr(config, "system_instruction", "")) else "chat"
+        return types.CachedContent(name=f"cachedContents/{kind}-{uuid.uuid4().hex[:8]}", model=model, expire_time=datetime.now(timezone.utc) + timedelta(hours=1))
+
+    def update(self, name, config=None):
+        self._c.record("caches.update", None)
+        from datetime import datetime, timedelta, timezone
+        return types.CachedContent(name=name, expire_time=datetime.now(timezone.utc) + timedelta(hours=1))
+
+    def delete(self, name): self._c.record("caches.delete", None)
+
+class FakeGenaiClient:
+    """Drop-in for genai.Client; `configure` sets the canned responses and latencies shared by every instance."""
+    defaults = dict(latency={"text": 0.0, "image": 0.0, "upload": 0.0}, chat_text="Hello!", paper_text="# Helix A.I.\n[PDF_READY]", stream_chunks=20, processing_polls=0)
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        for k, v in self.defaults.items(): setattr(self, k, copy.deepcopy(v))
+        self.image_bytes, self.uploaded_bytes = _png(), 0
+        self.calls, self._lock = [], threading.Lock()
+        self.models, self.files, self.caches = FakeModels(self), FakeFiles(self), FakeCaches(self)
+        FakeGenaiClient.instances.append(self)
+
+    @classmethod
+    def configure(cls, **kw):
+        cls.defaults.update(kw)
+
+    def record(self, op, model):
+        with self._lock: self.calls.append((op, model, time.time()))
+
+    def call_counts(self):
+        out = {}
+        for op, model, _ in self.calls:
+            key = f"{op}:{model}" if model else op
+            out[key] = out.get(key, 0) + 1
+        return out
+
+def fake_user(email="student@example.com", name="Bench Student"):
+    return SimpleNamespace(is_logged_in=True, email=email, name=name)
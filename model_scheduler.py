@@ -0,0 +1,134 @@
+import time
+import random
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import CancelledError, Future
+
+# -----------------------------
+# MODEL CALL SCHEDULER
+# -----------------------------
+# One per process, shared by every session and background job. Each model has a concurrency limit; callers
+# waiting for a slot are queued per session and served round-robin, so one session firing twenty visuals cannot
+# starve the others. A 429 / RESOURCE_EXHAUSTED answer pauses the whole model for an exponential, jittered
+# backoff before the call is retried. Calls given a coalescing key share one execution while it is in flight.
+# on_start runs once a slot is granted (so callers can time the call itself, not the queue), and a caller that
+# gives up sets its cancel event through abandon(): a ticket still waiting for a slot is withdrawn.
+
+def is_rate_limited(e: Exception) -> bool:
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    return code == 429 or "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e)[:40]
+
+class ModelScheduler:
+    def __init__(self, limits=None, default_limit=6, max_retries=4, base_backoff=2.0, max_backoff=60.0):
+        self.limits, self.default_limit = dict(limits or {}), default_limit
+        self.max_retries, self.base_backoff, self.max_backoff = max_retries, base_backoff, max_backoff
+        self.cond = threading.Condition()
+        self.active = Counter()
+        self.queues = {}       # model -> OrderedDict(session -> deque of tickets); the first session is served next
+        self.paused_until = {} # model -> time.time() before which no slot is granted
+        self.strikes = Counter()
+        self.inflight = {}     # coalescing key -> Future
+        self.coalesced = Counter() # first element of the key (model or namespace) -> calls served by another run
+        self.stats = {}
+
+    def _stat(self, model):
+        return self.stats.setdefault(model, {"calls": 0, "throttled": 0, "retries": 0, "failed": 0, "abandoned": 0, "wait": 0.0})
+
+    def limit(self, model) -> int:
+        return self.limits.get(model, self.default_limit)
+
+    def acquire(self, model, session=None, cancel=None):
+        ticket, t0 = object(), time.time()
+        with self.cond:
+            q = self.queues.setdefault(model, OrderedDict())
+            q.setdefault(session, deque()).append(ticket)
+            while True:
+                if cancel is not None and cancel.is_set():
+                    q[session].remove(ticket)
+                    if not q[session]: del q[session]
+                    self._stat(model)["abandoned"] += 1; self.cond.notify_all()
+                    raise CancelledError(f"{model}: abandoned while waiting for a slot")
+                head = q[next(iter(q))][0]
+                wait = self.paused_until.get(model, 0) - time.time()
+                if head is ticket and self.active[model] < self.limit(model) and wait <= 0: break
+                self.cond.wait(timeout=wait if wait > 0 else None)
+            q[session].popleft()
+            if q[session]: q.move_to_end(session) # round-robin: this session goes behind the others
+            else: del q[session]
+            self.active[model] += 1
+            s = self._stat(model); s["calls"] += 1; s["wait"] += time.time() - t0
+            self.cond.notify_all()
+
+    def release(self, model, ok=True):
+        with self.cond:
+            self.active[model] -= 1
+            if ok: self.strikes[model] = 0
+            self.cond.notify_all()
+
+    def _backoff(self, model, e, attempt) -> bool:
+        # -> True when the call should be retried after the model-wide pause
+        if not is_rate_limited(e) or attempt >= self.max_retries:
+            with self.cond: self._stat(model)["failed"] += 1
+            return False
+        with self.cond:
+            self.strikes[model] += 1
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (self.strikes[model] - 1)) * random.uniform(0.75, 1.25)
+            self.paused_until[model] = max(self.paused_until.get(model, 0), time.time() + delay)
+            s = self._stat(model); s["throttled"] += 1; s["retries"] += 1
+        return True
+
+    def abandon(self, cancel):
+        cancel.set()
+        with self.cond: self.cond.notify_all()
+
+    def call(self, model, fn, *args, session=None, key=None, on_start=None, cancel=None, **kwargs):
+        """Runs fn(*args, **kwargs) in one of model's slots, retrying on rate limits; identical keys share one run."""
+        if key is not None: return self.coalesce((model, key), self.call, model, fn, *args, session=session, on_start=on_start, cancel=cancel, **kwargs)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, session, cancel)
+            ok = False
+            try:
+                if on_start: on_start()
+                result = fn(*args, **kwargs); ok = True
+                return result
+            except Exception as e:
+                if not self._backoff(model, e, attempt): raise
+            finally: self.release(model, ok)
+
+    def stream(self, model, fn, *args, session=None, on_start=None, cancel=None, **kwargs):
+        """Like call, for streaming fns: the slot is held until the stream ends. Retries only before the first chunk."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, session, cancel)
+            started = ok = False
+            try:
+                if on_start: on_start()
+                for chunk in fn(*args, **kwargs):
+                    started = True
+                    yield chunk
+                ok = True
+                return
+            except Exception as e:
+                if started or not self._backoff(model, e, attempt): raise
+            finally: self.release(model, ok)
+
+    def coalesce(self, key, fn, *args, **kwargs):
+        with self.cond:
+            fut, owner = self.inflight.get(key), False
+            if fut is None: fut, owner = self.inflight.setdefault(key, Future()), True
+            else: self.coalesced[key[0] if isinstance(key, tuple) else key] += 1
+        if not owner: return fut.result()
+        try:
+            result = fn(*args, **kwargs)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self.cond: self.inflight.pop(key, None)
+
+    def snapshot(self):
+        with self.cond:
+            models = set(self.stats) | set(self.limits)
+            return {m: {"limit": self.limit(m), "active": self.active[m], "queued": sum(len(d) for d in self.queues.get(m, {}).values()),
+                        "paused": max(0.0, self.paused_until.get(m, 0) - time.time()), "coalesced": self.coalesced[m], **self._stat(m)} for m in sorted(models)}
@@ -0,0 +1,134 @@
+import re
+import math
+from io import BytesIO
+
+from PIL import Image
+
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle
+from reportlab.lib.enums import TA_LEFT, TA_CENTER
+from reportlab.lib import colors
+
+# -----------------------------
+# PDF RENDERER
+# -----------------------------
+# Markdown papers (headings, pipe tables, **bold**/*italic*, inline LaTeX, IMAGE_GEN/PIE_CHART slots) to an A4 PDF.
+# Styles are built once at import. Each line goes through one regex-driven scan that handles LaTeX commands
+# (nested \frac included) and XML escaping together, and images are downscaled before ReportLab embeds them.
+
+_SAMPLE = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle("CustomTitle", parent=_SAMPLE["Heading1"], fontSize=18, textColor=colors.HexColor("#00d4ff"), spaceAfter=12, alignment=TA_CENTER, fontName="Helvetica-Bold")
+HEADING_STYLE = ParagraphStyle("CustomHeading", parent=_SAMPLE["Heading2"], fontSize=14, spaceAfter=10, spaceBefore=10, fontName="Helvetica-Bold")
+BODY_STYLE = ParagraphStyle("CustomBody", parent=_SAMPLE["BodyText"], fontSize=11, spaceAfter=8, alignment=TA_LEFT, fontName="Helvetica")
+TABLE_STYLE = TableStyle([("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#00d4ff")), ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke), ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"), ("VALIGN", (0, 0), (-1, -1), "TOP"), ("ALIGN", (0, 0), (-1, -1), "LEFT"), ("BOTTOMPADDING", (0, 0), (-1, 0), 8), ("BACKGROUND", (0, 1), (-1, -1), colors.HexColor("#f8f9fa")), ("GRID", (0, 0), (-1, -1), 0.5, colors.grey)])
+IMAGE_WIDTH = 4.6 * inch
+IMAGE_MAX_PX = 1000 # ~220 dpi at IMAGE_WIDTH; larger renders only bloat the file and slow the build
+FOOTER = "<i>Generated by helix.ai - Your CIE Tutor</i>"
+
+LATEX_SYMBOLS = {"times": " x ", "div": " ÷ ", "circ": "°", "degree": "°", "pm": "±", "leq": "≤", "le": "≤", "geq": "≥", "ge": "≥",
+                 "neq": "≠", "ne": "≠", "approx": "≈", "pi": "π", "cdot": "·", "left": "", "right": "", "displaystyle": ""}
+LATEX_FRACS = ("frac", "dfrac", "tfrac")
+LATEX_TEXT = ("text", "mathrm", "mathbf", "mathit", "textbf", "operatorname")
+LATEX_SPACES = {",": " ", ";": " ", ":": " ", " ": " ", "!": "", "(": "", ")": "", "[": "", "]": "", "\\": ""}
+XML_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;", "$": ""} # stray dollar signs are dropped, never rendered
+
+_TOKEN_RE = re.compile(r"\\([a-zA-Z]+)|\\(.)|[$&<>]", re.S)
+_SPECIAL_RE = re.compile(r"[\\$&<>*]")
+_ATOM_RE = re.compile(r"[\w.°π√]+")
+_EMPHASIS_RE = re.compile(r"\*\*(.+?)\*\*|(?<!\*)\*(\S.+?)\*(?!\*)")
+_ITALIC_RE = re.compile(r"(?<!\*)\*(\S.+?)\*(?!\*)")
+_SOURCE_RE = re.compile(r"\s*\(Source:.*?\)")
+_SEPARATOR_RE = re.compile(r":?-+:?")
+
+def _brace_group(s: str, i: int):
+    # -> (contents, index after the closing brace) for the {...} group starting at s[i] (after spaces), or None
+    while i < len(s) and s[i] == " ": i += 1
+    if i >= len(s) or s[i] != "{": return None
+    depth = 0
+    for j in range(i, len(s)):
+        if s[j] == "{": depth += 1
+        elif s[j] == "}":
+            depth -= 1
+            if depth == 0: return s[i + 1:j], j + 1
+    return None
+
+def _atom(s: str) -> str:
+    return s if _ATOM_RE.fullmatch(s) else f"({s})"
+
+def latex_to_rl(s: str) -> str:
+    out, pos = [], 0
+    while m := _TOKEN_RE.search(s, pos):
+        out.append(s[pos:m.start()]); pos = m.end()
+        cmd, ch = m.group(1), m.group(2)
+        if cmd is None and ch is None: out.append(XML_ESCAPES[m.group()])
+        elif ch is not None: out.append(LATEX_SPACES.get(ch, XML_ESCAPES.get(ch, ch)))
+        elif cmd in LATEX_FRACS and (num := _brace_group(s, pos)) and (den := _brace_group(s, num[1])):
+            out.append(f"{_atom(latex_to_rl(num[0]))}/{_atom(latex_to_rl(den[0]))}"); pos = den[1]
+        elif cmd == "sqrt":
+            if arg := _brace_group(s, pos): out.append("√" + _atom(latex_to_rl(arg[0]))); pos = arg[1]
+            else: out.append("√")
+        elif cmd in LATEX_TEXT and (arg := _brace_group(s, pos)): out.append(latex_to_rl(arg[0])); pos = arg[1]
+        else: out.append(LATEX_SYMBOLS.get(cmd, cmd)) # unknown commands keep their name, minus the backslash
+    out.append(s[pos:])
+    return "".join(out)
+
+def _emphasis(m) -> str:
+    if m.group(1) is not None: return "<b>" + _ITALIC_RE.sub(r"<i>\1</i>", m.group(1)) + "</b>"
+    return f"<i>{m.group(2)}</i>"
+
+def md_inline_to_rl(text: str) -> str:
+    s = text or ""
+    if not _SPECIAL_RE.search(s): return s
+    s = latex_to_rl(s)
+    return _EMPHASIS_RE.sub(_emphasis, s) if "*" in s else s
+
+def prepare_image(data: bytes):
+    # -> (stream, width px, height px) no larger than IMAGE_MAX_PX, or None if undecodable. Integer box reduction
+    # (plus DCT draft scaling for JPEGs) keeps this cheaper than letting ReportLab compress the full-size render.
+    try:
+        img = Image.open(BytesIO(data))
+        fmt = "JPEG" if img.format == "JPEG" else "PNG"
+        if max(img.size) <= IMAGE_MAX_PX and img.format == fmt: return BytesIO(data), *img.size
+        if fmt == "JPEG": img.draft("RGB", (IMAGE_MAX_PX, IMAGE_MAX_PX))
+        if (factor := math.ceil(max(img.size) / IMAGE_MAX_PX)) > 1: img = img.reduce(factor)
+        buf = BytesIO(); img.save(buf, format=fmt, **({"quality": 85} if fmt == "JPEG" else {})); buf.seek(0)
+        return buf, *img.size
+    except Exception: return None
+
+def paper_lines(content: str):
+    return [_SOURCE_RE.sub("", l).strip() for l in str(content or "⚠️ No content").split("\n") if "[PDF_READY]" not in l.upper() and not l.strip().startswith(("Source(s):", "**Source(s):**"))]
+
+def create_pdf(content: str, images=None, filename="Question_Paper.pdf"):
+    buffer = BytesIO(); doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=0.75*inch, leftMargin=0.75*inch, topMargin=0.75*inch, bottomMargin=0.75*inch)
+    story, img_idx, table_rows = [], 0, []
+
+    def render_pending_table():
+        nonlocal table_rows
+        if not table_rows: return
+        ncols = max(len(r) for r in table_rows)
+        norm_rows = [[Paragraph(md_inline_to_rl(c), BODY_STYLE) for c in list(r) + [""] * (ncols - len(r))] for r in table_rows]
+        t = Table(norm_rows, colWidths=[doc.width / max(1, ncols)] * ncols)
+        t.setStyle(TABLE_STYLE)
+        story.extend([t, Spacer(1, 0.18*inch)]); table_rows = []
+
+    for s in paper_lines(content):
+        if s.startswith("|") and s.endswith("|") and s.count("|") >= 2:
+            cells = [c.strip() for c in s.split("|")[1:-1]]
+            if not all(_SEPARATOR_RE.fullmatch(c) for c in cells if c): table_rows.append(cells)
+            continue
+        render_pending_table()
+        if not s: story.append(Spacer(1, 0.14*inch)); continue
+        if s.startswith(("IMAGE_GEN:", "PIE_CHART:")):
+            if images and img_idx < len(images) and images[img_idx] and (prepared := prepare_image(images[img_idx])):
+                stream, iw, ih = prepared
+                story.extend([Spacer(1, 0.12*inch), RLImage(stream, width=IMAGE_WIDTH, height=IMAGE_WIDTH * (ih / float(iw))), Spacer(1, 0.12*inch)])
+            img_idx += 1; continue
+        if s.startswith("# "): story.append(Paragraph(md_inline_to_rl(s[2:].strip()), TITLE_STYLE))
+        elif s.startswith("## "): story.append(Paragraph(md_inline_to_rl(s[3:].strip()), HEADING_STYLE))
+        elif s.startswith("### "): story.append(Paragraph(f"<b>{md_inline_to_rl(s[4:].strip())}</b>", BODY_STYLE))
+        else: story.append(Paragraph(md_inline_to_rl(s), BODY_STYLE))
+    render_pending_table(); story.extend([Spacer(1, 0.28*inch), Paragraph(FOOTER, BODY_STYLE)])
+    doc.build(story); buffer.seek(0)
+    return buffer
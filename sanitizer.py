@@ -0,0 +1,204 @@
+import re
+import json
+
+# -----------------------------
+# RESPONSE SANITIZER
+# -----------------------------
+# One left-to-right pass over a model reply: pulls out the hidden analytics JSON, drops markers and the
+# leaked "Here is the analytics..." lead-in, and returns display-ready text. Only str.find / raw_decode are
+# used, so cost stays linear in the reply length however the model mangles the tail.
+
+VISUAL_DIRECTIVE_RE = re.compile(r"(IMAGE_GEN|PIE_CHART):\s*\[(.*?)\]")
+OPEN_DIRECTIVE_RE = re.compile(r"(IMAGE_GEN|PIE_CHART):\s*(\[[^\]\n]*)?\Z") # still streaming its closing bracket
+ANALYTICS_START, ANALYTICS_END, PDF_READY = "===ANALYTICS_START===", "===ANALYTICS_END===", "[PDF_READY]"
+ANALYTICS_KEY = '"weak_point"'
+STREAM_HOLD_MARKERS = (ANALYTICS_START, PDF_READY, "IMAGE_GEN:", "PIE_CHART:")
+# Lines that may open the hidden analytics tail (or its leaked variants). One is held back only while it leads, through
+# at most a few lead-in / fence lines, to a "{" whose object is still open or holds ANALYTICS_KEY.
+STREAM_HOLD_LINES = ("===analytics", "```json", "{", "here is the analytics", "analytics")
+STREAM_TAIL_MAX = 4000 # an object still open after this many chars is prose, not the analytics JSON
+# A line ending right before the JSON counts as leaked lead-in prose when it starts with one of these.
+LEAD_IN_PREFIXES = ("here is the analytics", "here are the analytics", "here is the json", "analytics", "json", "```json")
+LEAD_IN_MAX = 120
+
+JSON_OPEN_RE = re.compile(r"\{\s*\"")
+_decoder = json.JSONDecoder()
+
+def _decode_object(text: str, start: int, stop: int):
+    # Parses the first JSON object in text[start:stop]; returns (payload, end) or (None, -1).
+    brace = text.find("{", start, stop)
+    while brace != -1:
+        try:
+            obj, end = _decoder.raw_decode(text, brace)
+            if isinstance(obj, dict): return obj, end
+        except ValueError: pass
+        brace = text.find("{", brace + 1, stop)
+    return None, -1
+
+def _open_braces(text: str, lo: int, key: int):
+    # Braces in text[lo:key] still unclosed at key, outermost first; one forward pass, strings not tracked.
+    stack, brace = [], text.find("{", lo, key)
+    close = text.find("}", lo, key)
+    while brace != -1 or close != -1:
+        if close == -1 or (brace != -1 and brace < close): stack.append(brace); brace = text.find("{", brace + 1, key)
+        else:
+            if stack: stack.pop()
+            close = text.find("}", close + 1, key)
+    return stack
+
+def _enclosing_object(text: str, lo: int, key: int):
+    # Walks outward over the braces still open at key, at most STREAM_TAIL_MAX chars back, and returns
+    # (brace, payload, end) for the first one that decodes past key, i.e. the object holding it. Otherwise brace is
+    # the outermost one that fails to decode (truncated JSON) with no blank line before key, or -1.
+    lo = max(lo, key - STREAM_TAIL_MAX)
+    blank, failed = text.rfind("\n\n", lo, key), -1
+    for brace in reversed(_open_braces(text, lo, key)):
+        try: obj, end = _decoder.raw_decode(text, brace)
+        except ValueError: obj, end = None, -1
+        if isinstance(obj, dict) and end > key: return brace, obj, end
+        if end == -1 and brace > blank: failed = brace
+    return failed, None, -1
+
+def _lead_in_start(text: str, lower: str, pos: int) -> int:
+    # Walks back over a ```json fence and at most one lead-in prose line that end right before pos.
+    for _ in range(2):
+        end = pos
+        while end and text[end - 1].isspace(): end -= 1
+        line_start = text.rfind("\n", 0, end) + 1
+        if end - line_start > LEAD_IN_MAX: break
+        line = lower[line_start:end].strip().lstrip("*#-> ").rstrip("*")
+        if not line.startswith(LEAD_IN_PREFIXES): break
+        pos = line_start
+    return pos
+
+def _skip_fence_close(text: str, end: int) -> int:
+    rest = end
+    while rest < len(text) and text[rest].isspace(): rest += 1
+    return rest + 3 if text.startswith("```", rest) else end
+
+def _analytics_spans(text: str, lower: str):
+    # Yields (start, end, payload) for each analytics block, marked or bare, in order.
+    pos = 0
+    while True:
+        marked, bare = lower.find(ANALYTICS_START.lower(), pos), lower.find(ANALYTICS_KEY, pos)
+        if marked == -1 and bare == -1: return
+        if marked != -1 and (bare == -1 or marked < bare):
+            body = marked + len(ANALYTICS_START)
+            close = lower.find(ANALYTICS_END.lower(), body)
+            stop = len(text) if close == -1 else close
+            payload, _ = _decode_object(text, body, stop)
+            end = stop if close == -1 else close + len(ANALYTICS_END)
+            yield _lead_in_start(text, lower, marked), end, payload
+        else:
+            brace, payload, end = _enclosing_object(text, pos, bare)
+            if brace == -1: pos = bare + len(ANALYTICS_KEY); continue
+            if payload is None: # truncated or malformed JSON: drop up to the first closing brace, like before
+                close = text.find("}", bare)
+                end = len(text) if close == -1 else close + 1
+                # ...but only for a JSON-shaped object or one that ends the reply; otherwise it is prose with braces
+                if not JSON_OPEN_RE.match(text, brace) and (close == -1 or text[_skip_fence_close(text, end):].strip()):
+                    pos = bare + len(ANALYTICS_KEY); continue
+            yield _lead_in_start(text, lower, brace), _skip_fence_close(text, end), payload
+        pos = max(end, pos + 1)
+
+def strip_markers(text: str) -> str:
+    lower, out, pos, m = text.lower(), [], 0, PDF_READY.lower()
+    while (hit := lower.find(m, pos)) != -1:
+        out.append(text[pos:hit]); pos = hit + len(m)
+    out.append(text[pos:])
+    return "".join(out)
+
+def sanitize_response(text: str):
+    """Returns (display_text, analytics_payload) for a raw model reply; payload is None when absent or unparseable."""
+    text = str(text or "")
+    lower, out, pos, payload = text.lower(), [], 0, None
+    for start, end, found in _analytics_spans(text, lower):
+        if start < pos: start = pos
+        out.append(text[pos:start]); pos = end
+        if payload is None: payload = found
+    out.append(text[pos:])
+    return strip_markers("".join(out)).strip(), payload
+
+def clean_display(text: str) -> str:
+    return sanitize_response(text)[0]
+
+def _object_end(text: str, brace: int, limit: int) -> int:
+    # Index just past the "}" matching text[brace] (string-aware), or -1 if it is still open before limit.
+    depth, in_str, esc = 0, False, False
+    for i in range(brace, min(limit, len(text))):
+        c = text[i]
+        if in_str:
+            if esc: esc = False
+            elif c == "\\": esc = True
+            elif c == '"': in_str = False
+        elif c == '"': in_str = True
+        elif c == "{": depth += 1
+        elif c == "}":
+            depth -= 1
+            if not depth: return i + 1
+    return -1
+
+def _holds_tail(text: str, lower: str, pos: int) -> bool:
+    # False is final: prose follows, or the object closed without the analytics key (set notation, ...).
+    for _ in range(4):
+        eol = text.find("\n", pos)
+        line_end = len(text) if eol == -1 else eol
+        brace = text.find("{", pos, line_end)
+        if brace != -1:
+            end = _object_end(text, brace, brace + STREAM_TAIL_MAX)
+            if end == -1: return len(text) - brace < STREAM_TAIL_MAX
+            return ANALYTICS_KEY in lower[brace:end]
+        line = lower[pos:line_end].strip()
+        if eol == -1: return not line or line.startswith(STREAM_HOLD_LINES) or any(h.startswith(line) for h in STREAM_HOLD_LINES)
+        if line and not line.startswith(STREAM_HOLD_LINES): return False
+        if eol + 1 == len(text): return True # lead-in whose JSON has not arrived yet
+        pos = eol + 1
+    return False
+
+# Accumulates streamed text; exposes a display-safe prefix and the visual directives of completed lines.
+class StreamSanitizer:
+    def __init__(self):
+        # raw[:shown] is complete lines that are never held back again; clean is their display text, so each
+        # visible() call only works on the unsettled rest and a whole turn stays linear in the reply length.
+        self.raw, self.scanned, self.shown, self.clean = "", 0, 0, ""
+
+    def feed(self, chunk: str):
+        self.raw += chunk or ""
+        end = self.raw.rfind("\n") + 1
+        if end <= self.scanned: return []
+        found = VISUAL_DIRECTIVE_RE.findall(self.raw, self.scanned, end)
+        self.scanned = end
+        return found
+
+    def finish(self):
+        found = VISUAL_DIRECTIVE_RE.findall(self.raw, self.scanned)
+        self.scanned = len(self.raw)
+        return found
+
+    def visible(self) -> str:
+        text = self.raw[self.shown:]
+        cut = text.upper().find(ANALYTICS_START)
+        if cut != -1: text = text[:cut]
+        lower, pos, settled = text.lower(), 0, 0
+        while pos < len(text):
+            eol = text.find("\n", pos)
+            s = lower[pos:len(text) if eol == -1 else eol].strip()
+            if s and s.startswith(STREAM_HOLD_LINES) and _holds_tail(text, lower, pos): text = text[:pos]; break
+            if eol == -1:
+                if s and any(h.startswith(s) for h in STREAM_HOLD_LINES): text = text[:pos]
+                break
+            pos = settled = eol + 1
+        if settled: self.clean += self._display(text[:settled]); self.shown += settled
+        # An unfinished directive or a marker prefix can only sit in the unsettled last line
+        text = VISUAL_DIRECTIVE_RE.sub("", text[settled:])
+        if m := OPEN_DIRECTIVE_RE.search(text): text = text[:m.start()]
+        up = text.upper()
+        for m in STREAM_HOLD_MARKERS:
+            for k in range(len(m) - 1, 0, -1):
+                if up.endswith(m[:k]): text, up = text[:-k], up[:-k]; break
+        return self.clean + strip_markers(text)
+
+    @staticmethod
+    def _display(text: str) -> str:
+        # Directives become images once the reply is done; while streaming they are hidden
+        return strip_markers(VISUAL_DIRECTIVE_RE.sub("", text))
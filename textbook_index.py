@@ -0,0 +1,169 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import concurrent.futures
+from pathlib import Path
+from collections import Counter, namedtuple
+
+import numpy as np
+
+try: from pypdf import PdfReader
+except ImportError: PdfReader = None # index building needs pypdf; searching an existing index does not
+
+# -----------------------------
+# TEXTBOOK PAGE INDEX
+# -----------------------------
+# Offline BM25 index over the CIE_*.pdf textbooks. Pages are split into overlapping word windows ("chunks"),
+# each remembering its book and 1-based page number so the chat can cite it. On disk:
+#   meta.json     books, chunk table (book, page, length, text offset/size), vocabulary term -> [offset, df]
+#   postings.bin  (chunk_id u32, tf u16) records, grouped per term; memory-mapped, never loaded whole
+#   pages.bin     UTF-8 chunk texts, sliced out of a memory map on demand
+# Build with:  python textbook_index.py build   (search check:  python textbook_index.py search "photosynthesis")
+
+INDEX_DIR = Path(".textbook_index")
+INDEX_VERSION = 1
+CHUNK_WORDS, CHUNK_OVERLAP = 300, 50
+BM25_K1, BM25_B = 1.5, 0.75
+POSTING = np.dtype([("doc", "<u4"), ("tf", "<u2")])
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("a an and are as at be by can do does for from has have how i in is it its me my of on or so that the their them then there these this to was we what when where which who why will with you your".split())
+
+Hit = namedtuple("Hit", "book page score text")
+
+def tokenize(text: str):
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and t not in STOPWORDS]
+
+def is_textbook_pdf(path: Path) -> bool:
+    return path.suffix.lower() == ".pdf" and path.name.upper().startswith("CIE_")
+
+def book_stamp(path: Path) -> dict:
+    st = path.stat()
+    return {"size": st.st_size, "mtime": int(st.st_mtime)}
+
+def extract_chunks(path: Path):
+    # -> [(page, text)] for one book; runs in a worker process during builds
+    chunks = []
+    for page_no, page in enumerate(PdfReader(str(path)).pages, 1):
+        try: words = (page.extract_text() or "").split()
+        except Exception: continue
+        step = CHUNK_WORDS - CHUNK_OVERLAP
+        for start in range(0, max(len(words) - CHUNK_OVERLAP, 1), step):
+            if window := words[start:start + CHUNK_WORDS]: chunks.append((page_no, " ".join(window)))
+    return chunks
+
+def build_index(paths, out_dir: Path = INDEX_DIR, workers: int = None, in_process: bool = False) -> dict:
+    # in_process extracts on the calling thread (for builds triggered inside the running app, where forking is unsafe)
+    if PdfReader is None: raise RuntimeError("pypdf is required to build the textbook index (pip install pypdf)")
+    paths = sorted({Path(p) for p in paths if is_textbook_pdf(Path(p))}, key=lambda p: p.name.lower())
+    t0 = time.time()
+    if in_process: extracted = [extract_chunks(p) for p in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as exe: extracted = list(exe.map(extract_chunks, paths))
+
+    docs, postings, text_blobs, offset = [], {}, [], 0
+    for book_id, chunks in enumerate(extracted):
+        for page, text in chunks:
+            doc_id, tokens = len(docs), tokenize(text)
+            for term, tf in Counter(tokens).items(): postings.setdefault(term, []).append((doc_id, min(tf, 65535)))
+            blob = text.encode("utf-8")
+            docs.append([book_id, page, len(tokens), offset, len(blob)])
+            text_blobs.append(blob); offset += len(blob)
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    vocab, pos = {}, 0
+    tmp = {name: out_dir / f"{name}.tmp" for name in ("postings.bin", "pages.bin", "meta.json")}
+    with open(tmp["postings.bin"], "wb") as f:
+        for term in sorted(postings):
+            plist = np.array(postings[term], dtype=POSTING)
+            f.write(plist.tobytes()); vocab[term] = [pos, len(plist)]; pos += len(plist)
+    with open(tmp["pages.bin"], "wb") as f:
+        for blob in text_blobs: f.write(blob)
+    meta = {"version": INDEX_VERSION, "built_at": time.time(), "avgdl": (sum(d[2] for d in docs) / len(docs)) if docs else 0.0,
+            "books": [{"file": p.name.lower(), "pages": max((c[0] for c in ch), default=0), **book_stamp(p)} for p, ch in zip(paths, extracted)],
+            "docs": docs, "vocab": vocab}
+    tmp["meta.json"].write_text(json.dumps(meta, separators=(",", ":")))
+    # meta.json is swapped in last, so a reader never sees it pointing past the end of the data files
+    for name in ("postings.bin", "pages.bin", "meta.json"): os.replace(tmp[name], out_dir / name)
+    return {"books": len(paths), "chunks": len(docs), "terms": len(vocab), "seconds": round(time.time() - t0, 2)}
+
+class TextbookIndex:
+    def __init__(self, out_dir: Path, meta: dict):
+        self.dir, self.meta = out_dir, meta
+        self.books = [b["file"] for b in meta["books"]]
+        self.book_ids = {f: i for i, f in enumerate(self.books)}
+        docs = np.array(meta["docs"], dtype=np.int64).reshape(-1, 5)
+        self.doc_book, self.doc_page, self.doc_len = docs[:, 0], docs[:, 1], docs[:, 2].astype(np.float32)
+        self.doc_off, self.doc_size = docs[:, 3], docs[:, 4]
+        self.vocab, self.avgdl = meta["vocab"], meta["avgdl"] or 1.0
+        self.postings = np.memmap(out_dir / "postings.bin", dtype=POSTING, mode="r") if self.vocab else np.zeros(0, POSTING)
+        self.pages = np.memmap(out_dir / "pages.bin", dtype=np.uint8, mode="r") if len(docs) else np.zeros(0, np.uint8)
+
+    @classmethod
+    def load(cls, out_dir: Path = INDEX_DIR):
+        try:
+            meta = json.loads((out_dir / "meta.json").read_text())
+            return cls(out_dir, meta) if meta.get("version") == INDEX_VERSION else None
+        except (OSError, ValueError, KeyError): return None
+
+    def is_current(self, paths) -> bool:
+        stamps = {b["file"]: (b["size"], b["mtime"]) for b in self.meta["books"]}
+        try: return all(stamps.get(p.name.lower()) == tuple(book_stamp(p).values()) for p in paths)
+        except OSError: return False
+
+    def covers(self, filenames) -> bool:
+        return all(f.lower() in self.book_ids for f in filenames)
+
+    def chunk_text(self, doc_id: int) -> str:
+        off, size = int(self.doc_off[doc_id]), int(self.doc_size[doc_id])
+        return bytes(self.pages[off:off + size]).decode("utf-8", errors="replace")
+
+    def search(self, query: str, k: int = 6, books=None):
+        """Top-k BM25 chunks for query, at most one per (book, page); books restricts the search to those filenames."""
+        n = len(self.doc_len)
+        terms = set(tokenize(query))
+        if not n or not terms: return []
+        scores = np.zeros(n, dtype=np.float32)
+        for term in terms:
+            if not (entry := self.vocab.get(term)): continue
+            off, df = entry
+            plist = self.postings[off:off + df]
+            docs, tf = plist["doc"].astype(np.int64), plist["tf"].astype(np.float32)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[docs] / self.avgdl))
+        if books is not None:
+            scores[~np.isin(self.doc_book, [self.book_ids[f.lower()] for f in books if f.lower() in self.book_ids])] = 0
+        hits, seen = [], set()
+        for doc_id in np.argsort(-scores)[:k * 4]:
+            if scores[doc_id] <= 0 or len(hits) == k: break
+            page = (int(self.doc_book[doc_id]), int(self.doc_page[doc_id]))
+            if page in seen: continue
+            seen.add(page)
+            hits.append(Hit(self.books[page[0]], page[1], float(scores[doc_id]), self.chunk_text(int(doc_id))))
+        return hits
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Build or query the local textbook page index.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="index every CIE_*.pdf under the given folders/files (default: current folder)")
+    b.add_argument("paths", nargs="*", default=["."])
+    b.add_argument("--out", type=Path, default=INDEX_DIR)
+    b.add_argument("--workers", type=int, default=None)
+    s = sub.add_parser("search", help="print the top pages for a query")
+    s.add_argument("query")
+    s.add_argument("-k", type=int, default=6)
+    s.add_argument("--out", type=Path, default=INDEX_DIR)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "build":
+        pdfs = [p for root in map(Path, args.paths) for p in ([root] if root.is_file() else root.rglob("*.pdf")) if is_textbook_pdf(p)]
+        print(json.dumps(build_index(pdfs, args.out, args.workers)))
+    else:
+        if not (index := TextbookIndex.load(args.out)): sys.exit(f"No index in {args.out}; run: python textbook_index.py build")
+        for h in index.search(args.query, args.k): print(f"{h.score:7.2f}  {h.book} p.{h.page}  {h.text[:100]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# -----------------------------
+# TRACING
+# -----------------------------
+# Nested timing spans for chat turns, paper jobs and textbook syncs. tracer.trace() opens a root; tracer.span()
+# nests under whatever span is current in this thread/context, and on its own (e.g. in a worker pool) only feeds
+# the per-model samples when it carries a `model` attribute. Model spans wrap the scheduler call, so callers mark
+# the moment a slot is granted (Span.slot_acquired, the scheduler's on_start); the time before it is recorded as
+# queue wait and left out of the model's latency. Finished roots land in a bounded ring buffer and, when an export
+# path is set, are appended to a JSONL file.
+
+_current = contextvars.ContextVar("helix_span", default=None)
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "children", "error")
+
+    def __init__(self, name, attrs):
+        self.name, self.attrs, self.children, self.error = name, attrs, [], None
+        self.start = self.end = time.perf_counter()
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def slot_acquired(self):
+        # Retried calls queue again; the last grant wins, so backoff pauses count as queue wait too
+        self.attrs["queued"] = round(time.perf_counter() - self.start, 4)
+
+    def to_dict(self, t0: float) -> dict:
+        d = {"name": self.name, "offset": round(self.start - t0, 4), "duration": round(self.duration, 4)}
+        if self.attrs: d["attrs"] = self.attrs
+        if self.error: d["error"] = self.error
+        if self.children: d["spans"] = [c.to_dict(t0) for c in self.children]
+        return d
+
+def percentile(values, p: float) -> float:
+    v = sorted(values)
+    return v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))] if v else 0.0
+
+def walk(spans):
+    for s in spans:
+        yield s
+        yield from walk(s.get("spans", ()))
+
+class Tracer:
+    def __init__(self, capacity=500, model_capacity=2000, export_path=None):
+        self.lock = threading.Lock()
+        self.traces = deque(maxlen=capacity)
+        self.model_samples = deque(maxlen=model_capacity) # (model, seconds in the slot, ok, seconds queued)
+        self.export_path = export_path
+
+    @contextmanager
+    def span(self, name, _root=False, **attrs):
+        parent = _current.get()
+        s = Span(name, attrs)
+        token = _current.set(s)
+        try: yield s
+        except Exception as e:
+            s.error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            s.end = time.perf_counter()
+            _current.reset(token)
+            if "model" in attrs:
+                queued = attrs.get("queued", 0.0)
+                with self.lock: self.model_samples.append((attrs["model"], s.duration - queued, s.error is None, queued))
+            if _root or parent is None:
+                if _root: self._finish(s)
+            else: parent.children.append(s)
+
+    def trace(self, name, **attrs):
+        """Opens a root span; everything timed under it in this context becomes part of one trace."""
+        return self.span(name, _root=True, **attrs)
+
+    def _finish(self, root: Span):
+        d = {"name": root.name, "at": time.time(), **root.to_dict(root.start)}
+        with self.lock:
+            self.traces.append(d)
+            if self.export_path:
+                try:
+                    with open(self.export_path, "a", encoding="utf-8") as f: f.write(json.dumps(d, default=str) + "\n")
+                except OSError as e: print(f"Trace Export Error: {e}")
+
+    def recent(self, name=None):
+        with self.lock: return [t for t in self.traces if name is None or t["name"] == name]
+
+    def stage_stats(self):
+        groups = {}
+        for t in self.recent():
+            groups.setdefault((t["name"], "(total)"), []).append(t["duration"])
+            for s in walk(t.get("spans", ())): groups.setdefault((t["name"], s["name"]), []).append(s["duration"])
+        return [{"trace": k[0], "stage": k[1], "count": len(v), "p50": percentile(v, 50), "p95": percentile(v, 95), "max": max(v)} for k, v in sorted(groups.items())]
+
+    def model_stats(self):
+        groups = {}
+        with self.lock: samples = list(self.model_samples)
+        for model, secs, ok, queued in samples: groups.setdefault(model, []).append((secs, ok, queued))
+        return [{"model": m, "count": len(v), "errors": sum(1 for _, ok, _ in v if not ok), "p50": percentile([s for s, _, _ in v], 50), "p95": percentile([s for s, _, _ in v], 95),
+                 "queue_p50": percentile([q for _, _, q in v], 50), "queue_p95": percentile([q for _, _, q in v], 95)} for m, v in sorted(groups.items())]
+
+    def slowest(self, name, n=10):
+        return sorted(self.recent(name), key=lambda t: -t["duration"])[:n]